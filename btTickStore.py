@@ -0,0 +1,276 @@
+# encoding: UTF-8
+#
+# Copyright 2018 BigQuant, Inc.
+#
+# 二进制tick行情存储，按 交易日/合约 保存定长记录，回放时内存映射读取
+#
+# 目录结构:
+#   <root>/<tradingDay>/index.json       索引：合约列表、记录数、起止时间、字段等
+#   <root>/<tradingDay>/<btSymbol>.tick  定长记录，按转换顺序保存
+#
+
+import csv
+import json
+import os
+from itertools import islice
+
+import numpy as np
+
+from bigtrader.btObject import BtTickData
+
+from btVMatch import TICK_FIELD_TYPES, iter_csv_ticks
+
+INDEX_FILE = 'index.json'
+TICK_FILE_EXT = '.tick'
+TIME_WIDTH = 16
+
+# 固定保存的字段，其余数值字段按转换时的csv列保存
+BASE_FIELDS = ['lastPrice', 'volume']
+DEPTH_FIELDS = ['askPrice', 'askVolume', 'bidPrice', 'bidVolume']
+# 每条记录的头部：原始行号、时间(毫秒)、actionDay在索引中的序号、原始时间字符串
+HEADER_DTYPE = [('seq', '<i8'), ('time_ms', '<i4'), ('action_day', '<u2'), ('time', 'S%d' % TIME_WIDTH)]
+# 按合约保存的字符串字段，取该合约的第一笔记录
+KNOWN_STR_FIELDS = {'btSymbol', 'date', 'time', 'actionDay'}
+
+
+def time_to_ms(time_str):
+    """'HH:MM:SS[.fff]' 转为当日毫秒数"""
+    hms, _, frac = time_str.partition('.')
+    h, m, s = hms.split(':')
+    ms = int((frac + '000')[:3]) if frac else 0
+    return ((int(h) * 60 + int(m)) * 60 + int(s)) * 1000 + ms
+
+
+def make_tick_dtype(fields):
+    """根据数值字段生成记录类型"""
+    dtype = list(HEADER_DTYPE)
+    for field in fields:
+        dtype.append((field, '<f8' if TICK_FIELD_TYPES.get(field) is float else '<i8'))
+    return np.dtype(dtype)
+
+
+def convert_csv(csv_file, root, columns=None, fixed_fields=None, depth=5, chunk_size=100000, encoding='utf-8'):
+    """将csv行情文件转换为二进制存储，参数同 iter_csv_ticks，返回写入的记录数
+    depth: 保存的盘口档数；csv中没有的数值字段不保存，回放时保持tick默认值
+    交易日已有存储时（如按合约存储的多个文件依次转换），合并到已有索引，记录追加到已有合约文件，
+    行号接着已有记录编号；已有存储的字段、档数须与本次相同
+    """
+    with open(csv_file, 'r', newline='', encoding=encoding) as f:
+        header = next(csv.reader(f), [])
+    names = list(columns.keys()) if columns else list(header)
+    if fixed_fields:
+        names.extend(fixed_fields.keys())
+
+    depth_fields = set('%s%d' % (prefix, i) for prefix in DEPTH_FIELDS for i in range(1, depth + 1))
+    fields = [name for name in names if name in TICK_FIELD_TYPES and
+              (name in BASE_FIELDS or name in depth_fields or not name[-1].isdigit())]
+    for field in BASE_FIELDS:
+        if field not in fields:
+            fields.append(field)
+    str_fields = [name for name in names if name not in TICK_FIELD_TYPES and name not in KNOWN_STR_FIELDS]
+    dtype = make_tick_dtype(fields)
+
+    days = {}       # {tradingDay: 索引}
+    written = set()
+    count = 0
+    ticks = iter_csv_ticks(csv_file, columns, fixed_fields, chunk_size, encoding)
+    while True:
+        chunk = list(islice(ticks, chunk_size))
+        if not chunk:
+            break
+
+        buffers = {}    # {(tradingDay, btSymbol): [record]}
+        for tick in chunk:
+            if not tick.date:
+                raise ValueError("convert_csv tick without date in {}".format(csv_file))
+            day = days.get(tick.date)
+            if day is None:
+                day = _load_day_index(root, tick.date, depth, fields)
+                written.update((tick.date, btSymbol) for btSymbol in day['symbols'])
+                days[tick.date] = day
+
+            symbol = day['symbols'].get(tick.btSymbol)
+            time_ms = time_to_ms(tick.time)
+            if symbol is None:
+                symbol = {'file': tick.btSymbol + TICK_FILE_EXT, 'count': 0, 'sorted': True,
+                          'firstTime': time_ms, 'lastTime': time_ms,
+                          'attrs': {name: getattr(tick, name) for name in str_fields}}
+                day['symbols'][tick.btSymbol] = symbol
+            elif time_ms < symbol['lastTime']:
+                symbol['sorted'] = False
+            symbol['count'] += 1
+            symbol['firstTime'] = min(symbol['firstTime'], time_ms)
+            symbol['lastTime'] = max(symbol['lastTime'], time_ms)
+
+            action_days = day['actionDays']
+            try:
+                action_day = action_days.index(tick.actionDay)
+            except ValueError:
+                action_day = len(action_days)
+                action_days.append(tick.actionDay)
+
+            time_bytes = tick.time.encode('ascii')
+            if len(time_bytes) > TIME_WIDTH:
+                raise ValueError("convert_csv time '{}' longer than {} chars in {}"
+                                 .format(tick.time, TIME_WIDTH, csv_file))
+            record = (day['count'], time_ms, action_day, time_bytes) + \
+                tuple(getattr(tick, field) for field in fields)
+            day['count'] += 1
+            try:
+                buffers[(tick.date, tick.btSymbol)].append(record)
+            except KeyError:
+                buffers[(tick.date, tick.btSymbol)] = [record]
+
+        for (trading_day, btSymbol), records in buffers.items():
+            day_dir = os.path.join(root, trading_day)
+            path = os.path.join(day_dir, days[trading_day]['symbols'][btSymbol]['file'])
+            key = (trading_day, btSymbol)
+            # 本次新增的合约覆盖可能残留的文件，已有合约追加
+            if key not in written:
+                os.makedirs(day_dir, exist_ok=True)
+                mode = 'wb'
+                written.add(key)
+            else:
+                mode = 'ab'
+            with open(path, mode) as f:
+                np.array(records, dtype=dtype).tofile(f)
+        count += len(chunk)
+
+    for trading_day, day in days.items():
+        with open(os.path.join(root, trading_day, INDEX_FILE), 'w') as f:
+            json.dump(day, f, ensure_ascii=False, indent=1)
+    return count
+
+
+def _load_day_index(root, trading_day, depth, fields):
+    """交易日已有的索引，没有时新建"""
+    path = os.path.join(root, trading_day, INDEX_FILE)
+    if not os.path.isfile(path):
+        return {'tradingDay': trading_day, 'depth': depth, 'fields': fields, 'actionDays': [],
+                'symbols': {}, 'count': 0}
+
+    with open(path) as f:
+        day = json.load(f)
+    if day['fields'] != fields or day['depth'] != depth:
+        raise ValueError("convert_csv fields/depth {}/{} differ from existing index {}/{} in {}"
+                         .format(fields, depth, day['fields'], day['depth'], path))
+    return day
+
+
+class TickStore(object):
+    """二进制tick行情存储的读取"""
+    def __init__(self, root):
+        self.root = root
+        self.indexes = {}   # {tradingDay: index}
+
+    def get_days(self):
+        """所有交易日"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isfile(os.path.join(self.root, name, INDEX_FILE)))
+
+    def get_index(self, trading_day):
+        """交易日索引"""
+        index = self.indexes.get(trading_day)
+        if index is None:
+            with open(os.path.join(self.root, trading_day, INDEX_FILE)) as f:
+                index = json.load(f)
+            index['dtype'] = make_tick_dtype(index['fields'])
+            self.indexes[trading_day] = index
+        return index
+
+    def get_symbols(self, trading_day):
+        """交易日的所有合约"""
+        return list(self.get_index(trading_day)['symbols'].keys())
+
+    def read_records(self, trading_day, btSymbol, start_time=None, end_time=None):
+        """内存映射读取某合约的记录，可按时间 [start_time, end_time] 截取，不读取其余部分"""
+        index = self.get_index(trading_day)
+        symbol = index['symbols'].get(btSymbol)
+        if not symbol or not symbol['count']:
+            return np.empty(0, dtype=index['dtype'])
+
+        records = np.memmap(os.path.join(self.root, trading_day, symbol['file']), dtype=index['dtype'],
+                            mode='r', shape=(symbol['count'],))
+        if start_time is None and end_time is None:
+            return records
+
+        start_ms = time_to_ms(start_time) if start_time else -1
+        end_ms = time_to_ms(end_time) if end_time else 1 << 30
+        time_ms = records['time_ms']
+        if symbol['sorted']:
+            # 二分查找，只访问少量页面
+            begin = np.searchsorted(time_ms, start_ms, side='left')
+            end = np.searchsorted(time_ms, end_ms, side='right')
+            return records[begin:end]
+        return records[(time_ms >= start_ms) & (time_ms <= end_ms)]
+
+    def iter_ticks(self, days=None, symbols=None, start_time=None, end_time=None, chunk_size=65536):
+        """按时间顺序回放 BtTickData：按 actionDay、时间排序，时间相同的按转换时的行号
+        days: 交易日列表，默认全部
+        symbols: 合约列表，默认全部
+        start_time/end_time: 'HH:MM:SS' 时间范围
+        """
+        for trading_day in (days if days is not None else self.get_days()):
+            index = self.get_index(trading_day)
+            day_symbols = index['symbols']
+            selected = [s for s in (symbols if symbols is not None else day_symbols) if s in day_symbols]
+
+            parts = []
+            for btSymbol in selected:
+                records = self.read_records(trading_day, btSymbol, start_time, end_time)
+                if len(records):
+                    parts.append((btSymbol, records))
+            if not parts:
+                continue
+
+            yield from self._iter_day_ticks(index, parts, chunk_size)
+
+    @staticmethod
+    def _iter_day_ticks(index, parts, chunk_size):
+        """将多个合约的记录按 (actionDay, 时间, 行号) 合并，分块生成tick
+        多个文件分别转换时行号按文件先后编号，只按行号会把先转换的文件整体排在前面
+        """
+        trading_day = index['tradingDay']
+        action_days = index['actionDays']
+        fields = index['fields']
+        symbols = index['symbols']
+
+        # actionDay 在索引中按出现顺序编号，换算为日期先后
+        day_ranks = np.empty(len(action_days), dtype=np.int64)
+        day_ranks[np.argsort(action_days, kind='stable')] = np.arange(len(action_days))
+        seqs = np.concatenate([records['seq'] for _, records in parts])
+        times = np.concatenate([records['time_ms'] for _, records in parts])
+        days = day_ranks[np.concatenate([records['action_day'] for _, records in parts])]
+        part_ids = np.repeat(np.arange(len(parts)), [len(records) for _, records in parts])
+        rows = np.concatenate([np.arange(len(records)) for _, records in parts])
+        order = np.lexsort((seqs, times, days))
+        del seqs, times, days
+
+        for begin in range(0, len(order), chunk_size):
+            chunk = order[begin:begin + chunk_size]
+            chunk_parts = part_ids[chunk]
+            chunk_rows = rows[chunk]
+
+            # 按合约分组批量读取记录，再按原始顺序放回
+            out = [None] * len(chunk)
+            by_part = np.argsort(chunk_parts, kind='stable')
+            splits = np.flatnonzero(np.diff(chunk_parts[by_part])) + 1
+            for positions in np.split(by_part, splits):
+                btSymbol, records = parts[chunk_parts[positions[0]]]
+                attrs = symbols[btSymbol]['attrs']
+                for pos, record in zip(positions.tolist(), records[chunk_rows[positions]].tolist()):
+                    out[pos] = (btSymbol, attrs, record)
+
+            for btSymbol, attrs, record in out:
+                tick = BtTickData()
+                tick.btSymbol = btSymbol
+                tick.date = trading_day
+                tick.time = record[3].decode('ascii')
+                tick.actionDay = action_days[record[2]]
+                for name, value in attrs.items():
+                    setattr(tick, name, value)
+                for name, value in zip(fields, record[4:]):
+                    setattr(tick, name, value)
+                yield tick
@@ -5,11 +5,21 @@
 # 模拟撮合模型
 #
 
+import csv
+import heapq
 import math
-from copy import copy
+import os
+import pickle
+import struct
+import traceback
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime
-from queue import Queue, Empty
-from threading import Thread
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
+from queue import Queue, Empty, Full
+from threading import Lock, Thread, current_thread
+from time import perf_counter
 
 from bigtrader.btConstant import *
 from bigtrader.btObject import BtOrderReq, BtCancelOrderReq
@@ -17,14 +27,109 @@ from bigtrader.btObject import BtBarData, BtTickData, BtOrderData, BtTradeData
 
 EV_REQ_ORDER = 'eReqOrder'
 EV_REQ_CANCEL = 'eReqCancel'
+EV_TICK = 'eTick'
+EV_BAR = 'eBar'
+EV_SNAPSHOT = 'eSnapshot'
+EV_REQ_ORDERS = 'eReqOrders'
+
+# 共享流动性的分配方式
+ALLOC_PRIORITY = 'priority'     # 价格优先、时间优先
+ALLOC_PRO_RATA = 'pro_rata'     # 按剩余委托量比例
+
+# 撮合内部使用的订单/成交字段，与 BtOrderData/BtTradeData 的同名字段对应
+ORDER_FIELDS = ('gatewayName', 'accountID', 'brokerID', 'symbol', 'exchange', 'btSymbol', 'orderID', 'btOrderID',
+                'orderSysID', 'btOrderSysID', 'businessUnit', 'direction', 'offset', 'hedgeFlag', 'priceType',
+                'price', 'totalVolume', 'tradedVolume', 'status', 'statusMsg', 'tradingDay', 'userID',
+                'multiplier', 'frontID', 'sessionID')
+TRADE_FIELDS = ('accountID', 'brokerID', 'symbol', 'exchange', 'btSymbol', 'orderSysID', 'btOrderSysID',
+                'tradeID', 'btTradeID', 'orderID', 'btOrderID', 'direction', 'offset', 'price', 'volume',
+                'tradeDate', 'tradeTime', 'tradingDay', 'tradeDateTime', 'userID')
+
+# 订单某一时刻的快照、成交记录，均为不可变的轻量记录
+OrderRecord = namedtuple('OrderRecord', ORDER_FIELDS)
+TradeRecord = namedtuple('TradeRecord', TRADE_FIELDS)
+_get_order_fields = attrgetter(*ORDER_FIELDS)
+_get_trade_fields = attrgetter(*TRADE_FIELDS)
+# 默认字段值，转换时直接填充实例字典，比逐个字段初始化快
+_order_data_defaults = vars(BtOrderData())
+_trade_data_defaults = vars(BtTradeData())
+
+
+def snapshot_order(order):
+    """订单快照 OrderRecord"""
+    return tuple.__new__(OrderRecord, _get_order_fields(order))
+
+
+def to_order_data(order):
+    """SimOrder/OrderRecord 转为 BtOrderData"""
+    order_data = BtOrderData.__new__(BtOrderData)
+    fields = order_data.__dict__
+    fields.update(_order_data_defaults)
+    fields.update(zip(ORDER_FIELDS, _get_order_fields(order)))
+    return order_data
+
+
+def to_trade_data(trade):
+    """TradeRecord 转为 BtTradeData"""
+    trade_data = BtTradeData.__new__(BtTradeData)
+    fields = trade_data.__dict__
+    fields.update(_trade_data_defaults)
+    fields.update(zip(TRADE_FIELDS, _get_trade_fields(trade)))
+    return trade_data
+
+
+class SimOrder(object):
+    """撮合内部使用的订单，只保存撮合需要的字段，回报时再转为 BtOrderData"""
+    __slots__ = ORDER_FIELDS
+
+    def __init__(self, order_req):
+        self.gatewayName = order_req.gatewayName
+        self.accountID = order_req.accountID
+        self.brokerID = order_req.brokerID
+        self.symbol = order_req.symbol
+        self.exchange = order_req.exchange
+        self.btSymbol = order_req.btSymbol
+        self.orderID = str(order_req.orderID)
+        self.btOrderID = ''
+        self.orderSysID = ''
+        self.btOrderSysID = ''
+        self.businessUnit = ''
+        self.direction = order_req.direction
+        self.offset = order_req.offset
+        self.hedgeFlag = '1'
+        self.priceType = order_req.priceType
+        self.price = order_req.price
+        self.totalVolume = order_req.volume
+        self.tradedVolume = 0
+        self.status = STATUS_UNKNOWN
+        self.statusMsg = "未知"
+        self.tradingDay = ''
+        self.userID = order_req.userID
+        self.multiplier = order_req.multiplier
+        self.frontID = 0
+        self.sessionID = 0
+
+    @classmethod
+    def from_record(cls, record):
+        """由 OrderRecord 恢复订单"""
+        order = cls.__new__(cls)
+        for name, value in zip(ORDER_FIELDS, record):
+            setattr(order, name, value)
+        return order
+
+    def __repr__(self):
+        return "SimOrder({})".format(', '.join('{}={}'.format(name, getattr(self, name)) for name in ORDER_FIELDS))
+
 
 ########################################################################
-class TradeInfo:
+class TradeInfo(object):
     """成交信息"""
+    __slots__ = ('order', 'traded_order', 'trade_id', 'trade_volume', 'trade_price', 'trade_date', 'trade_time')
+
     def __init__(self, order, trade_id, trade_volume, trade_price, trade_date, trade_time):
         """成交信息"""
         self.order = order
-        self.traded_order = copy(order)
+        self.traded_order = snapshot_order(order)
         self.trade_id = trade_id
         self.trade_volume = trade_volume
         self.trade_price = trade_price
@@ -36,11 +141,362 @@ class TradeInfo:
         return "TradeInfo(trade_id:{},trade_volume:{},trade_price:{},trade_time:{} {})"\
                .format(self.trade_id, self.trade_volume, self.trade_price, self.trade_date, self.trade_time)
 
+JOURNAL_ORDER = 'O'
+JOURNAL_TRADE = 'T'
+JOURNAL_SEG_EXT = '.seg'
+JOURNAL_IDX_EXT = '.idx'
+_JOURNAL_HEAD = struct.Struct('<I')
+
+
+class VMatchJournal(object):
+    """交易流水（订单快照 OrderRecord、成交记录 TradeRecord）
+    1. 内存中最多保留 max_records 条，超过时将较早的一半写入磁盘
+    2. 磁盘上每个交易日一个追加写的段文件 <root>/<tradingDay>.seg，记录为 长度 + pickle，
+       并有索引文件 <tradingDay>.idx，每行 "orderSysID 偏移"，查询时才加载
+    3. root 为 None 时不写磁盘，超出的记录被丢弃
+    4. 查询均为生成器，按写入顺序逐条读取，不一次性加载
+    """
+    def __init__(self, root=None, max_records=100000):
+        self.root = root
+        self.max_records = max(2, max_records)
+        self.trading_day = ''
+
+        self.order_n = 0        # 记录总数
+        self.trade_n = 0
+        self.dropped_n = 0      # 未写磁盘而丢弃的记录数
+
+        self.__memory = OrderedDict()   # 尚未写盘的记录 {tradingDay: deque(record)}
+        self.__memory_n = 0
+        self.__memory_ids = {}          # 内存中各订单的记录数 {orderSysID: n}
+        self.__indexes = {}             # 已加载的写盘索引 {tradingDay: {orderSysID: [offset]}}
+
+    def set_trading_day(self, trading_day):
+        self.trading_day = trading_day
+
+    def append_order(self, record):
+        self.order_n += 1
+        self._append(record)
+
+    def append_trade(self, record):
+        self.trade_n += 1
+        self._append(record)
+
+    def _append(self, record):
+        try:
+            self.__memory[self.trading_day].append(record)
+        except KeyError:
+            self.__memory[self.trading_day] = deque([record])
+        memory_ids = self.__memory_ids
+        memory_ids[record.orderSysID] = memory_ids.get(record.orderSysID, 0) + 1
+        self.__memory_n += 1
+        if self.__memory_n > self.max_records:
+            self.spill(self.__memory_n - self.max_records // 2)
+
+    def __len__(self):
+        return self.order_n + self.trade_n
+
+    def spill(self, n=None):
+        """将内存中最早的 n 条（默认全部）记录写入磁盘"""
+        n = self.__memory_n if n is None else min(n, self.__memory_n)
+        if self.root is not None and n:
+            os.makedirs(self.root, exist_ok=True)
+
+        memory = self.__memory
+        memory_ids = self.__memory_ids
+        while n > 0:
+            trading_day, records = next(iter(memory.items()))
+            count = min(n, len(records))
+            spilled = [records.popleft() for _ in range(count)]
+            if not records:
+                del memory[trading_day]
+            n -= count
+            self.__memory_n -= count
+            for record in spilled:
+                left = memory_ids[record.orderSysID] - 1
+                if left:
+                    memory_ids[record.orderSysID] = left
+                else:
+                    del memory_ids[record.orderSysID]
+
+            if self.root is None:
+                self.dropped_n += count
+            else:
+                self._write(trading_day, spilled)
+
+    flush = spill
+
+    def _write(self, trading_day, records):
+        index = self.__indexes.get(trading_day)
+        lines = []
+        with open(self._path(trading_day, JOURNAL_SEG_EXT), 'ab') as f:
+            offset = f.tell()
+            chunks = []
+            for record in records:
+                kind = JOURNAL_TRADE if type(record) is TradeRecord else JOURNAL_ORDER
+                data = pickle.dumps((kind, tuple(record)), pickle.HIGHEST_PROTOCOL)
+                chunks.append(_JOURNAL_HEAD.pack(len(data)))
+                chunks.append(data)
+                lines.append('{} {}\n'.format(record.orderSysID, offset))
+                if index is not None:
+                    try:
+                        index[record.orderSysID].append(offset)
+                    except KeyError:
+                        index[record.orderSysID] = [offset]
+                offset += _JOURNAL_HEAD.size + len(data)
+            f.write(b''.join(chunks))
+        with open(self._path(trading_day, JOURNAL_IDX_EXT), 'a') as f:
+            f.write(''.join(lines))
+
+    def _path(self, trading_day, ext):
+        return os.path.join(self.root, (trading_day or '_') + ext)
+
+    def _get_index(self, trading_day):
+        """已写盘记录的索引，首次访问时从索引文件加载"""
+        index = self.__indexes.get(trading_day)
+        if index is None:
+            index = {}
+            path = self._path(trading_day, JOURNAL_IDX_EXT) if self.root is not None else None
+            if path and os.path.isfile(path):
+                with open(path) as f:
+                    for line in f:
+                        orderSysID, _, offset = line.rstrip('\n').rpartition(' ')
+                        try:
+                            index[orderSysID].append(int(offset))
+                        except KeyError:
+                            index[orderSysID] = [int(offset)]
+            self.__indexes[trading_day] = index
+        return index
+
+    def get_days(self):
+        """有流水的交易日"""
+        days = set(self.__memory.keys())
+        if self.root is not None and os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name.endswith(JOURNAL_SEG_EXT):
+                    day = name[:-len(JOURNAL_SEG_EXT)]
+                    days.add('' if day == '_' else day)
+        return sorted(days)
+
+    def _iter_disk(self, trading_day, offsets=None):
+        """读取写盘的记录 (kind, record)"""
+        if self.root is None:
+            return
+        path = self._path(trading_day, JOURNAL_SEG_EXT)
+        if not os.path.isfile(path):
+            return
+        head_size = _JOURNAL_HEAD.size
+        unpack = _JOURNAL_HEAD.unpack
+        with open(path, 'rb') as f:
+            if offsets is None:
+                while True:
+                    head = f.read(head_size)
+                    if len(head) < head_size:
+                        break
+                    kind, values = pickle.loads(f.read(unpack(head)[0]))
+                    yield kind, tuple.__new__(TradeRecord if kind == JOURNAL_TRADE else OrderRecord, values)
+            else:
+                for offset in offsets:
+                    f.seek(offset)
+                    kind, values = pickle.loads(f.read(unpack(f.read(head_size))[0]))
+                    yield kind, tuple.__new__(TradeRecord if kind == JOURNAL_TRADE else OrderRecord, values)
+
+    def iter_records(self, trading_day=None, orderSysID=None, kind=None):
+        """按写入顺序逐条读取流水
+        trading_day: 交易日，None 表示全部
+        orderSysID: 只读取该订单的记录（按索引定位）
+        kind: JOURNAL_ORDER/JOURNAL_TRADE，None 表示全部
+        """
+        record_type = None if kind is None else (TradeRecord if kind == JOURNAL_TRADE else OrderRecord)
+        days = self.get_days() if trading_day is None else [trading_day]
+        for day in days:
+            offsets = None
+            if orderSysID is not None:
+                offsets = self._get_index(day).get(orderSysID)
+            if orderSysID is None or offsets:
+                for record_kind, record in self._iter_disk(day, offsets):
+                    if kind is None or record_kind == kind:
+                        yield record
+
+            # 内存中的记录
+            records = self.__memory.get(day)
+            if not records or (orderSysID is not None and orderSysID not in self.__memory_ids):
+                continue
+            for record in list(records):
+                if (record_type is None or type(record) is record_type) and \
+                   (orderSysID is None or record.orderSysID == orderSysID):
+                    yield record
+
+    def iter_trades(self, trading_day=None, orderSysID=None):
+        """逐条读取成交记录"""
+        return self.iter_records(trading_day, orderSysID, JOURNAL_TRADE)
+
+    def get_trade_summary(self, trading_day=None):
+        """日终对账：按合约、方向汇总成交 {(btSymbol, direction): [成交量, 成交额, 成交笔数]}"""
+        summary = {}
+        for trade in self.iter_trades(trading_day):
+            key = (trade.btSymbol, trade.direction)
+            item = summary.get(key)
+            if item is None:
+                summary[key] = [trade.volume, trade.volume * trade.price, 1]
+            else:
+                item[0] += trade.volume
+                item[1] += trade.volume * trade.price
+                item[2] += 1
+        return summary
+
+# 预写日志的记录类型
+WAL_TRADING_DAY = 'D'   # (D, tradingDay) 交易日切换
+WAL_REQ_ORDER = 'R'     # (R, OrderRecord) 订单请求，尚未处理
+WAL_ACCEPT = 'A'        # (A, OrderRecord) 订单处理结果（挂单/拒单）
+WAL_CANCEL = 'X'        # (X, OrderRecord) 撤单成功
+WAL_MATCH = 'M'         # (M, OrderRecord, TradeRecord/None) 撮合结果（成交/撤销）
+WAL_FILE_FMT = 'wal.{}.log'
+SNAPSHOT_FILE = 'snapshot.pkl'
+
+
+class VMatchWAL(object):
+    """预写日志及快照，用于实盘模拟崩溃后快速恢复
+    1. 状态变化在对外回报前追加写入 <root>/wal.<代号>.log，每条为 长度 + pickle，
+       每条直接写入文件（进程崩溃不丢失），fsync 为 True 时每条同步到磁盘（断电不丢失）
+    2. 快照时先切换到新一代日志，再原子替换 snapshot.pkl，最后删除旧的日志
+    3. 恢复时加载快照，只重放快照之后的日志；末尾写了一半的记录被丢弃
+    """
+    def __init__(self, root, fsync=False):
+        self.root = root
+        self.fsync = fsync
+        self.generation = 0     # 当前日志代号，快照中记录其后第一代
+        self.record_n = 0       # 当前日志的记录数
+        self.__file = None
+        self.__valid_end = (None, 0)    # 已读取日志的完整记录结束位置 (代号, 位置)
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, generation):
+        return os.path.join(self.root, WAL_FILE_FMT.format(generation))
+
+    def _get_generations(self):
+        generations = []
+        prefix, suffix = WAL_FILE_FMT.split('{}')
+        for name in os.listdir(self.root):
+            if name.startswith(prefix) and name.endswith(suffix):
+                try:
+                    generations.append(int(name[len(prefix):-len(suffix)]))
+                except ValueError:
+                    pass
+        return sorted(generations)
+
+    def load_snapshot(self):
+        """读取最近的快照，没有时返回 None"""
+        path = os.path.join(self.root, SNAPSHOT_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        self.generation = snapshot['generation']
+        return snapshot
+
+    def _iter_file(self, generation):
+        """逐条读取一代日志，生成 (记录, 该记录的结束位置)，遇到不完整的记录时停止"""
+        head_size = _JOURNAL_HEAD.size
+        unpack = _JOURNAL_HEAD.unpack
+        end = 0
+        with open(self._path(generation), 'rb') as f:
+            while True:
+                head = f.read(head_size)
+                if len(head) < head_size:
+                    break
+                size = unpack(head)[0]
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                try:
+                    entry = pickle.loads(data)
+                except Exception:
+                    break
+                kind = entry[0]
+                if kind == WAL_MATCH:
+                    trade = entry[2] and tuple.__new__(TradeRecord, entry[2])
+                    entry = (kind, tuple.__new__(OrderRecord, entry[1]), trade)
+                elif kind != WAL_TRADING_DAY:
+                    entry = (kind, tuple.__new__(OrderRecord, entry[1]))
+                end += head_size + size
+                yield entry, end
+
+    def iter_tail(self):
+        """依次读取快照之后的日志记录"""
+        for generation in self._get_generations():
+            if generation >= self.generation:
+                self.generation = generation
+                self.record_n = 0
+                self.__valid_end = (generation, 0)
+                for entry, end in self._iter_file(generation):
+                    self.record_n += 1
+                    self.__valid_end = (generation, end)
+                    yield entry
+
+    def open(self):
+        """打开当前一代日志以追加写入，截掉末尾不完整的记录"""
+        if self.__file:
+            return
+        path = self._path(self.generation)
+        if os.path.isfile(path):
+            generation, end = self.__valid_end
+            if generation != self.generation:
+                # 未经 iter_tail 读取过，重新扫描
+                end = 0
+                self.record_n = 0
+                for _, end in self._iter_file(self.generation):
+                    self.record_n += 1
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        self.__file = open(path, 'ab', buffering=0)
+
+    def close(self):
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+    def append(self, kind, record, trade=None):
+        """追加一条记录，OrderRecord/TradeRecord 按普通元组保存，读取时还原"""
+        if kind == WAL_MATCH:
+            entry = (kind, tuple(record), trade and tuple(trade))
+        elif kind == WAL_TRADING_DAY:
+            entry = (kind, record)
+        else:
+            entry = (kind, tuple(record))
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        self.__file.write(_JOURNAL_HEAD.pack(len(data)) + data)
+        if self.fsync:
+            os.fsync(self.__file.fileno())
+        self.record_n += 1
+
+    def write_snapshot(self, state):
+        """写入快照，之后的记录写入新一代日志，并删除旧日志"""
+        old_generation = self.generation
+        self.close()
+        self.generation = old_generation + 1
+        self.record_n = 0
+        self.open()
+
+        state = dict(state, generation=self.generation)
+        path = os.path.join(self.root, SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        for generation in self._get_generations():
+            if generation < self.generation:
+                os.remove(self._path(generation))
+
+
 class SimPosition(object):
     """简单持仓"""
     def __init__(self, multiplier, is_future):
         self.multiplier = multiplier
         assert multiplier > 0, "multiplier should be > 0"
+        self.is_future = is_future
         if is_future:
             self.update_position = self.update_future_position
         else:
@@ -64,6 +520,18 @@ class SimPosition(object):
                        self.short_share, self.short_price, self.short_frozen,
                        self.last_price, self.closed_pnl)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['update_position']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.is_future:
+            self.update_position = self.update_future_position
+        else:
+            self.update_position = self.update_equity_position
+
     @property
     def long_avail(self):
         return self.long_share - self.long_frozen
@@ -116,6 +584,214 @@ class SimPosition(object):
             self.update_long_frozen(-trade.volume)
 
 
+class TickDepth(object):
+    """一笔tick的盘口深度，记录本笔tick内已被订单消耗的量
+    1. 各档价量取自 askPrice1..N/askVolume1..N 等字段，或逐笔快照的 askPrices/askVolumes 等序列（任意档数）
+    2. 盘口量总是从最优档开始消耗，每边只需记录已消耗的总量，结合累计量数组二分查找起始档位
+    """
+    __slots__ = ('tick', 'ask_prices', 'ask_cums', 'ask_used', 'bid_prices', 'bid_cums', 'bid_used')
+
+    def __init__(self, tick, depth, ask_levels=None, bid_levels=None):
+        """ask_levels/bid_levels: 直接指定各档 [(价格, 量)]，不从tick读取"""
+        self.tick = tick
+        # 卖档价格递增；买档价格取负后同样递增
+        self.ask_prices, self.ask_cums = self._load_levels(tick, 'ask', depth, 1, ask_levels)
+        self.bid_prices, self.bid_cums = self._load_levels(tick, 'bid', depth, -1, bid_levels)
+        self.ask_used = 0
+        self.bid_used = 0
+
+    @staticmethod
+    def _load_levels(tick, side, depth, sign, levels=None):
+        if levels is not None:
+            prices = [price for price, _ in levels]
+            volumes = [volume for _, volume in levels]
+        else:
+            prices = getattr(tick, side + 'Prices', None)
+            if prices is not None:
+                volumes = getattr(tick, side + 'Volumes')
+            else:
+                prices = [getattr(tick, '%sPrice%d' % (side, i), 0) for i in range(1, depth + 1)]
+                volumes = [getattr(tick, '%sVolume%d' % (side, i), 0) for i in range(1, depth + 1)]
+
+        level_prices, cums = [], []
+        total = 0
+        for price, volume in zip(prices, volumes):
+            # 无效档位之后的档位均无效
+            if not price or price <= 0:
+                break
+            if volume > 0:
+                total += volume
+                level_prices.append(sign * price)
+                cums.append(total)
+        return level_prices, cums
+
+    def available(self, is_buy, limit_price=None):
+        """价格不劣于 limit_price 的剩余可成交量，limit_price 为 None 表示不限价"""
+        if is_buy:
+            prices, cums, used = self.ask_prices, self.ask_cums, self.ask_used
+            key = limit_price
+        else:
+            prices, cums, used = self.bid_prices, self.bid_cums, self.bid_used
+            key = None if limit_price is None else -limit_price
+        k = len(prices) if key is None else bisect_right(prices, key)
+        return cums[k - 1] - used if k and cums[k - 1] > used else 0
+
+    def take(self, is_buy, limit_price, volume):
+        """按价格优先消耗盘口量，返回 [(成交价, 成交量)]"""
+        if is_buy:
+            prices, cums, used, sign = self.ask_prices, self.ask_cums, self.ask_used, 1
+        else:
+            prices, cums, used, sign = self.bid_prices, self.bid_cums, self.bid_used, -1
+        key = None if limit_price is None else sign * limit_price
+
+        fills = []
+        i = bisect_right(cums, used)
+        n = len(prices)
+        while volume > 0 and i < n:
+            if key is not None and prices[i] > key:
+                break
+            trade_volume = min(cums[i] - used, volume)
+            fills.append((sign * prices[i], trade_volume))
+            used += trade_volume
+            volume -= trade_volume
+            i += 1
+
+        if is_buy:
+            self.ask_used = used
+        else:
+            self.bid_used = used
+        return fills
+
+    def take_pro_rata(self, is_buy, requests):
+        """逐档按剩余需求量比例分配盘口量，取整后的余量按请求顺序（优先级）分配
+        requests: [(key, limit_price, volume)]，按优先级排序
+        返回 {key: [(成交价, 成交量)]}
+        """
+        if is_buy:
+            prices, cums, used, sign = self.ask_prices, self.ask_cums, self.ask_used, 1
+        else:
+            prices, cums, used, sign = self.bid_prices, self.bid_cums, self.bid_used, -1
+        remaining = {key: volume for key, _, volume in requests}
+        fills = {key: [] for key, _, _ in requests}
+
+        i = bisect_right(cums, used)
+        n = len(prices)
+        while i < n:
+            level_price = prices[i]
+            # 越深的档位可成交的请求越少
+            eligible = [key for key, limit_price, _ in requests if remaining[key] > 0 and
+                        (limit_price is None or level_price <= sign * limit_price)]
+            if not eligible:
+                break
+
+            size = cums[i] - used
+            demand = sum(remaining[key] for key in eligible)
+            if demand <= size:
+                allocs = [(key, remaining[key]) for key in eligible]
+            else:
+                allocs = [(key, int(size * remaining[key] / demand)) for key in eligible]
+                left = size - sum(volume for _, volume in allocs)
+                for j, (key, volume) in enumerate(allocs):
+                    if left <= 0:
+                        break
+                    if volume < remaining[key]:
+                        allocs[j] = (key, volume + 1)
+                        left -= 1
+
+            for key, volume in allocs:
+                if volume > 0:
+                    fills[key].append((sign * level_price, volume))
+                    remaining[key] -= volume
+                    used += volume
+            if demand <= size:
+                break
+            i += 1
+
+        if is_buy:
+            self.ask_used = used
+        else:
+            self.bid_used = used
+        return fills
+
+
+def _time_id_base():
+    """按当前时间生成的编号基数"""
+    return int(datetime.now().strftime("%Y%m%d%H%M%S")) * 100000
+
+
+class IDSource(object):
+    """编号段的来源，为多个 IDAllocator 分配互不重叠的编号段
+    1. seed 为 None 时以当前时间为基数（实盘），否则从 seed 开始，按相同顺序取号时编号完全相同（回测可复现）
+    2. 多个分片（进程）各用 shard 不同、n_shards 相同的来源，编号段交错分配，无需跨进程协调
+    3. 只有取编号段时加锁，段内分配不加锁
+    """
+    def __init__(self, seed=None, block_size=100000, shard=0, n_shards=1):
+        if not 0 <= shard < n_shards:
+            raise ValueError("shard {} out of range [0, {})".format(shard, n_shards))
+        self.seed = seed
+        if seed is None:
+            self.base = _time_id_base()
+            self.session_id = self.base // 100000 % 1000000000000
+        else:
+            self.base = seed
+            self.session_id = seed % 1000000000000
+        self.block_size = block_size
+        self.shard = shard
+        self.n_shards = n_shards
+        self.block_n = 0        # 已分配的编号段数
+        self.__lock = Lock()
+
+    def next_block(self):
+        """分配一个编号段 [start, end)"""
+        with self.__lock:
+            index = self.block_n * self.n_shards + self.shard
+            self.block_n += 1
+        start = self.base + index * self.block_size + 1
+        return start, start + self.block_size
+
+    def high_water(self):
+        """已分配编号段的最大编号"""
+        return self.base + ((self.block_n - 1) * self.n_shards + self.shard + 1) * self.block_size
+
+    def advance_past(self, value):
+        """之后分配的编号段都大于 value，用于恢复后不与已用过的编号重复"""
+        with self.__lock:
+            # 第 block_n 段的起始编号为 base + (block_n * n_shards + shard) * block_size + 1
+            index = (value - 1 - self.base) // self.block_size + 1
+            block_n = -(-(index - self.shard) // self.n_shards)
+            self.block_n = max(self.block_n, block_n)
+
+
+class IDAllocator(object):
+    """编号分配，从 IDSource 取编号段后在段内顺序分配，一个分配器只在一个线程中使用"""
+    def __init__(self, source=None):
+        self.source = source if source is not None else _get_default_id_source()
+        self.__next = 0
+        self.__end = 0
+
+    def next_id(self):
+        if self.__next >= self.__end:
+            self.__next, self.__end = self.source.next_block()
+        value = self.__next
+        self.__next += 1
+        return value
+
+    def new_block(self):
+        """放弃当前编号段，下次分配时取新的编号段"""
+        self.__next = self.__end = 0
+
+
+_default_id_source = None
+
+
+def _get_default_id_source():
+    """未指定来源的分配器共用一个按当前时间的来源，同一进程内编号不重复"""
+    global _default_id_source
+    if _default_id_source is None:
+        _default_id_source = IDSource()
+    return _default_id_source
+
+
 """
 实时行情：
 1. 行情线程收到行情后，put到工作线程中
@@ -126,13 +802,13 @@ class SimPosition(object):
 
 class VMatchEngine(object):
     """撮合引擎，只负责订单的撮合"""
-    # 成交编号
-    trade_id = 0
-
     PRICETYPE_TOBE_CANCELED = set([PRICETYPE_MARKETPRICE, PRICETYPE_FAK, PRICETYPE_FOK])
 
-    def __init__(self):
-        """只负责撮合"""
+    def __init__(self, trade_ids=None):
+        """只负责撮合
+        trade_ids: 成交编号分配器 IDAllocator，默认从进程内共用的按时间来源分配
+        """
+        self.trade_ids = trade_ids if trade_ids is not None else IDAllocator()
         self.last_mds = {}          # 上一次行情
 
         self.price_impact = 0.1
@@ -141,16 +817,12 @@ class VMatchEngine(object):
         self.price_round = 2
         self.get_trade_vp = None
 
-        self.reset_trade_id()
+        self.tick_depths = {}       # 当前tick的盘口深度 {btSymbol: TickDepth}
+        self.set_tick_depth(1)
 
-    @classmethod
-    def reset_trade_id(cls):
-        cls.trade_id = int(datetime.now().strftime("%Y%m%d%H%M%S")) * 100000
-
-    @classmethod
-    def next_trade_id(cls):
-        cls.trade_id += 1
-        return cls.trade_id
+    def next_trade_id(self):
+        """成交编号"""
+        return self.trade_ids.next_id()
 
     def match_by_tick1(self, order, tick, trade_infos):
         """根据1档tick行情撮合"""
@@ -170,38 +842,42 @@ class VMatchEngine(object):
 
     def match_by_tick5(self, order, tick, trade_infos):
         """根据5档tick行情撮合"""
-        last_tick = self.last_mds.get(tick.btSymbol)
-        if not last_tick:
-            last_tick = BtTickData()
-
-        self.get_trade_vp = self.get_trade_vp_by_tick
-        volume_delta = tick.volume - last_tick.volume
-        
-        for i in range(5):
-            if i == 0:
-                ask_price = tick.askPrice1
-                bid_price = tick.bidPrice1
-            elif i == 1:
-                ask_price = tick.askPrice2
-                bid_price = tick.bidPrice2
-            elif i == 2:
-                ask_price = tick.askPrice3
-                bid_price = tick.bidPrice3
-            elif i == 3:
-                ask_price = tick.askPrice4
-                bid_price = tick.bidPrice4
-            elif i == 4:
-                ask_price = tick.askPrice5
-                bid_price = tick.bidPrice5
-
-            rv = self.match_order(order, ask_price, bid_price, tick.lastPrice, tick.volume, volume_delta,
-                                  tick.actionDay, tick.time[:8], trade_infos)
-            if rv == 0:
-                # 没有成交
-                break
-            volume_delta -= trade_infos[-1].trade_volume
-
-        if tick != last_tick:
+        return self.match_by_depth(order, tick, trade_infos, 5)
+
+    def set_tick_depth(self, depth):
+        """设置tick撮合使用的盘口档数，1档时按最新价及成交量撮合，多档时按各档价量撮合"""
+        self.tick_depth = depth
+        self.match_by_tick = self.match_by_tick1 if depth <= 1 else self.match_by_depth
+
+    def get_tick_depth(self, tick, depth=None):
+        """获取tick的盘口深度，同一笔tick内的多个订单共用，已成交的量不再重复成交"""
+        tick_depth = self.tick_depths.get(tick.btSymbol)
+        if tick_depth is None or tick_depth.tick is not tick:
+            tick_depth = TickDepth(tick, depth or self.tick_depth)
+            self.tick_depths[tick.btSymbol] = tick_depth
+        return tick_depth
+
+    def match_by_depth(self, order, tick, trade_infos, depth=None):
+        """根据多档tick行情撮合，按价格优先逐档消耗盘口挂单量，成交价为各档价格"""
+        tick_depth = self.get_tick_depth(tick, depth)
+        is_buy = order.direction == DIRECTION_LONG
+        # 市价单可与所有档位成交
+        limit_price = None if order.priceType == PRICETYPE_MARKETPRICE else order.price
+        cur_date, cur_time = tick.actionDay, tick.time[:8]
+        remaining = order.totalVolume - order.tradedVolume
+
+        if order.priceType == PRICETYPE_FOK and tick_depth.available(is_buy, limit_price) < remaining:
+            # 该FOK单无法全部成交
+            self.cancel_order(order, cur_date, cur_time, trade_infos)
+        else:
+            fills = tick_depth.take(is_buy, limit_price, remaining)
+            for trade_price, trade_volume in fills:
+                self.fill_order(order, trade_price, trade_volume, cur_date, cur_time, trade_infos)
+            if not fills and order.priceType in self.PRICETYPE_TOBE_CANCELED:
+                # 市价单/FAK无可成交的量，撤销
+                self.cancel_order(order, cur_date, cur_time, trade_infos)
+
+        if tick is not self.last_mds.get(tick.btSymbol):
             self.last_mds[tick.btSymbol] = tick
 
     def match_by_bar(self, order, bar, trade_infos):
@@ -224,10 +900,7 @@ class VMatchEngine(object):
 
             if order.priceType == PRICETYPE_FOK and order.totalVolume > volume_delta:
                 # 该FOK单无法成交，创建一个成交量为0的数据，后续该订单将不在挂单队列中
-                order.status = STATUS_CANCELLED
-                order.statusMsg = "已撤单"
-                trade_info = TradeInfo(order, '', 0, 0, cur_date, cur_time)
-                trade_infos.append(trade_info)
+                self.cancel_order(order, cur_date, cur_time, trade_infos)
                 return 0
 
             # !该订单可成交!
@@ -235,44 +908,49 @@ class VMatchEngine(object):
 
             trade_price, trade_volume = self.get_trade_vp(order.direction, order.price,
                 order.totalVolume - order.tradedVolume, volume_delta, last_price)
-            if trade_volume < 0.0001:
-                if order.priceType in self.PRICETYPE_TOBE_CANCELED:
-                    order.status = STATUS_CANCELLED
-                    order.statusMsg = "已撤单"
-                    trade_info = TradeInfo(order, '', 0, 0, cur_date, cur_time)
-                    trade_infos.append(trade_info)
-                return 0
-
-            # 更新订单数据
-            order.tradedVolume += trade_volume
-            if order.totalVolume - order.tradedVolume > 0:
-                # 部分成交
-                if order.priceType in self.PRICETYPE_TOBE_CANCELED:
-                    order.status = STATUS_PARTCANCELLED
-                    order.statusMsg = "部分撤单"
-                else:
-                    order.status = STATUS_PARTTRADED
-                    order.statusMsg = "部分成交"
-            else:
-                # 全部成交
-                order.status = STATUS_ALLTRADED
-                order.statusMsg = "全部成交"
-
-            # 成交信息
-            trade_id = str(self.next_trade_id())
-            trade_info = TradeInfo(order, trade_id, trade_volume, trade_price, cur_date, cur_time)
-            trade_infos.append(trade_info)
-
-            return 1
+            return self.fill_order(order, trade_price, trade_volume, cur_date, cur_time, trade_infos)
         elif order.priceType in self.PRICETYPE_TOBE_CANCELED:
             # 市价单/FAK/FOK则创建一个成交量为0的数据，后续该订单将不在挂单队列中
-            order.status = STATUS_CANCELLED
-            order.statusMsg = "已撤单"
-            trade_info = TradeInfo(order, '', 0, 0, cur_date, cur_time)
-            trade_infos.append(trade_info)
+            self.cancel_order(order, cur_date, cur_time, trade_infos)
             return 0
         return 0
 
+    def cancel_order(self, order, cur_date, cur_time, trade_infos):
+        """撤销订单，创建一个成交量为0的数据"""
+        order.status = STATUS_CANCELLED
+        order.statusMsg = "已撤单"
+        trade_info = TradeInfo(order, '', 0, 0, cur_date, cur_time)
+        trade_infos.append(trade_info)
+
+    def fill_order(self, order, trade_price, trade_volume, cur_date, cur_time, trade_infos):
+        """按撮合得到的成交价量更新订单，返回是否有成交"""
+        if trade_volume < 0.0001:
+            if order.priceType in self.PRICETYPE_TOBE_CANCELED:
+                self.cancel_order(order, cur_date, cur_time, trade_infos)
+            return 0
+
+        # 更新订单数据
+        order.tradedVolume += trade_volume
+        if order.totalVolume - order.tradedVolume > 0:
+            # 部分成交
+            if order.priceType in self.PRICETYPE_TOBE_CANCELED:
+                order.status = STATUS_PARTCANCELLED
+                order.statusMsg = "部分撤单"
+            else:
+                order.status = STATUS_PARTTRADED
+                order.statusMsg = "部分成交"
+        else:
+            # 全部成交
+            order.status = STATUS_ALLTRADED
+            order.statusMsg = "全部成交"
+
+        # 成交信息
+        trade_id = str(self.next_trade_id())
+        trade_info = TradeInfo(order, trade_id, trade_volume, trade_price, cur_date, cur_time)
+        trade_infos.append(trade_info)
+
+        return 1
+
     def get_trade_vp_by_tick(self, direction, order_price, order_volume, volume, last_price):
         """根据tick获取成交价量"""
         if direction == DIRECTION_LONG:
@@ -285,6 +963,10 @@ class VMatchEngine(object):
 
     def get_trade_vp_by_bar(self, direction, order_price, order_volume, volume, last_price):
         """根据bar获取成交价量"""
+        if volume <= 0:
+            # 无成交量的bar不能成交
+            return order_price, 0
+
         max_volume = self.volume_limit * volume if self.volume_limit > 0 else volume
         trade_volume = min(order_volume, max_volume)
         if self.volume_round == 1:
@@ -304,28 +986,137 @@ class VMatchEngine(object):
         return trade_price, trade_volume
 
 
+class RestingOrders(object):
+    """一个合约的挂单队列
+    1. 按进入队列的先后遍历（快照、共享流动性等），移除订单不需遍历队列
+    2. 限价单另按方向、价格排序，行情到达时二分查找出价格可成交的挂单，其余挂单不必逐个撮合
+    3. 市价/FAK/FOK单每笔行情都要处理（成交或撤销），放在单独的列表中
+    """
+    __slots__ = ('orders', 'buys', 'sells', 'fast', 'entries', 'seq')
+
+    def __init__(self):
+        self.orders = {}    # 按时间排列 {seq: order}
+        self.buys = []      # 买限价单 [(price, seq, order)]，按价格、时间排列
+        self.sells = []     # 卖限价单，同上
+        self.fast = []      # 市价/FAK/FOK单 [(price, seq, order)]，按时间排列
+        self.entries = {}   # {orderSysID: (price, seq, order)}
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __iter__(self):
+        return iter(self.orders.values())
+
+    def __contains__(self, order):
+        entry = self.entries.get(order.orderSysID)
+        return entry is not None and entry[2] is order
+
+    def __repr__(self):
+        return "RestingOrders(orders={},buys={},sells={},fast={})".format(
+            len(self.orders), len(self.buys), len(self.sells), len(self.fast))
+
+    def _get_side(self, order):
+        if order.priceType in VMatchEngine.PRICETYPE_TOBE_CANCELED:
+            return self.fast
+        return self.buys if order.direction == DIRECTION_LONG else self.sells
+
+    def append(self, order):
+        """订单进入队列"""
+        entry = (order.price, self.seq, order)
+        self.orders[self.seq] = order
+        self.seq += 1
+        self.entries[order.orderSysID] = entry
+        side = self._get_side(order)
+        if side is self.fast:
+            side.append(entry)
+        else:
+            # (price, seq) 唯一，不会比较到订单
+            insort(side, entry)
+
+    def remove(self, order):
+        """订单离开队列，不在队列中时抛出 ValueError（同 list.remove）"""
+        entry = self.entries.get(order.orderSysID)
+        if entry is None or entry[2] is not order:
+            raise ValueError('order not in resting orders')
+        del self.entries[order.orderSysID]
+        del self.orders[entry[1]]
+        side = self._get_side(order)
+        if side is self.fast:
+            side.remove(entry)
+        else:
+            del side[bisect_left(side, entry[:2])]
+
+    def discard(self, orders):
+        """移除一批在队列中的订单（如撮合结束的订单）
+        各价格队列只压缩一次被移除订单所在的区间，不逐个删除（逐个删除每次都要移动之后的元素）
+        """
+        entries, time_orders = self.entries, self.orders
+        removed = set()
+        spans = {}      # {id(side): (side, lo, hi)}
+        for order in orders:
+            entry = entries.pop(order.orderSysID)
+            del time_orders[entry[1]]
+            removed.add(id(order))
+            side = self._get_side(order)
+            if side is self.fast:
+                lo, hi = 0, len(side)
+            else:
+                lo = bisect_left(side, entry[:2])
+                hi = lo + 1
+            span = spans.get(id(side))
+            if span is not None:
+                lo, hi = min(lo, span[1]), max(hi, span[2])
+            spans[id(side)] = (side, lo, hi)
+        for side, lo, hi in spans.values():
+            side[lo:hi] = [entry for entry in side[lo:hi] if id(entry[2]) not in removed]
+
+    def crossable(self, ask_price, bid_price):
+        """价格可成交的限价单（买价 >= ask_price，卖价 <= bid_price）及全部市价/FAK/FOK单，按时间排列"""
+        buys, sells = self.buys, self.sells
+        matched = []
+        if buys and buys[-1][0] >= ask_price:
+            matched = buys[bisect_left(buys, (ask_price,)):]
+        if sells and sells[0][0] <= bid_price:
+            matched += sells[:bisect_right(sells, (bid_price, math.inf))]
+        if self.fast:
+            matched += self.fast
+        if not matched:
+            return matched
+        if len(matched) > 1:
+            matched.sort(key=itemgetter(1))
+        return [entry[2] for entry in matched]
+
+
 class VMatch(object):
     """单账户的模拟撮合数据等"""
-    # 交易所报单编号
-    order_sysid = 0
-
-    def __init__(self, is_future=True):
+    def __init__(self, is_future=True, accountID='', sysids=None, trade_ids=None):
         """是否需要每个该类实例只对应一个市场
+        sysids/trade_ids: 报单编号、成交编号分配器 IDAllocator，可与其他账户共用，默认各自从进程内共用的来源分配
         """
-        self.vmatch_engine = VMatchEngine()
+        self.sysids = sysids if sysids is not None else IDAllocator()
+        self.vmatch_engine = VMatchEngine(trade_ids)
+        self.accountID = accountID
         self.trading_day = ''
-        self.order_dicts = {}   # {symbol1:[order_list]}
+        self.order_dicts = {}   # {symbol1: RestingOrders}
+        self.order_index = {}   # 挂单索引 {orderSysID: order}
+        self.symbol_order_n = {}    # 各合约的有效挂单数量 {symbol: n}
 
         self.is_future = is_future
         if is_future:
             self.check_position_closeable = self.check_future_position_closeable
+            self.release_position_frozen = self.release_future_position_frozen
         else:
             self.check_position_closeable = self.check_equity_position_closeable
+            self.release_position_frozen = self.release_equity_position_frozen
 
         # callbacks
         self.rtn_order_func = None
         self.rtn_trade_func = None
+        self.rtn_symbol_func = None     # 合约有/无挂单的变化通知
         self.rtn_userdata = None
+        self.rtn_raw = False
+        self.rtn_batch = None   # 回报列表，设置时各回报记录（OrderRecord/TradeRecord）按顺序追加到其中
 
         self.new_orders = []    # 新订单
         self.open_orders = []   # 挂单
@@ -333,175 +1124,382 @@ class VMatch(object):
         self.pos_dicts = {}     # 持仓记录 {symbol:SimPosition}
         self.max_order_ref = 0  # 客户端最大报单编号
         self.frontID = 1
-        self.sessionID = int(datetime.now().strftime("%Y%m%d%H%M%S")) % 1000000000000
+        self.sessionID = self.sysids.source.session_id
 
         # 交易流水
-        self.all_trades = []
-        self.all_datas = []
-
-    @classmethod
-    def reset_sysid(cls):
-        """重置系统报单编号"""
-        cls.order_sysid = int(datetime.now().strftime("%Y%m%d%H%M%S")) * 100000
+        self.journal = VMatchJournal()
+        # 预写日志，状态变化在回报前写入，用于崩溃恢复
+        self.wal = None
 
-    @classmethod
-    def next_sysid(cls):
+    def next_sysid(self):
         """系统报单编号"""
-        cls.order_sysid += 1
-        return cls.order_sysid
+        return self.sysids.next_id()
 
     def set_trading_day(self, trading_day):
         """设置交易日"""
         if self.trading_day != trading_day:
+            if self.rtn_symbol_func:
+                for btSymbol, n in self.symbol_order_n.items():
+                    if n > 0:
+                        self.rtn_symbol_func(self.rtn_userdata, self, btSymbol, False)
             self.order_dicts.clear()
+            self.order_index.clear()
+            self.symbol_order_n.clear()
             self.new_orders.clear()
             self.open_orders.clear()
-            self.reset_sysid()
         self.trading_day = trading_day
+        self.journal.set_trading_day(trading_day)
 
-    def set_rtn_func(self, rtn_order_func, rtn_trade_func, rtn_userdata):
-        """设置回调函数"""
+    def set_journal(self, journal):
+        """设置交易流水，可指定写盘目录"""
+        journal.set_trading_day(self.trading_day)
+        self.journal = journal
+
+    def set_wal(self, wal):
+        """设置预写日志 VMatchWAL，为 None 时不记录"""
+        self.wal = wal
+
+    @property
+    def all_trades(self):
+        """全部成交记录（兼容旧接口，会读取全部流水，大量数据时请用 journal.iter_trades）"""
+        return list(self.journal.iter_trades())
+
+    @property
+    def all_datas(self):
+        """全部订单快照及成交记录（兼容旧接口，会读取全部流水，大量数据时请用 journal.iter_records）"""
+        return list(self.journal.iter_records())
+
+    def set_rtn_func(self, rtn_order_func, rtn_trade_func, rtn_userdata, raw=False):
+        """设置回调函数
+        raw: 为 True 时回调收到内部记录 OrderRecord/TradeRecord，否则收到 BtOrderData/BtTradeData
+        """
         self.rtn_order_func = rtn_order_func
         self.rtn_trade_func = rtn_trade_func
         self.rtn_userdata = rtn_userdata
+        self.rtn_raw = raw
+
+    def set_rtn_batch(self, rtn_batch):
+        """设置回报列表，回报记录同时追加到其中，由使用者批量取走；为 None 时不追加"""
+        self.rtn_batch = rtn_batch
+
+    def set_symbol_func(self, rtn_symbol_func):
+        """设置合约挂单变化的回调函数 rtn_symbol_func(userdata, vmatch, btSymbol, has_orders)"""
+        self.rtn_symbol_func = rtn_symbol_func
+
+    def _add_working_order(self, order):
+        """订单进入挂单队列"""
+        btSymbol = order.btSymbol
+        self.order_index[order.orderSysID] = order
+        n = self.symbol_order_n.get(btSymbol, 0)
+        self.symbol_order_n[btSymbol] = n + 1
+        if n == 0 and self.rtn_symbol_func:
+            self.rtn_symbol_func(self.rtn_userdata, self, btSymbol, True)
+
+    def _remove_working_order(self, order):
+        """订单离开挂单队列（成交/撤单）"""
+        if self.order_index.pop(order.orderSysID, None) is None:
+            return False
+        btSymbol = order.btSymbol
+        n = self.symbol_order_n[btSymbol] - 1
+        self.symbol_order_n[btSymbol] = n
+        if n == 0 and self.rtn_symbol_func:
+            self.rtn_symbol_func(self.rtn_userdata, self, btSymbol, False)
+        return True
 
     def req_input_order(self, order_req):
         """有新订单请求
         TODO: 是否可支持同步模式，直接返回一确认信息
         """
-        order = self.gen_order_data(order_req)
+        order = SimOrder(order_req)
+        if self.wal:
+            self.wal.append(WAL_REQ_ORDER, snapshot_order(order))
         self.new_orders.append(order)
 
     def req_cancel_order(self, cancel_req):
         """撤单请求"""
         # 根据委托号从挂单中撤销掉
-        pass
-
-    def on_new_tick(self, tick):
-        """有新1档tick行情到达"""
-        # tick = BtTickData()
-
-        self._process_new_orders()
+        order = self.order_index.get(cancel_req.orderSysID)
+        if not order:
+            # TODO: 撤单失败(不存在/已成交)
+            return False
+        self._cancel_working_order(order)
 
-        try:
-            orders = self.order_dicts[tick.btSymbol]
-        except KeyError:
-            return
+        record = snapshot_order(order)
+        if self.wal:
+            self.wal.append(WAL_CANCEL, record)
+        self.journal.append_order(record)
+        if self.rtn_order_func:
+            self.rtn_order_func(self.rtn_userdata, record if self.rtn_raw else to_order_data(record))
+        if self.rtn_batch is not None:
+            self.rtn_batch.append(record)
+        return True
 
-        # 没有挂单
-        if len(orders) == 0:
-            return
+    def _cancel_working_order(self, order):
+        """撤销挂单（立即移出挂单队列，O(log n)），解冻持仓"""
+        if self._remove_working_order(order):
+            self.order_dicts[order.btSymbol].remove(order)
 
-        trade_infos = []
-        for order in orders:
-            self.vmatch_engine.match_by_tick1(order, tick, trade_infos)
+        if order.tradedVolume > 0:
+            order.status = STATUS_PARTCANCELLED
+            order.statusMsg = "部分撤单"
+        else:
+            order.status = STATUS_CANCELLED
+            order.statusMsg = "全部撤单"
 
-        for trade_info in trade_infos:
-            # 从挂单队列中移除
-            try:
-                orders.remove(trade_info.order)
-            except ValueError:
-                pass
+        simpos = self.pos_dicts.get(order.btSymbol)
+        if simpos:
+            self.release_position_frozen(order, simpos)
 
-            self.all_datas.append(trade_info.traded_order)
-            if trade_info.trade_volume:
-                trade = self.gen_trade_data(trade_info)
-                self.all_trades.append(trade)
-                self.all_datas.append(trade)
-            else:
-                trade = None
+    def _get_working_orders(self, btSymbol):
+        """获取合约的挂单队列，没有挂单时返回 None"""
+        orders = self.order_dicts.get(btSymbol)
+        return orders if orders else None
 
-            # 委托通知
-            if self.rtn_order_func:
-                self.rtn_order_func(self.rtn_userdata, trade_info.traded_order)
+    def _get_resting_orders(self, btSymbol):
+        """合约的挂单队列，没有时创建"""
+        try:
+            return self.order_dicts[btSymbol]
+        except KeyError:
+            orders = self.order_dicts[btSymbol] = RestingOrders()
+            return orders
 
-            # 成交通知
-            if self.rtn_trade_func and trade:
-                self.rtn_trade_func(self.rtn_userdata, trade)
+    def on_new_tick(self, tick):
+        """有新tick行情到达，按撮合引擎设置的盘口档数撮合"""
+        # tick = BtTickData()
+        engine = self.vmatch_engine
+        self._match_orders(tick.btSymbol, tick.askPrice1, tick.bidPrice1, engine.match_by_tick, tick,
+                           engine.last_mds)
 
     def on_new_bar(self, bar):
         """有新bar行情到达"""
         # bar = BtBarData()
+        self._match_orders(bar.btSymbol, bar.close, bar.close, self.vmatch_engine.match_by_bar, bar)
 
+    def _match_orders(self, btSymbol, ask_price, bid_price, match_func, md, last_mds=None):
+        """tick/bar 共用的撮合流程：处理新订单，撮合价格可成交的挂单，再处理撮合结果
+        last_mds: 需记录本笔行情时传入（tick撮合按成交量增量计算，没有可成交的挂单时也要记录）
+        """
         self._process_new_orders()
 
-        try:
-            orders = self.order_dicts[bar.btSymbol]
-        except KeyError:
-            return
-
         # 没有挂单
-        if len(orders) == 0:
+        orders = self._get_working_orders(btSymbol)
+        if not orders:
             return
 
         trade_infos = []
-        for order in orders:
-            self.vmatch_engine.match_by_bar(order, bar, trade_infos)
+        for order in orders.crossable(ask_price, bid_price):
+            match_func(order, md, trade_infos)
+        if last_mds is not None:
+            last_mds[btSymbol] = md
 
-        for trade_info in trade_infos:
-            # 从挂单队列中移除
-            try:
-                orders.remove(trade_info.order)
-            except ValueError:
-                pass
+        self._process_trade_infos(orders, trade_infos)
 
-            self.all_datas.append(trade_info.traded_order)
+    def _process_trade_infos(self, orders, trade_infos):
+        """处理撮合结果：
+        1. 结束的订单（全部成交/撤销）先统一标记离开挂单，再一次性从挂单队列中移除，部分成交的订单继续挂单
+        2. 按撮合顺序记录流水，发出委托和成交通知
+        """
+        if not trade_infos:
+            return
+        finished = []
+        for trade_info in trade_infos:
+            order = trade_info.order
+            # 同一订单可能有多条成交信息，只移除一次
+            if order.status != STATUS_PARTTRADED and self._remove_working_order(order):
+                finished.append(order)
+        if finished and orders is not None:
+            orders.discard(finished)
+
+        rtn_order_func = self.rtn_order_func
+        rtn_trade_func = self.rtn_trade_func
+        raw = self.rtn_raw
+        rtn_batch = self.rtn_batch
+        journal = self.journal
+        wal = self.wal
+        for trade_info in trade_infos:
+            traded_order = trade_info.traded_order
+            journal.append_order(traded_order)
             if trade_info.trade_volume:
-                trade = self.gen_trade_data(trade_info)
-                self.all_trades.append(trade)
-                self.all_datas.append(trade)
+                trade = self.gen_trade_record(trade_info)
+                journal.append_trade(trade)
             else:
                 trade = None
+            if wal:
+                wal.append(WAL_MATCH, traded_order, trade)
 
             # 委托通知
-            if self.rtn_order_func:
-                self.rtn_order_func(self.rtn_userdata, trade_info.traded_order)
+            if rtn_order_func:
+                rtn_order_func(self.rtn_userdata, traded_order if raw else to_order_data(traded_order))
 
             # 成交通知
-            if self.rtn_trade_func and trade:
-                self.rtn_trade_func(self.rtn_userdata, trade)
+            if rtn_trade_func and trade:
+                rtn_trade_func(self.rtn_userdata, trade if raw else to_trade_data(trade))
+
+            if rtn_batch is not None:
+                rtn_batch.append(traded_order)
+                if trade:
+                    rtn_batch.append(trade)
+
+    def req_input_orders(self, order_reqs):
+        """一批新订单请求，与之前未处理的订单一起立即处理（检查可平仓位、冻结、委托确认）"""
+        orders = [SimOrder(order_req) for order_req in order_reqs]
+        if self.wal:
+            for order in orders:
+                self.wal.append(WAL_REQ_ORDER, snapshot_order(order))
+        self.new_orders.extend(orders)
+        self._process_new_orders()
 
     def _process_new_orders(self):
-        """处理新的订单请求"""
-        for order in self.new_orders:
-            btSymbol = order.btSymbol
+        """处理新的订单请求，回报回调中产生的新订单随后一起处理"""
+        while self.new_orders:
+            orders = self.new_orders
+            self.new_orders = []
+            self._accept_orders(orders)
+
+    def _accept_orders(self, orders):
+        """处理一批新订单：按合约分组检查可平仓位并冻结，再按请求顺序分配报单编号、进入挂单队列并发出委托确认"""
+        symbol_orders = {}
+        for order in orders:
+            try:
+                symbol_orders[order.btSymbol].append(order)
+            except KeyError:
+                symbol_orders[order.btSymbol] = [order]
+        for btSymbol, group in symbol_orders.items():
+            try:
+                simpos = self.pos_dicts[btSymbol]
+            except KeyError:
+                simpos = SimPosition(group[0].multiplier, self.is_future)
+                self.pos_dicts[btSymbol] = simpos
+            self._freeze_orders(group, simpos)
 
+        has_rtn = self.wal or self.rtn_order_func or self.rtn_batch is not None
+        for order in orders:
             # order.orderTime = self.currentTime
             # order.insertDate = self.currentDate
             # order.orderDateTime = ' '.join([order.insertDate, order.orderTime])
             order.frontID = self.frontID
             order.sessionID = self.sessionID
 
-            try:
-                simpos = self.pos_dicts[btSymbol]
-            except KeyError:
-                simpos = SimPosition(order.multiplier, self.is_future)
-                self.pos_dicts[btSymbol] = simpos
+            # 生成系统报单编号，放入挂单队列中
+            if order.status != STATUS_REJECTED:
+                order.orderSysID = str(self.next_sysid())
+                self._get_resting_orders(order.btSymbol).append(order)
+                self._add_working_order(order)
 
-            if not self.check_position_closeable(order, simpos, do_freeze=True):
-                order.status = STATUS_REJECTED
-                order.statusMsg = "可平仓位不足"
+            # 委托确认通知
+            if has_rtn:
+                record = snapshot_order(order)
+                if self.wal:
+                    self.wal.append(WAL_ACCEPT, record)
+                if self.rtn_order_func:
+                    self.rtn_order_func(self.rtn_userdata, record if self.rtn_raw else to_order_data(record))
+                if self.rtn_batch is not None:
+                    self.rtn_batch.append(record)
+
+    def _freeze_orders(self, orders, simpos):
+        """同一合约的一批新订单按顺序检查可平仓位（同 check_position_closeable），冻结量累计后一次写回持仓"""
+        is_future = self.is_future
+        long_avail, short_avail = simpos.long_avail, simpos.short_avail
+        long_frozen = short_frozen = 0
+        for order in orders:
+            volume = order.totalVolume
+            if is_future and order.offset == OFFSET_OPEN:
+                accepted = True
+            elif is_future and order.direction == DIRECTION_LONG:
+                # 平空仓
+                accepted = volume <= short_avail
+                if accepted:
+                    short_avail -= volume
+                    short_frozen += volume
             else:
+                # 平多仓，股票均按多仓检查
+                accepted = volume <= long_avail
+                if accepted:
+                    long_avail -= volume
+                    long_frozen += volume
+
+            if accepted:
                 order.status = STATUS_NOTTRADED
                 order.statusMsg = "未成交"
+            else:
+                order.status = STATUS_REJECTED
+                order.statusMsg = "可平仓位不足"
 
-                # 生成系统报单编号
-                order.orderSysID = str(self.next_sysid())
-
-            # 放入挂单队列中
+        if long_frozen:
+            simpos.update_long_frozen(long_frozen)
+        if short_frozen:
+            simpos.update_short_frozen(short_frozen)
+
+    def get_state(self):
+        """账户状态（挂单、未处理的订单、持仓等），可序列化，用于快照"""
+        order_index = self.order_index
+        working_orders = [snapshot_order(order) for orders in self.order_dicts.values() for order in orders
+                          if order_index.get(order.orderSysID) is order]
+        return {
+            'accountID': self.accountID,
+            'is_future': self.is_future,
+            'trading_day': self.trading_day,
+            'working_orders': working_orders,
+            'new_orders': [snapshot_order(order) for order in self.new_orders],
+            'pos_dicts': self.pos_dicts,
+            'max_order_ref': self.max_order_ref,
+            'frontID': self.frontID,
+            'sessionID': self.sessionID,
+        }
+
+    def set_state(self, state):
+        """从快照恢复账户状态，不发出回报"""
+        self.trading_day = state['trading_day']
+        self.journal.set_trading_day(self.trading_day)
+        self.pos_dicts = state['pos_dicts']
+        self.max_order_ref = state['max_order_ref']
+        self.frontID = state['frontID']
+        self.sessionID = state['sessionID']
+        self.new_orders = [SimOrder.from_record(record) for record in state['new_orders']]
+        for record in state['working_orders']:
+            order = SimOrder.from_record(record)
+            self._get_resting_orders(order.btSymbol).append(order)
+            self._add_working_order(order)
+
+    def replay(self, entry):
+        """重放一条预写日志记录（交易日切换除外），不记录流水、不发出回报"""
+        kind, record = entry[0], entry[1]
+        if kind == WAL_REQ_ORDER:
+            self.new_orders.append(SimOrder.from_record(record))
+
+        elif kind == WAL_ACCEPT:
+            # 新订单按请求顺序处理
+            order = self.new_orders.pop(0)
+            try:
+                simpos = self.pos_dicts[order.btSymbol]
+            except KeyError:
+                simpos = SimPosition(order.multiplier, self.is_future)
+                self.pos_dicts[order.btSymbol] = simpos
+            if record.status != STATUS_REJECTED:
+                self.check_position_closeable(order, simpos, do_freeze=True)
+            for name, value in zip(ORDER_FIELDS, record):
+                setattr(order, name, value)
             if order.status != STATUS_REJECTED:
-                try:
-                    working_orders = self.order_dicts[btSymbol]
-                    working_orders.append(order)
-                except KeyError:
-                    working_orders = [order]
-                    self.order_dicts[btSymbol] = working_orders
-
-            # 委托确认通知
-            if self.rtn_order_func:
-                self.rtn_order_func(self.rtn_userdata, order)
-
-        self.new_orders.clear()
+                self._get_resting_orders(order.btSymbol).append(order)
+                self._add_working_order(order)
+
+        elif kind == WAL_CANCEL:
+            order = self.order_index.get(record.orderSysID)
+            if order:
+                self._cancel_working_order(order)
+
+        elif kind == WAL_MATCH:
+            # 同 _process_trade_infos：结束的订单离开挂单队列，部分成交的继续挂单
+            order = self.order_index.get(record.orderSysID)
+            if order:
+                order.tradedVolume = record.tradedVolume
+                order.status = record.status
+                order.statusMsg = record.statusMsg
+                if order.status != STATUS_PARTTRADED:
+                    orders = self.order_dicts.get(order.btSymbol)
+                    if orders and order in orders:
+                        orders.remove(order)
+                    self._remove_working_order(order)
 
     @staticmethod
     def gen_order_data(order_req):
@@ -533,6 +1531,20 @@ class VMatch(object):
         # order.orderKey = (int(order.orderID), order.frontID, order.sessionID)
         return order
 
+    @staticmethod
+    def gen_trade_record(trade_info):
+        """创建成交记录 TradeRecord，字段同 gen_trade_data"""
+        order = trade_info.order
+        exchange = order.exchange
+        trade_id = trade_info.trade_id
+        trade_date = trade_info.trade_date
+        trade_time = trade_info.trade_time
+        return tuple.__new__(TradeRecord, (
+            order.accountID, order.brokerID, order.symbol, exchange, order.btSymbol, order.orderSysID,
+            order.btOrderSysID, trade_id, '.'.join([exchange, trade_id]), order.orderID, order.btOrderID,
+            order.direction, order.offset, trade_info.trade_price, trade_info.trade_volume,
+            trade_date, trade_time, order.tradingDay, ' '.join([trade_date, trade_time]), order.userID))
+
     @staticmethod
     def gen_trade_data(trade_info):
         """ 创建一个成交数据对象
@@ -598,89 +1610,764 @@ class VMatch(object):
             simpos.update_long_frozen(residual_volume)
         return True
 
+    @staticmethod
+    def release_future_position_frozen(order, simpos):
+        """撤单时解冻期货平仓冻结"""
+        if order.offset != OFFSET_OPEN:
+            residual_volume = order.totalVolume - order.tradedVolume
+            if order.direction == DIRECTION_LONG:
+                simpos.update_short_frozen(-residual_volume)
+            else:
+                simpos.update_long_frozen(-residual_volume)
+
+    @staticmethod
+    def release_equity_position_frozen(order, simpos):
+        """撤单时解冻股票冻结"""
+        simpos.update_long_frozen(-(order.totalVolume - order.tradedVolume))
+
+class LatencyStats(object):
+    """延迟统计，每个阶段保留最近 max_samples 个样本（秒）
+    工作线程记录样本时，其他线程可同时调用 summary：样本在锁内复制，排序等计算在锁外
+    """
+    def __init__(self, max_samples=100000):
+        self.max_samples = max_samples
+        self.samples = {}   # {stage: deque}
+        self.lock = Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = deque(maxlen=self.max_samples)
+                self.samples[stage] = samples
+            samples.append(seconds)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """各阶段的样本数及延迟（微秒）{stage: {'count', 'mean', 'max', 'p50', ...}}"""
+        with self.lock:
+            snapshot = [(stage, tuple(samples)) for stage, samples in self.samples.items()]
+
+        result = {}
+        for stage, samples in snapshot:
+            if not samples:
+                continue
+            values = sorted(samples)
+            n = len(values)
+            item = {'count': n, 'mean': sum(values) / n * 1e6, 'max': values[-1] * 1e6}
+            for p in percentiles:
+                item['p%d' % p] = values[min(n - 1, int(n * p / 100.0))] * 1e6
+            result[stage] = item
+        return result
+
+
+class EventWorker(object):
+    """事件工作线程
+    1. 事件放入有界队列，队列满时按 block/timeout 等待，超时则拒绝（背压）
+    2. 每次唤醒后批量取出队列中已有的事件（最多 max_batch 个）依次处理
+    3. 延迟统计：queue 为入队到开始处理，match 为处理耗时，
+       callback 为入队到发出回报（由使用者根据 enqueue_time 记录）
+    4. stop 时处理完已入队的事件后再返回
+    5. 设置 batch_handler 时，每批事件处理完后调用一次（如批量发出回报）
+    """
+    def __init__(self, handler, max_queue=100000, max_batch=1024, block=True, timeout=None, name=None,
+                 batch_handler=None):
+        self.handler = handler      # handler(ev_type, data)
+        self.batch_handler = batch_handler  # batch_handler()
+        self.max_batch = max(1, max_batch)
+        self.block = block
+        self.timeout = timeout
+        self.name = name
+
+        self.stats = LatencyStats()
+        self.enqueue_time = None    # 正在处理的事件的入队时间
+        self.event_n = 0            # 已处理的事件数
+        self.batch_n = 0            # 唤醒次数
+        self.reject_n = 0           # 队列满被拒绝的事件数
+
+        self.__active = False
+        self.__que = Queue(maxsize=max_queue)
+        self.__thrd = None
+
+    @property
+    def active(self):
+        return self.__active
+
+    def qsize(self):
+        return self.__que.qsize()
+
+    def should_queue(self):
+        """是否应放入队列：已启动，且不在工作线程中（回调中产生的请求直接处理）"""
+        return self.__active and current_thread() is not self.__thrd
+
+    def start(self):
+        """启动工作线程"""
+        if self.__active:
+            return
+        self.__active = True
+        self.__thrd = Thread(target=self.work_run, name=self.name)
+        self.__thrd.daemon = True
+        self.__thrd.start()
+
+    def stop(self):
+        """处理完已入队的事件后停止工作线程"""
+        if not self.__active:
+            return
+        self.__que.put(None)
+        self.__thrd.join()
+        self.__active = False
+        self.__thrd = None
+
+        # 停止过程中入队的事件
+        while True:
+            try:
+                item = self.__que.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self._handle(item)
+        self._handle_batch_end()
+
+    def put(self, ev_type, data, block=None, timeout=None):
+        """事件入队，队列满且等待超时则返回 False"""
+        if block is None:
+            block = self.block
+            timeout = self.timeout
+        try:
+            self.__que.put((ev_type, data, perf_counter()), block, timeout)
+        except Full:
+            self.reject_n += 1
+            return False
+        return True
+
+    def record_callback(self):
+        """在工作线程发出回报时调用，记录入队到回报的延迟"""
+        enqueue_time = self.enqueue_time
+        if enqueue_time is not None:
+            self.stats.add('callback', perf_counter() - enqueue_time)
+
+    def _handle(self, item):
+        ev_type, data, enqueue_time = item
+        start_time = perf_counter()
+        self.enqueue_time = enqueue_time
+        try:
+            self.handler(ev_type, data)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.enqueue_time = None
+        self.stats.add('queue', start_time - enqueue_time)
+        self.stats.add('match', perf_counter() - start_time)
+        self.event_n += 1
+
+    def _handle_batch_end(self):
+        if self.batch_handler:
+            try:
+                self.batch_handler()
+            except Exception:
+                traceback.print_exc()
+
+    def work_run(self):
+        """工作线程：阻塞等待第一个事件，再一次取出队列中已有的事件批量处理"""
+        que = self.__que
+        max_batch = self.max_batch
+        while True:
+            batch = [que.get()]
+            try:
+                while len(batch) < max_batch:
+                    batch.append(que.get_nowait())
+            except Empty:
+                pass
+
+            self.batch_n += 1
+            stopping = False
+            for item in batch:
+                if item is None:
+                    stopping = True
+                else:
+                    self._handle(item)
+            self._handle_batch_end()
+            if stopping:
+                return
+
+
 class VMatchManager(object):
     """
     模拟撮合管理，负责行情的接入与各个账户的管理
     1. 可以本地读tick行情，依次触发
     2. 可以接实时tick行情，被动触发
+    3. start 后订单、撤单及行情经工作线程的队列依次处理，回报在工作线程中发出；
+       未启动时在调用线程中同步处理
+    4. 共享流动性模式下，一笔tick的可成交量由所有账户的挂单共同分配，每笔tick只计算一次
+    5. 开启持久化后，状态变化写预写日志并定期快照，重启时恢复各账户的挂单和持仓
+    6. 可设置批量回报回调：同步模式下每次行情/撤单产生的全部回报，异步模式下工作线程每批事件产生的全部回报，
+       按产生顺序放在一个列表中回调一次；逐笔回报的接口不变，两者可同时使用
     """
-    def __init__(self):
+    def __init__(self, max_queue=100000, max_batch=1024, block=True, timeout=None, id_source=None):
+        """id_source: 编号来源 IDSource，回测时指定 seed 可使报单、成交编号可复现"""
         # 管理多个账户的撮合
         self.vmatch_dicts = {}
         self.trading_day = ''
 
+        self.tick_depth = 1             # tick撮合的盘口档数
+        self.shared_liquidity = False   # 是否跨账户共享tick的可成交量
+        self.allocation = ALLOC_PRIORITY
+        self.last_mds = {}              # 各合约的上一笔tick，共享模式下计算成交量增量
+
+        self.journal_root = None        # 交易流水写盘目录，各账户一个子目录
+        self.journal_max_records = 100000
+
+        self.wal = None                 # 预写日志
+        self.snapshot_interval = 100000 # 日志记录数达到该值时做快照
+
+        # 各账户共用报单、成交编号分配器，编号只取决于事件顺序
+        self.id_source = id_source if id_source is not None else IDSource()
+        self.sysids = IDAllocator(self.id_source)
+        self.trade_ids = IDAllocator(self.id_source)
+
+        # 合约订阅索引，行情只分发给该合约有挂单的账户 {btSymbol: {accountID: vmatch}}
+        self.symbol_subs = {}
+        # 有新订单待处理的账户 {accountID: vmatch}
+        self.pending_vmatchs = {}
+
         self.order_userdata = None
         self.order_callback = None
         self.trade_userdata = None
         self.trade_callback = None
+        self.batch_userdata = None
+        self.batch_callback = None
+        self.batch_raw = True
+        self.__returns = []     # 待批量发出的回报记录，各账户共用
 
-        self.__active = False
-        self.__que = Queue()
-        self.__thrd = Thread(target=self.work_run)
+        # 工作线程，队列满时按 block/timeout 等待，超时则拒绝
+        self.__worker = EventWorker(self._process_event, max_queue, max_batch, block, timeout, name='VMatchManager',
+                                    batch_handler=self._flush_returns)
+
+    def start(self):
+        """启动工作线程"""
+        self.__worker.start()
+
+    def stop(self):
+        """处理完已入队的事件后停止工作线程，开启持久化时做一次快照"""
+        self.__worker.stop()
+        if self.wal and self.wal.record_n:
+            self.snapshot()
+
+    def get_latency_stats(self):
+        """延迟统计（微秒）"""
+        return self.__worker.stats.summary()
 
     def set_trading_day(self, trading_day):
         """设置交易日"""
+        if self.wal:
+            self.wal.append(WAL_TRADING_DAY, trading_day)
         self.trading_day = trading_day
         for vmatch in self.vmatch_dicts.values():
             vmatch.set_trading_day(trading_day)
 
+    def set_persistence(self, root, snapshot_interval=100000, fsync=False):
+        """开启持久化：订单请求、撤单、撮合结果写入 root 下的预写日志，每 snapshot_interval 条做一次快照
+        root 下已有数据时先恢复（加载快照并重放其后的日志），返回重放的日志记录数
+        应在 start 及交易开始前调用；fsync 为 True 时每条日志同步到磁盘
+        """
+        self.set_wal(None)
+        wal = VMatchWAL(root, fsync)
+        snapshot = wal.load_snapshot()
+        if snapshot:
+            self._set_state(snapshot)
+
+        max_id = 0
+        replay_n = 0
+        for entry in wal.iter_tail():
+            kind = entry[0]
+            if kind == WAL_TRADING_DAY:
+                self.set_trading_day(entry[1])
+            else:
+                record = entry[1]
+                self._get_vmatch(record.accountID).replay(entry)
+                if record.orderSysID:
+                    max_id = max(max_id, int(record.orderSysID))
+                if kind == WAL_MATCH and entry[2]:
+                    max_id = max(max_id, int(entry[2].tradeID))
+            replay_n += 1
+        # 编号不与恢复前的重复
+        self._advance_ids(max_id)
+        for accountID, vmatch in self.vmatch_dicts.items():
+            if vmatch.new_orders:
+                self.pending_vmatchs[accountID] = vmatch
+
+        wal.open()
+        self.snapshot_interval = snapshot_interval
+        self.set_wal(wal)
+        if replay_n:
+            # 恢复后立即快照，下次重启无需再重放
+            self.snapshot()
+        return replay_n
+
+    def set_wal(self, wal):
+        """设置预写日志，为 None 时关闭"""
+        if self.wal and self.wal is not wal:
+            self.wal.close()
+        self.wal = wal
+        for vmatch in self.vmatch_dicts.values():
+            vmatch.set_wal(wal)
+
+    def get_state(self):
+        """各账户状态及编号，可序列化"""
+        return {
+            'trading_day': self.trading_day,
+            'max_id': self.id_source.high_water(),
+            'accounts': [vmatch.get_state() for vmatch in self.vmatch_dicts.values()],
+        }
+
+    def _set_state(self, state):
+        self.trading_day = state['trading_day']
+        self._advance_ids(state['max_id'])
+        for account_state in state['accounts']:
+            self._get_vmatch(account_state['accountID'], account_state['is_future']).set_state(account_state)
+
+    def _advance_ids(self, max_id):
+        """之后的报单、成交编号都大于 max_id"""
+        self.id_source.advance_past(max_id)
+        self.sysids.new_block()
+        self.trade_ids.new_block()
+
+    def snapshot(self):
+        """做一次快照，之后重启只需重放快照后的日志；异步模式下返回是否入队成功"""
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_SNAPSHOT, None)
+        if self.wal:
+            self.wal.write_snapshot(self.get_state())
+        return True
+
+    def _check_snapshot(self):
+        # 在事件之间检查，快照中不会有处理了一半的状态
+        if self.wal.record_n >= self.snapshot_interval:
+            self.snapshot()
+
+    def set_tick_depth(self, depth):
+        """设置tick撮合的盘口档数"""
+        self.tick_depth = depth
+        for vmatch in self.vmatch_dicts.values():
+            vmatch.vmatch_engine.set_tick_depth(depth)
+
+    def set_journal_root(self, root, max_records=100000):
+        """设置交易流水的写盘目录，root 为 None 时只在内存中保留最近 max_records 条
+        已有账户换用新的流水，应在开始交易前设置
+        """
+        self.journal_root = root
+        self.journal_max_records = max_records
+        for accountID, vmatch in self.vmatch_dicts.items():
+            vmatch.set_journal(self._new_journal(accountID))
+
+    def _new_journal(self, accountID):
+        root = os.path.join(self.journal_root, str(accountID)) if self.journal_root else None
+        return VMatchJournal(root, self.journal_max_records)
+
+    def set_shared_liquidity(self, enabled, allocation=ALLOC_PRIORITY):
+        """设置是否跨账户共享tick的可成交量
+        allocation: ALLOC_PRIORITY 按价格、时间优先分配；ALLOC_PRO_RATA 按剩余委托量比例分配
+        """
+        if allocation not in (ALLOC_PRIORITY, ALLOC_PRO_RATA):
+            raise ValueError("unknown allocation {}".format(allocation))
+        self.shared_liquidity = enabled
+        self.allocation = allocation
+
     def set_order_callback(self, callback, userdata):
         self.order_callback = callback
         self.order_userdata = userdata
+        self._bind_rtn_funcs()
 
     def set_trade_callback(self, callback, userdata):
         self.trade_callback = callback
         self.trade_userdata = userdata
+        self._bind_rtn_funcs()
+
+    def set_batch_callback(self, callback, userdata, raw=True):
+        """设置批量回报回调 callback(userdata, returns)，returns 为按产生顺序排列的回报列表
+        raw: 为 True 时回报为内部记录 OrderRecord/TradeRecord（namedtuple，可按类型区分），否则为 BtOrderData/BtTradeData
+        """
+        self.batch_callback = callback
+        self.batch_userdata = userdata
+        self.batch_raw = raw
+        self._bind_rtn_funcs()
+
+    def _bind_rtn_funcs(self, vmatch=None):
+        """账户回报只接到已设置的回调上，未设置逐笔回调时不经过 on_rtn_order/on_rtn_trade"""
+        vmatchs = [vmatch] if vmatch is not None else self.vmatch_dicts.values()
+        rtn_order_func = self.on_rtn_order if self.order_callback else None
+        rtn_trade_func = self.on_rtn_trade if self.trade_callback else None
+        rtn_batch = self.__returns if self.batch_callback else None
+        for vmatch in vmatchs:
+            vmatch.set_rtn_func(rtn_order_func, rtn_trade_func, self, raw=True)
+            vmatch.set_rtn_batch(rtn_batch)
+
+    def _end_event(self):
+        """同步模式下一个事件处理完即批量发出回报，异步模式下由工作线程每批事件处理完后发出"""
+        if self.__returns and not self.__worker.active:
+            self._flush_returns()
+
+    def _flush_returns(self):
+        """批量发出已产生的回报，回调中产生的回报随后作为新的一批发出"""
+        while self.__returns:
+            returns = list(self.__returns)
+            self.__returns.clear()
+            if not self.batch_callback:
+                return
+            if not self.batch_raw:
+                returns = [to_order_data(record) if isinstance(record, OrderRecord) else to_trade_data(record)
+                           for record in returns]
+            self.batch_callback(self.batch_userdata, returns)
 
     def req_input_order(self, order_req):
-        """有新订单请求
+        """有新订单请求，异步模式下返回是否入队成功
         TODO: 是否可支持同步模式，直接返回一确认信息
         """
-        vmatch = self.vmatch_dicts.get(order_req.accountID)
-        if not vmatch:
-            vmatch = VMatch(is_future=True)
-            vmatch.set_rtn_func(self.on_rtn_order, self.on_rtn_trade, self)
-            self.vmatch_dicts[order_req.accountID] = vmatch
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_REQ_ORDER, order_req)
+
+        vmatch = self._get_vmatch(order_req.accountID)
         vmatch.req_input_order(order_req)
+        self.pending_vmatchs[order_req.accountID] = vmatch
+
+    def req_input_orders(self, order_reqs):
+        """一批新订单请求（如调仓时的大量订单），按账户分组后立即处理，委托确认在一次批量回报中发出；
+        异步模式下整批入队，返回是否入队成功
+        """
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_REQ_ORDERS, order_reqs)
+
+        # 之前的单笔订单先处理，报单编号按请求顺序分配
+        if self.pending_vmatchs:
+            self._process_new_orders()
+        account_reqs = {}
+        for order_req in order_reqs:
+            try:
+                account_reqs[order_req.accountID].append(order_req)
+            except KeyError:
+                account_reqs[order_req.accountID] = [order_req]
+        for accountID, reqs in account_reqs.items():
+            self._get_vmatch(accountID).req_input_orders(reqs)
+        self._end_event()
+
+    def _get_vmatch(self, accountID, is_future=True):
+        """账户的撮合，没有时创建"""
+        vmatch = self.vmatch_dicts.get(accountID)
+        if not vmatch:
+            vmatch = VMatch(is_future, accountID, self.sysids, self.trade_ids)
+            self._bind_rtn_funcs(vmatch)
+            vmatch.set_symbol_func(self.on_symbol_changed)
+            vmatch.set_trading_day(self.trading_day)
+            vmatch.vmatch_engine.set_tick_depth(self.tick_depth)
+            vmatch.set_journal(self._new_journal(accountID))
+            vmatch.set_wal(self.wal)
+            self.vmatch_dicts[accountID] = vmatch
+        return vmatch
 
     def req_cancel_order(self, cancel_req):
-        """撤单请求"""
+        """撤单请求，同步模式下返回是否撤单成功，异步模式下返回是否入队成功"""
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_REQ_CANCEL, cancel_req)
+
         # 根据委托号从挂单中撤销掉
-        vmatch = self.vmatch_dicts.get(order_req.accountID)
+        vmatch = self.vmatch_dicts.get(cancel_req.accountID)
         if not vmatch:
-            return
-        vmatch.req_cancel_order(cancel_req)
+            return False
+        rv = vmatch.req_cancel_order(cancel_req)
+        self._end_event()
+        return rv
 
     def on_new_tick(self, tick):
-        """新行情"""
-        for vmatch in self.vmatch_dicts.values():
-            vmatch.on_new_tick(tick)
+        """新行情，异步模式下返回是否入队成功"""
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_TICK, tick)
+
+        if self.wal:
+            self._check_snapshot()
+        if self.pending_vmatchs:
+            self._process_new_orders()
+
+        subs = self.symbol_subs.get(tick.btSymbol)
+        if self.shared_liquidity:
+            self._match_shared(tick, list(subs.values()) if subs else [])
+        else:
+            # 切换到共享模式时的成交量基准
+            self.last_mds[tick.btSymbol] = tick
+            if subs:
+                for vmatch in list(subs.values()):
+                    vmatch.on_new_tick(tick)
+        self._end_event()
+
+    def _match_shared(self, tick, vmatchs):
+        """共享流动性撮合：汇总所有账户的挂单，按分配方式一次性分配本笔tick的可成交量"""
+        btSymbol = tick.btSymbol
+        last_tick = self.last_mds.get(btSymbol)
+        self.last_mds[btSymbol] = tick
+        # 同逐账户撮合记录各账户的上一笔tick，切换回逐账户撮合时成交量增量正确
+        for vmatch in vmatchs:
+            vmatch.vmatch_engine.last_mds[btSymbol] = tick
+        if not vmatchs:
+            return
+
+        depth = self.tick_depth
+        if depth <= 1:
+            # 1档：买卖方向各自以本笔tick的成交量为上限
+            volume_delta = tick.volume - (last_tick.volume if last_tick else 0)
+            pool = TickDepth(tick, 1, [(tick.askPrice1, volume_delta)], [(tick.bidPrice1, volume_delta)])
+        else:
+            pool = TickDepth(tick, depth)
+
+        # 汇总各账户价格可成交的挂单
+        buys, sells = [], []
+        account_orders = []
+        for vmatch in vmatchs:
+            orders = vmatch._get_working_orders(btSymbol)
+            if not orders:
+                continue
+            crossable = orders.crossable(tick.askPrice1, tick.bidPrice1)
+            account_orders.append((vmatch, orders, crossable))
+            for order in crossable:
+                if order.direction == DIRECTION_LONG:
+                    buys.append(order)
+                else:
+                    sells.append(order)
+
+        fills = {}      # {id(order): [(trade_price, trade_volume)]}，None 表示撤单
+        self._allocate(pool, True, buys, fills)
+        self._allocate(pool, False, sells, fills)
+
+        cur_date, cur_time = tick.actionDay, tick.time[:8]
+        last_price = tick.lastPrice
+        for vmatch, orders, crossable in account_orders:
+            engine = vmatch.vmatch_engine
+            to_cancel_types = engine.PRICETYPE_TOBE_CANCELED
+            trade_infos = []
+            for order in crossable:
+                order_fills = fills.get(id(order))
+                if order_fills:
+                    for trade_price, trade_volume in order_fills:
+                        if depth <= 1:
+                            # 同 VMatchEngine.get_trade_vp_by_tick
+                            if order.direction == DIRECTION_LONG:
+                                trade_price = min(last_price, order.price)
+                            else:
+                                trade_price = max(last_price, order.price)
+                        engine.fill_order(order, trade_price, trade_volume, cur_date, cur_time, trade_infos)
+                elif order.priceType in to_cancel_types:
+                    engine.cancel_order(order, cur_date, cur_time, trade_infos)
+            if trade_infos:
+                vmatch._process_trade_infos(orders, trade_infos)
+
+    def _allocate(self, pool, is_buy, orders, fills):
+        """分配一个方向的可成交量"""
+        if not orders:
+            return
+        # 多档撮合时市价单可与所有档位成交，1档时同 VMatchEngine.match_order 按委托价判断
+        sweep_market = self.tick_depth > 1
+        sign = -1 if is_buy else 1
+
+        def priority(order):
+            if sweep_market and order.priceType == PRICETYPE_MARKETPRICE:
+                return (0, 0, int(order.orderSysID))
+            return (1, sign * order.price, int(order.orderSysID))
+        orders = sorted(orders, key=priority)
+
+        requests = []
+        for order in orders:
+            limit_price = None if sweep_market and order.priceType == PRICETYPE_MARKETPRICE else order.price
+            remaining = order.totalVolume - order.tradedVolume
+            if order.priceType == PRICETYPE_FOK:
+                # FOK单先按优先级全部成交或撤销
+                if pool.available(is_buy, limit_price) >= remaining:
+                    fills[id(order)] = pool.take(is_buy, limit_price, remaining)
+            elif self.allocation == ALLOC_PRIORITY:
+                fills[id(order)] = pool.take(is_buy, limit_price, remaining)
+            else:
+                requests.append((id(order), limit_price, remaining))
+        if requests:
+            fills.update(pool.take_pro_rata(is_buy, requests))
 
     def on_new_bar(self, bar):
-        """新行情"""
-        for vmatch in self.vmatch_dicts.values():
-            vmatch.on_new_bar(bar)
+        """新行情，异步模式下返回是否入队成功"""
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_BAR, bar)
+
+        if self.wal:
+            self._check_snapshot()
+        if self.pending_vmatchs:
+            self._process_new_orders()
+
+        subs = self.symbol_subs.get(bar.btSymbol)
+        if subs:
+            for vmatch in list(subs.values()):
+                vmatch.on_new_bar(bar)
+        self._end_event()
+
+    def _process_new_orders(self):
+        """处理各账户的新订单，订单进入挂单队列时更新合约订阅索引"""
+        pending_vmatchs = list(self.pending_vmatchs.values())
+        self.pending_vmatchs.clear()
+        for vmatch in pending_vmatchs:
+            vmatch._process_new_orders()
+
+    def on_symbol_changed(self, userdata, vmatch, btSymbol, has_orders):
+        """账户在某合约上有/无挂单"""
+        if has_orders:
+            try:
+                self.symbol_subs[btSymbol][vmatch.accountID] = vmatch
+            except KeyError:
+                self.symbol_subs[btSymbol] = {vmatch.accountID: vmatch}
+        else:
+            subs = self.symbol_subs.get(btSymbol)
+            if subs:
+                subs.pop(vmatch.accountID, None)
+                if not subs:
+                    del self.symbol_subs[btSymbol]
 
     def on_rtn_order(self, userdata, order):
-        """订单回报"""
+        """订单回报，账户回报的是 OrderRecord，有回调时才转为 BtOrderData"""
         if self.order_callback:
-            self.order_callback(self.order_userdata, order)
+            self.__worker.record_callback()
+            self.order_callback(self.order_userdata, to_order_data(order))
 
     def on_rtn_trade(self, userdata, trade):
-        """成交回报"""
+        """成交回报，账户回报的是 TradeRecord，有回调时才转为 BtTradeData"""
         if self.trade_callback:
-            self.trade_callback(self.trade_userdata, trade)
+            self.__worker.record_callback()
+            self.trade_callback(self.trade_userdata, to_trade_data(trade))
+
+    def _process_event(self, ev_type, data):
+        """工作线程处理事件"""
+        if ev_type == EV_TICK:
+            self.on_new_tick(data)
+        elif ev_type == EV_BAR:
+            self.on_new_bar(data)
+        elif ev_type == EV_REQ_ORDER:
+            self.req_input_order(data)
+        elif ev_type == EV_REQ_CANCEL:
+            self.req_cancel_order(data)
+        elif ev_type == EV_REQ_ORDERS:
+            self.req_input_orders(data)
+        elif ev_type == EV_SNAPSHOT:
+            self.snapshot()
+
+def _parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+# tick字段的类型，未列出的字段按字符串处理
+TICK_FIELD_TYPES = {
+    'lastPrice': float,
+    'volume': _parse_int,
+    'turnover': float,
+    'openInterest': float,
+    'openPrice': float,
+    'highPrice': float,
+    'lowPrice': float,
+    'preClosePrice': float,
+    'upperLimit': float,
+    'lowerLimit': float,
+}
+for _i in range(1, 11):
+    TICK_FIELD_TYPES['askPrice%d' % _i] = float
+    TICK_FIELD_TYPES['bidPrice%d' % _i] = float
+    TICK_FIELD_TYPES['askVolume%d' % _i] = _parse_int
+    TICK_FIELD_TYPES['bidVolume%d' % _i] = _parse_int
+
+
+def _iter_csv_rows(csv_file, chunk_size, encoding):
+    """按块读取csv，先返回表头，之后每次返回 chunk_size 行"""
+    with open(csv_file, 'r', newline='', encoding=encoding) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            return
+        yield header
 
-    def work_run(self):
-        """行情工作线程"""
-        while self.__active:
-            try:
-                event = self.__que.get(timeout=1)
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                break
+            yield rows
+
+
+def _iter_csv_rows_reopen(csv_file, chunk_size, encoding):
+    """同 _iter_csv_rows，但每块读取后关闭文件，下次从记录的位置重新打开
+    同时打开大量文件回放时不占用文件句柄；按行切分，不支持字段内换行
+    """
+    with open(csv_file, 'rb') as f:
+        line = f.readline()
+        offset = f.tell()
+    header = next(csv.reader([line.decode(encoding)]), None)
+    if not header:
+        return
+    yield header
+
+    while True:
+        with open(csv_file, 'rb') as f:
+            f.seek(offset)
+            lines = list(islice(f, chunk_size))
+            offset = f.tell()
+        if not lines:
+            break
+        # 只缓存原始行，逐行解析
+        yield csv.reader(line.decode(encoding) for line in lines)
+
+
+def iter_csv_ticks(csv_file, columns=None, fixed_fields=None, chunk_size=10000, encoding='utf-8', reopen=False):
+    """流式读取csv行情文件，按块解析并逐个返回 BtTickData
+    csv_file: 文件路径
+    columns: 字段映射 {tick属性名: csv列名}，默认csv表头即为tick属性名
+    fixed_fields: 所有tick都相同的字段，如按合约存储的文件 {'btSymbol': 'rb1905.SHF'}
+    chunk_size: 每次解析的行数，内存占用只与之相关
+    reopen: 每块读取后关闭文件，用于同时归并大量文件
+
+    注意：撮合引擎会保存每个合约的上一笔tick用于计算成交量增量，故每行都生成新的tick对象
+    """
+    chunks = (_iter_csv_rows_reopen if reopen else _iter_csv_rows)(csv_file, chunk_size, encoding)
+    header = next(chunks, None)
+    if not header:
+        return
+
+    if columns is None:
+        columns = {name: name for name in header}
+    col_index = {name: i for i, name in enumerate(header)}
+    fields = []
+    for attr, col_name in columns.items():
+        if col_name not in col_index:
+            raise KeyError("iter_csv_ticks column '{}' not found in {}".format(col_name, csv_file))
+        fields.append((attr, col_index[col_name], TICK_FIELD_TYPES.get(attr, str)))
+    fixed_fields = list(fixed_fields.items()) if fixed_fields else []
+
+    for rows in chunks:
+        # 逐行生成tick，不缓存整块tick对象
+        for row in rows:
+            tick = BtTickData()
+            for attr, idx, conv in fields:
+                value = row[idx]
+                if value != '':
+                    setattr(tick, attr, conv(value))
+            for attr, value in fixed_fields:
+                setattr(tick, attr, value)
+            yield tick
+
+
+# tick的时间排序键：交易日、自然日、时间，夜盘按自然日排在同一交易日的日盘之前
+TICK_TIME_KEY = attrgetter('date', 'actionDay', 'time')
+
+
+def merge_ticks(tick_sources, key=TICK_TIME_KEY):
+    """将多个各自按时间有序的行情源按时间k路归并（堆），逐个读取，不预先加载
+    时间相同的tick按行情源的先后顺序
+    """
+    return heapq.merge(*tick_sources, key=key)
 
-                # 处理事件
-                self.on_new_tick(event.data)
-            except Empty:
-                continue
 
 class QuoteEngine(object):
     """行情引擎 (一些接口为示例代码)
@@ -690,6 +2377,7 @@ class QuoteEngine(object):
     def __init__(self, vmatchmgr):
         self.vmatchmgr = vmatchmgr
         self.tick_list = []
+        self.tick_sources = []  # 流式行情源，依次回放
 
     def put_ticks(self, tick_list, clear_previous=False):
         """放入行情列表"""
@@ -697,13 +2385,44 @@ class QuoteEngine(object):
             self.tick_list.clear()
         self.tick_list.extend(tick_list)
 
-    def read_csv(self, csv_file):
-        """读取csv行情文件"""
-        pass
+    def put_tick_source(self, tick_source):
+        """放入流式行情源（可迭代的tick序列），回放时依次读取"""
+        self.tick_sources.append(tick_source)
+
+    def read_csv(self, csv_file, columns=None, fixed_fields=None, chunk_size=10000, encoding='utf-8'):
+        """读取csv行情文件，回放时按块流式读取，参数同 iter_csv_ticks"""
+        self.put_tick_source(iter_csv_ticks(csv_file, columns, fixed_fields, chunk_size, encoding))
+
+    def put_merge_sources(self, tick_sources, key=TICK_TIME_KEY):
+        """放入一组各自按时间有序的行情源（如每个合约一个文件），回放时按时间归并为一个有序序列"""
+        self.put_tick_source(merge_ticks(tick_sources, key))
+
+    def read_csv_files(self, csv_files, columns=None, fixed_fields=None, chunk_size=128, encoding='utf-8'):
+        """读取按合约、按交易日存储的多个csv行情文件，参数同 iter_csv_ticks
+        1. 各文件按第一笔tick的交易日分组，交易日依次回放，只同时读取当天的文件
+        2. 同一交易日的文件按时间归并，每个文件只缓存 chunk_size 行，读取后即关闭文件
+        fixed_fields: 所有文件相同的字段 dict，或按文件返回字段的函数 fixed_fields(csv_file)，
+                      文件中没有合约列时用于指定各文件的 btSymbol，如 lambda path: {'btSymbol': ...}
+        """
+        get_fixed = fixed_fields if callable(fixed_fields) else lambda csv_file: fixed_fields
+        day_files = {}
+        for csv_file in csv_files:
+            file_fields = get_fixed(csv_file)
+            first = next(iter_csv_ticks(csv_file, columns, file_fields, 1, encoding, reopen=True), None)
+            if first is not None:
+                day_files.setdefault(first.date, []).append((csv_file, file_fields))
+
+        for trading_day in sorted(day_files):
+            self.put_merge_sources([iter_csv_ticks(csv_file, columns, file_fields, chunk_size, encoding, reopen=True)
+                                    for csv_file, file_fields in day_files[trading_day]])
 
     def cast_quotes(self):
+        vmatchmgr = self.vmatchmgr
+        tick_sources = self.tick_sources
+        self.tick_sources = []
+
         last_tick_date = ''
-        for tick in self.tick_list:
+        for tick in chain(self.tick_list, *tick_sources):
             if last_tick_date != tick.date:
                 vmatchmgr.set_trading_day(tick.date)
                 last_tick_date = tick.date
@@ -711,6 +2430,122 @@ class QuoteEngine(object):
 
 
 
+class PriceLevel(object):
+    """价格档位，同一价格的挂单按时间先后排队"""
+    __slots__ = ('price', 'orders')
+
+    def __init__(self, price):
+        self.price = price
+        self.orders = OrderedDict()     # {orderSysID: order}，可O(1)移除任意挂单
+
+    def front(self):
+        """队首挂单"""
+        return next(iter(self.orders.values()))
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __repr__(self):
+        return "PriceLevel(price:{},orders:{})".format(self.price, len(self.orders))
+
+
+class OrderBookSide(object):
+    """买卖单边的挂单队列
+    价格索引为有序列表，买方按 price 升序，卖方按 -price 升序，最优价总在列表末尾，
+    新增价位 O(log L) 定位，取最优价 O(1)
+    """
+    def __init__(self, is_buy):
+        self.is_buy = is_buy
+        self.sign = 1 if is_buy else -1
+        self.levels = {}        # {sign * price: PriceLevel}
+        self.keys = []          # 有序价格索引
+        self.order_count = 0
+
+    def __len__(self):
+        return self.order_count
+
+    def __iter__(self):
+        """按价格优先、时间优先的顺序遍历挂单"""
+        for key in reversed(self.keys):
+            for order in self.levels[key].orders.values():
+                yield order
+
+    def best_level(self):
+        """最优价位"""
+        if not self.keys:
+            return None
+        return self.levels[self.keys[-1]]
+
+    def insert(self, order):
+        """插入挂单到对应价位的队尾，返回所在价位"""
+        key = order.price * self.sign
+        level = self.levels.get(key)
+        if level is None:
+            level = PriceLevel(order.price)
+            self.levels[key] = level
+            insort(self.keys, key)
+        level.orders[order.orderSysID] = order
+        self.order_count += 1
+        return level
+
+    def pop_front(self, level):
+        """移除某价位的队首挂单"""
+        _, order = level.orders.popitem(last=False)
+        self.order_count -= 1
+        if not level.orders:
+            self.remove_level(level)
+        return order
+
+    def remove(self, order, level=None):
+        """移除任意位置的挂单"""
+        if level is None:
+            level = self.levels.get(order.price * self.sign)
+            if level is None:
+                return False
+        if level.orders.pop(order.orderSysID, None) is None:
+            return False
+        self.order_count -= 1
+        if not level.orders:
+            self.remove_level(level)
+        return True
+
+    def remove_level(self, level):
+        """移除价位"""
+        key = level.price * self.sign
+        del self.levels[key]
+        if self.keys[-1] == key:
+            self.keys.pop()
+        else:
+            del self.keys[bisect_left(self.keys, key)]
+
+    def clear(self):
+        self.levels.clear()
+        self.keys.clear()
+        self.order_count = 0
+
+
+class OrderBook(object):
+    """单个合约的买卖挂单簿"""
+    def __init__(self, btSymbol):
+        self.btSymbol = btSymbol
+        self.bids = OrderBookSide(is_buy=True)
+        self.asks = OrderBookSide(is_buy=False)
+
+    def __repr__(self):
+        return "OrderBook({},bids:{},asks:{},best:{}/{})"\
+               .format(self.btSymbol, len(self.bids), len(self.asks), self.best_bid, self.best_ask)
+
+    @property
+    def best_bid(self):
+        level = self.bids.best_level()
+        return level.price if level else None
+
+    @property
+    def best_ask(self):
+        level = self.asks.best_level()
+        return level.price if level else None
+
+
 class VMatchExchange(object):
     """模拟交易所，
     保存买卖挂单队列，有订单则发出一笔行情，撮合则也产生一笔行情
@@ -718,9 +2553,9 @@ class VMatchExchange(object):
     order_sysid = 1
     trade_id = 1
 
-    def __init__(self):
-        self.buy_order_dicts = {}
-        self.sell_order_dicts = {}
+    def __init__(self, max_queue=100000, max_batch=1024, block=True, timeout=None):
+        self.order_books = {}   # {btSymbol: OrderBook}
+        self.order_index = {}   # 挂单索引 {orderSysID: (btSymbol, side, level, order)}
         self.traded_orders = {}
 
         self.trading_day = ''
@@ -733,9 +2568,20 @@ class VMatchExchange(object):
         self.rtn_trade_func = None
         self.rtn_userdata = None
 
-        self.__active = False
-        self.__que = Queue()
-        self.__thrd = Thread(target=self.work_run)
+        # 工作线程，队列满时按 block/timeout 等待，超时则拒绝
+        self.__worker = EventWorker(self._process_event, max_queue, max_batch, block, timeout, name='VMatchExchange')
+
+    def start(self):
+        """启动工作线程，之后订单与撤单经队列在工作线程中撮合"""
+        self.__worker.start()
+
+    def stop(self):
+        """处理完已入队的事件后停止工作线程"""
+        self.__worker.stop()
+
+    def get_latency_stats(self):
+        """延迟统计（微秒）"""
+        return self.__worker.stats.summary()
 
     @classmethod
     def next_sys_id(cls):
@@ -747,13 +2593,23 @@ class VMatchExchange(object):
         cls.trade_id += 1
         return cls.trade_id
 
+    def get_order_book(self, symbol):
+        """获取合约的挂单簿，不存在则创建"""
+        book = self.order_books.get(symbol)
+        if book is None:
+            book = OrderBook(symbol)
+            self.order_books[symbol] = book
+        return book
+
     def get_buy_order_list(self, symbol):
-        """获取挂单列表"""
-        return self.buy_order_dicts.get(symbol, list())
+        """获取挂单列表（价格优先，时间优先）"""
+        book = self.order_books.get(symbol)
+        return list(book.bids) if book else list()
 
     def get_sell_order_list(self, symbol):
-        """获取挂单列表"""
-        return self.sell_order_dicts.get(symbol, list())
+        """获取挂单列表（价格优先，时间优先）"""
+        book = self.order_books.get(symbol)
+        return list(book.asks) if book else list()
 
     def set_rtn_func(self, rtn_order_func, rtn_trade_func, rtn_userdata):
         """设置回调函数"""
@@ -764,36 +2620,27 @@ class VMatchExchange(object):
     def req_input_order(self, order_req):
         """订单请求"""
         order_data = VMatch.gen_order_data(order_req)
+        order_data.orderSysID = str(self.next_sys_id())
+        order_data.status = STATUS_NOTTRADED
+        order_data.statusMsg = "未成交"
 
-        if self.__thrd:
-            self.__que.put((EV_REQ_ORDER, order_data))
-        else:
-            self.do_match(order_data)
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_REQ_ORDER, order_data)
+        self.do_match(order_data)
 
     def req_cancel_order(self, cancel_req):
         """撤单请求"""
-        if self.__thrd:
-            self.__que.put((EV_REQ_CANCEL, cancel_req))
-        else:
-            self.do_match(cancel_req)
+        if self.__worker.should_queue():
+            return self.__worker.put(EV_REQ_CANCEL, cancel_req)
+        self.do_cancel(cancel_req)
 
     def do_cancel(self, cancel_req):
         """执行挂单的撤销"""
         original_order = None
-        buy_orders = self.get_buy_order_list(cancel_req.btSymbol)
-        for buy_order in buy_orders:
-            if buy_order.orderSysID == cancel_req.orderSysID:
-                original_order = buy_order
-                buy_orders.remove(buy_order)
-                break
-
-        if not original_order:
-            sell_orders = self.get_sell_order_list(cancel_req.btSymbol)
-            for sell_order in sell_orders:
-                if sell_order.orderSysID == cancel_req.orderSysID:
-                    original_order = sell_orders
-                    sell_orders.remove(sell_order)
-                    break
+        item = self.order_index.pop(cancel_req.orderSysID, None)
+        if item:
+            _, side, level, original_order = item
+            side.remove(original_order, level)
 
         if original_order:
             # 撤销成功
@@ -804,6 +2651,7 @@ class VMatchExchange(object):
                 original_order.status = STATUS_CANCELLED
                 original_order.statusMsg = "全部撤单"
             if self.rtn_order_func:
+                self.__worker.record_callback()
                 self.rtn_order_func(self.rtn_userdata, original_order)
         else:
             # TODO: 撤单失败(不存在/已成交)
@@ -811,59 +2659,39 @@ class VMatchExchange(object):
 
     def do_match(self, order):
         """执行买卖挂单的撮合"""
-        buy_orders = self.get_buy_order_list(order.btSymbol)
-        sell_orders = self.get_sell_order_list(order.btSymbol)
-        pruned_orders = []
-
-        if order.direction == DIRECTION_LONG:
+        book = self.get_order_book(order.btSymbol)
+        is_buy = order.direction == DIRECTION_LONG
+        if is_buy:
             # 与卖单比较，若能撮合，则生成成交，否则插入订单到适合位置（价格优化，时间优化）
-            for sell_order in sell_orders:
-                if order.price < sell_order.price:
-                    break
+            opposite, own = book.asks, book.bids
+        else:
+            # 与买单比较，若能撮合，则生成成交，否则插入订单到适合位置
+            opposite, own = book.bids, book.asks
 
-                # 成交
-                self.process_match_data(order, sell_order, sell_order.price)
-                if sell_order.status == STATUS_ALLTRADED:
-                    pruned_orders.append(sell_order)
+        while order.tradedVolume < order.totalVolume:
+            level = opposite.best_level()
+            if level is None:
+                break
+            if (is_buy and order.price < level.price) or \
+               (not is_buy and order.price > level.price):
+                break
 
-            # 移除挂单
-            for prune_order in pruned_orders:
-                sell_orders.remove(prune_order)
+            # 成交，价格为挂单价
+            resting_order = level.front()
+            if is_buy:
+                self.process_match_data(order, resting_order, level.price)
+            else:
+                self.process_match_data(resting_order, order, level.price)
 
-            # 插入到挂单队列中（以价格优先，时间优先）
-            if order.status == STATUS_NOTTRADED or order.status == STATUS_PARTTRADED:
-                self.insert_pending_order(buy_orders, order, is_buy=True)
-        else:
-            # 与买单比较，若能撮合，则生成成交，否则插入订单到适合位置
-            for buy_order in buy_orders:
-                if order.price > buy_order.price:
-                    break
+            # 移除已全部成交的挂单
+            if resting_order.status == STATUS_ALLTRADED:
+                opposite.pop_front(level)
+                del self.order_index[resting_order.orderSysID]
 
-                # 成交
-                self.process_match_data(buy_order, order, buy_order.price)
-                if buy_order.status == STATUS_ALLTRADED:
-                    pruned_orders.append(buy_order)
-
-            # 移除挂单
-            for prune_order in pruned_orders:
-                buy_orders.remove(prune_order)
-
-            # 插入到挂单队列中（以价格优先，时间优先）,TODO: 处理 FAK/FOK单
-            if order.status == STATUS_NOTTRADED or order.status == STATUS_PARTTRADED:
-                self.insert_pending_order(sell_orders, order, is_buy=False)
-
-    def insert_pending_order(self, order_list, order, is_buy):
-        """处理挂单"""
-        index = 0
-        cmp = lambda x, y: x >= y if is_buy else x <= y
-        for temp_order in order_list:
-            if cmp(temp_order.price, order.price):
-                index += 1
-                continue
-            order_list.insert(index, order)
-            break
-        if index == len(order_list):
-            order_list.append(order)
+        # 插入到挂单队列中（以价格优先，时间优先），TODO: 处理 FAK/FOK单
+        if order.status == STATUS_NOTTRADED or order.status == STATUS_PARTTRADED:
+            level = own.insert(order)
+            self.order_index[order.orderSysID] = (order.btSymbol, own, level, order)
 
     def process_match_data(self, buy_order, sell_order, trade_price):
         """处理成交数据"""
@@ -897,6 +2725,7 @@ class VMatchExchange(object):
         sell_trade = VMatch.gen_trade_data(sell_trade_info)
 
         # 成交通知
+        self.__worker.record_callback()
         if self.rtn_order_func:
             self.rtn_order_func(self.rtn_userdata, buy_order)
             self.rtn_order_func(self.rtn_userdata, sell_order)
@@ -918,20 +2747,12 @@ class VMatchExchange(object):
             self.rtn_tick_func(self.rtn_userdata, tick)
         """
 
-    def work_run(self):
-        """工作线程"""
-        while self.__active:
-            try:
-                item = self.__que.get(timeout=1)
-                if item is None:
-                    continue
-
-                if item[0] == EV_REQ_ORDER:
-                    self.do_match(item[1])
-                elif item[0] == EV_REQ_CANCEL:
-                    self.do_cancel(item[1])
-            except Empty:
-                continue
+    def _process_event(self, ev_type, data):
+        """工作线程处理事件"""
+        if ev_type == EV_REQ_ORDER:
+            self.do_match(data)
+        elif ev_type == EV_REQ_CANCEL:
+            self.do_cancel(data)
 
 
 ############################################################
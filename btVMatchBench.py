@@ -0,0 +1,1614 @@
+# encoding: UTF-8
+#
+# Copyright 2018 BigQuant, Inc.
+#
+# 模拟撮合性能测试
+#   python btVMatchBench.py [name ...]
+#
+
+import asyncio
+import csv
+import gc
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import threading
+import tracemalloc
+
+import numpy as np
+from copy import copy
+from collections import deque
+from types import SimpleNamespace
+
+from bigtrader.btConstant import *
+from bigtrader.btObject import BtOrderReq, BtCancelOrderReq, BtTickData, BtBarData
+from bigtrader.btObject import BtTradeData, BtPositionDetailData
+
+from btVMatch import EV_REQ_ORDER, EV_TICK
+from btVMatch import VMatch, VMatchExchange, VMatchManager, QuoteEngine, iter_csv_ticks
+from btVMatch import ALLOC_PRIORITY, ALLOC_PRO_RATA, VMatchJournal, OrderRecord, TradeRecord
+from btVMatch import IDSource, IDAllocator, SimPosition, TICK_TIME_KEY
+from btVMatchVec import BarReplayEngine
+from btTickStore import TickStore, convert_csv
+from btVMatchShard import ShardedVMatchManager
+from btVMatchServer import VMatchService, run_load
+import vposition
+from vposition import VPosition2
+from vportfolio import VPortfolio
+
+
+def make_order_req(account_id, symbol, direction, price, volume, offset=OFFSET_OPEN):
+    """构造一笔报单请求"""
+    order_req = BtOrderReq()
+    order_req.gatewayName = "BENCH"
+    order_req.accountID = account_id
+    order_req.symbol = symbol
+    order_req.btSymbol = symbol
+    order_req.direction = direction
+    order_req.offset = offset
+    order_req.priceType = PRICETYPE_LIMITPRICE
+    order_req.price = price
+    order_req.volume = volume
+    order_req.multiplier = 10
+    return order_req
+
+
+def make_exchange_order(exchange, direction, price, volume, symbol="rb1905"):
+    """构造一笔可直接送入 VMatchExchange.do_match 的委托"""
+    order = VMatch.gen_order_data(make_order_req("bench", symbol, direction, price, volume))
+    order.orderSysID = str(exchange.next_sys_id())
+    order.status = STATUS_NOTTRADED
+    order.statusMsg = "未成交"
+    return order
+
+
+def make_cancel_req(account_id, symbol, order_sys_id):
+    """构造一笔撤单请求"""
+    cancel_req = BtCancelOrderReq()
+    cancel_req.accountID = account_id
+    cancel_req.symbol = symbol
+    cancel_req.btSymbol = symbol
+    cancel_req.orderSysID = order_sys_id
+    return cancel_req
+
+
+def make_tick(symbol, last_price, volume, ask_price=None, bid_price=None, time_str="09:30:00", date="2019-01-03"):
+    """构造一笔1档tick行情"""
+    tick = BtTickData()
+    tick.symbol = symbol
+    tick.btSymbol = symbol
+    tick.lastPrice = last_price
+    tick.askPrice1 = last_price if ask_price is None else ask_price
+    tick.bidPrice1 = last_price if bid_price is None else bid_price
+    tick.volume = volume
+    tick.time = time_str
+    tick.date = date
+    tick.actionDay = date
+    return tick
+
+
+TICK_CSV_HEADER = ['btSymbol', 'date', 'time', 'actionDay', 'lastPrice', 'volume',
+                   'askPrice1', 'askVolume1', 'bidPrice1', 'bidVolume1']
+
+
+def write_tick_csv(path, n_rows, symbols, seed=0, date="2019-01-03"):
+    """生成tick行情csv文件，多个合约按时间交替"""
+    rnd = random.Random(seed)
+    prices = {symbol: 4000.0 for symbol in symbols}
+    volumes = {symbol: 0 for symbol in symbols}
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TICK_CSV_HEADER)
+        for i in range(n_rows):
+            symbol = symbols[i % len(symbols)]
+            prices[symbol] += rnd.choice((-1, 0, 1))
+            volumes[symbol] += rnd.randint(0, 20)
+            seconds = 9 * 3600 + i // len(symbols)
+            time_str = "{:02d}:{:02d}:{:02d}.{:03d}".format(seconds // 3600 % 24, seconds // 60 % 60, seconds % 60, 0)
+            writer.writerow([symbol, date, time_str, date, prices[symbol], volumes[symbol],
+                             prices[symbol] + 1, rnd.randint(1, 100), prices[symbol] - 1, rnd.randint(1, 100)])
+
+
+def report(name, count, elapsed):
+    print("{:<40} {:>10} ops {:>9.3f}s {:>12.0f} ops/s".format(name, count, elapsed, count / elapsed if elapsed else 0))
+
+
+def report_latency(name, samples_ns):
+    """打印延时分位数(us)"""
+    samples_ns = sorted(samples_ns)
+    n = len(samples_ns)
+    pct = lambda p: samples_ns[min(n - 1, int(n * p))] / 1000.0
+    print("{:<40} n={:<8} p50={:.2f}us p90={:.2f}us p99={:.2f}us max={:.2f}us"
+          .format(name, n, pct(0.5), pct(0.9), pct(0.99), samples_ns[-1] / 1000.0))
+
+
+############################################################
+def bench_order_book(depths=(10000, 100000)):
+    """挂单簿插入/撮合吞吐量"""
+    for depth in depths:
+        rnd = random.Random(depth)
+        exchange = VMatchExchange()
+
+        # 不可成交的挂单：买价 < 4000 <= 卖价，分布在 2000 个价位上
+        orders = []
+        for i in range(depth):
+            if i % 2:
+                orders.append(make_exchange_order(exchange, DIRECTION_LONG, 3000 + rnd.randint(0, 999), 1))
+            else:
+                orders.append(make_exchange_order(exchange, DIRECTION_SHORT, 4000 + rnd.randint(0, 999), 1))
+
+        t0 = time.perf_counter()
+        for order in orders:
+            exchange.do_match(order)
+        report("orderbook insert depth={}".format(depth), depth, time.perf_counter() - t0)
+
+        # 吃掉一半挂单
+        takers = []
+        for i in range(depth // 2):
+            if i % 2:
+                takers.append(make_exchange_order(exchange, DIRECTION_LONG, 5000, 1))
+            else:
+                takers.append(make_exchange_order(exchange, DIRECTION_SHORT, 2000, 1))
+
+        t0 = time.perf_counter()
+        for order in takers:
+            exchange.do_match(order)
+        report("orderbook match depth={}".format(depth), len(takers), time.perf_counter() - t0)
+
+
+def bench_cancel(depths=(10000, 100000), n_samples=10000):
+    """撤单延时分位数，模拟撮合的撤单计入之后一笔行情的处理"""
+    perf_ns = time.perf_counter_ns
+    for depth in depths:
+        rnd = random.Random(depth)
+
+        # 模拟交易所
+        exchange = VMatchExchange()
+        sys_ids = []
+        for i in range(depth):
+            direction = DIRECTION_LONG if i % 2 else DIRECTION_SHORT
+            price = 3000 + rnd.randint(0, 999) if i % 2 else 4000 + rnd.randint(0, 999)
+            order = make_exchange_order(exchange, direction, price, 1)
+            exchange.do_match(order)
+            sys_ids.append(order.orderSysID)
+        rnd.shuffle(sys_ids)
+
+        samples = []
+        for sys_id in sys_ids:
+            cancel_req = make_cancel_req("bench", "rb1905", sys_id)
+            t0 = perf_ns()
+            exchange.do_cancel(cancel_req)
+            samples.append(perf_ns() - t0)
+        report_latency("exchange cancel depth={}".format(depth), samples)
+
+        # 单账户模拟撮合
+        vmatch = VMatch(is_future=True)
+        for i in range(depth):
+            vmatch.req_input_order(make_order_req("bench", "rb1905", DIRECTION_LONG, 3000 + rnd.randint(0, 999), 1))
+        vmatch._process_new_orders()
+        sys_ids = list(vmatch.order_index.keys())
+        rnd.shuffle(sys_ids)
+
+        # 撤单及之后的一笔（不可成交的）tick，撤单的全部开销都计入
+        n = min(n_samples, depth // 2)
+        samples = []
+        for i, sys_id in enumerate(sys_ids[:n]):
+            cancel_req = make_cancel_req("bench", "rb1905", sys_id)
+            tick = make_tick("rb1905", 4500, i + 1, ask_price=4500, bid_price=4499)
+            t0 = perf_ns()
+            vmatch.req_cancel_order(cancel_req)
+            vmatch.on_new_tick(tick)
+            samples.append(perf_ns() - t0)
+        report_latency("vmatch cancel+tick depth={}".format(depth), samples)
+
+        # 撤单重报：撤一笔、报一笔、再来一笔tick，挂单数不变
+        samples = []
+        for i, sys_id in enumerate(sys_ids[n:2 * n]):
+            cancel_req = make_cancel_req("bench", "rb1905", sys_id)
+            order_req = make_order_req("bench", "rb1905", DIRECTION_LONG, 3000 + rnd.randint(0, 999), 1)
+            tick = make_tick("rb1905", 4500, n + i + 1, ask_price=4500, bid_price=4499)
+            t0 = perf_ns()
+            vmatch.req_cancel_order(cancel_req)
+            vmatch.req_input_order(order_req)
+            vmatch.on_new_tick(tick)
+            samples.append(perf_ns() - t0)
+        report_latency("vmatch cancel/replace depth={}".format(depth), samples)
+
+
+def bench_dispatch(n_accounts=5000, n_symbols=4000, symbols_per_account=5, broadcast_ticks=200):
+    """按合约分发行情 vs 广播到所有账户"""
+    rnd = random.Random(n_accounts)
+    symbols = ["S{:04d}".format(i) for i in range(n_symbols)]
+
+    vmatchmgr = VMatchManager()
+    for i in range(n_accounts):
+        account_id = "A{:05d}".format(i)
+        for symbol in rnd.sample(symbols, symbols_per_account):
+            # 远离盘口的买单，不会成交
+            vmatchmgr.req_input_order(make_order_req(account_id, symbol, DIRECTION_LONG, 10, 1))
+    ticks = [make_tick(symbol, 100, 1000) for symbol in symbols]
+    vmatchmgr.on_new_tick(ticks[0])     # 处理新订单
+
+    t0 = time.perf_counter()
+    for tick in ticks:
+        vmatchmgr.on_new_tick(tick)
+    report("routed {}x{}".format(n_accounts, n_symbols), len(ticks), time.perf_counter() - t0)
+
+    vmatchs = list(vmatchmgr.vmatch_dicts.values())
+    t0 = time.perf_counter()
+    for tick in ticks[:broadcast_ticks]:
+        for vmatch in vmatchs:
+            vmatch.on_new_tick(tick)
+    report("broadcast {}x{}".format(n_accounts, n_symbols), broadcast_ticks, time.perf_counter() - t0)
+
+
+def _run_bar_replay(n_accounts, n_orders, closes, volumes, vectorized, partial=False):
+    """构造同样的账户和挂单，按对象或列方式回放bar，返回回报记录
+    partial: 每个账户只挂一笔始终可成交的大单，按成交量限制每根bar部分成交，始终不会全部成交
+    """
+    rnd = random.Random(n_accounts * n_orders)
+    records = []
+    price_types = [PRICETYPE_LIMITPRICE] * 8 + [PRICETYPE_FAK, PRICETYPE_FOK]
+
+    def on_order(userdata, order):
+        records.append(('order', order.accountID, order.orderSysID, order.status, order.tradedVolume))
+
+    def on_trade(userdata, trade):
+        records.append(('trade', trade.accountID, trade.orderSysID, trade.tradeID, trade.price, trade.volume,
+                        trade.tradeDateTime))
+        # 部分成交后追加一笔新订单，验证回调中下单
+        if int(trade.tradeID) % 7 == 0:
+            order_req = make_order_req(trade.accountID, "rb1905", trade.direction, trade.price, 3)
+            vmatchmgr.req_input_order(order_req)
+
+    # 两种回放的报单、成交编号须相同
+    vmatchmgr = VMatchManager(id_source=IDSource(seed=0))
+    vmatchmgr.set_order_callback(on_order, None)
+    vmatchmgr.set_trade_callback(on_trade, None)
+    for i in range(n_accounts):
+        account_id = "A{:04d}".format(i)
+        if partial:
+            direction = DIRECTION_LONG if i % 2 == 0 else DIRECTION_SHORT
+            price = 5000 if direction == DIRECTION_LONG else 3000
+            vmatchmgr.req_input_order(make_order_req(account_id, "rb1905", direction, price, 10 ** 9))
+            continue
+        for j in range(n_orders):
+            direction = DIRECTION_LONG if rnd.random() < 0.5 else DIRECTION_SHORT
+            order_req = make_order_req(account_id, "rb1905", direction, 4000 + rnd.randint(-200, 200),
+                                       rnd.randint(1, 50))
+            order_req.priceType = rnd.choice(price_types)
+            vmatchmgr.req_input_order(order_req)
+    dates = ["2019-01-{:02d}".format(1 + i // 240 % 28) for i in range(len(closes))]
+    times = ["{:02d}:{:02d}:00".format(9 + i % 240 // 60, i % 60) for i in range(len(closes))]
+
+    t0 = time.perf_counter()
+    if vectorized:
+        BarReplayEngine(vmatchmgr).replay("rb1905", dates, times, closes, volumes)
+    else:
+        for i in range(len(closes)):
+            bar = BtBarData()
+            bar.btSymbol = "rb1905"
+            bar.date, bar.time = dates[i], times[i]
+            bar.close, bar.volume = closes[i], volumes[i]
+            vmatchmgr.on_new_bar(bar)
+    return records, time.perf_counter() - t0
+
+
+def bench_bar_replay(n_bars=20000, n_accounts=20, n_orders=200, repeat=3):
+    """列式bar回放与逐对象回放：结果一致性及吞吐量"""
+    rnd = random.Random(n_bars)
+    closes, volumes = [], []
+    price = 4000.0
+    for i in range(n_bars):
+        price = max(3500.0, min(4500.0, price + rnd.choice((-2, -1, 0, 1, 2))))
+        closes.append(price)
+        volumes.append(0 if i % 97 == 0 else rnd.randint(100, 2000))
+
+    scalar_records, scalar_elapsed = _run_bar_replay(n_accounts, n_orders, closes, volumes, vectorized=False)
+    vector_records, vector_elapsed = _run_bar_replay(n_accounts, n_orders, closes, volumes, vectorized=True)
+    assert scalar_records == vector_records, "vectorized bar replay differs from object path"
+    print("equivalent: {} records".format(len(scalar_records)))
+    report("bar replay object", n_bars, scalar_elapsed)
+    report("bar replay vectorized", n_bars, vector_elapsed)
+
+    # 部分成交的挂单几乎每根bar都撮合，列式回放改为逐bar撮合，不应比逐对象回放慢；交替运行取最短耗时
+    for n in (n_bars // 4, n_bars):
+        scalar_elapsed = vector_elapsed = float('inf')
+        for _ in range(repeat):
+            scalar_records, elapsed = _run_bar_replay(2, 1, closes[:n], volumes[:n], False, partial=True)
+            scalar_elapsed = min(scalar_elapsed, elapsed)
+            vector_records, elapsed = _run_bar_replay(2, 1, closes[:n], volumes[:n], True, partial=True)
+            vector_elapsed = min(vector_elapsed, elapsed)
+            assert scalar_records == vector_records, "vectorized partial fill replay differs from object path"
+        report("partial fills object records={}".format(len(scalar_records)), n, scalar_elapsed)
+        report("partial fills vectorized", n, vector_elapsed)
+
+
+def bench_csv_ticks(n_rows=1000000, n_symbols=100):
+    """流式读取csv tick：解析速度、回放速度及各阶段内存峰值
+    内存峰值用 tracemalloc 统计，每个阶段前重置，且与计时分开再跑一遍，不影响计时
+    """
+    symbols = ["S{:04d}".format(i) for i in range(n_symbols)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "ticks.csv")
+        write_tick_csv(path, n_rows, symbols)
+        print("csv size: {:.1f}MB".format(os.path.getsize(path) / 1e6))
+
+        def parse():
+            count = 0
+            for _ in iter_csv_ticks(path):
+                count += 1
+            return count
+
+        def replay():
+            qe, _ = _make_tick_replay(symbols)
+            qe.read_csv(path)
+            t0 = time.perf_counter()
+            qe.cast_quotes()
+            return time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        count = parse()
+        report("csv parse", count, time.perf_counter() - t0)
+        report("csv replay", n_rows, replay())
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            for name, phase in (("parse", parse), ("replay", replay)):
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                phase()
+                peak = tracemalloc.get_traced_memory()[1]
+                print("{:<40} peak={:.1f}MB".format("memory csv " + name, (peak - base) / 1e6))
+        finally:
+            tracemalloc.stop()
+
+
+def _make_tick_replay(symbols, date="2019-01-03"):
+    """构造带挂单的行情回放，返回 (QuoteEngine, 回报记录)"""
+    records = []
+
+    def on_order(userdata, order):
+        records.append(('order', order.accountID, order.orderSysID, order.status, order.tradedVolume))
+
+    def on_trade(userdata, trade):
+        records.append(('trade', trade.accountID, trade.orderSysID, trade.tradeID, trade.price, trade.volume,
+                        trade.tradeDateTime))
+
+    # csv 与二进制存储回放的报单、成交编号须相同
+    vmatchmgr = VMatchManager(id_source=IDSource(seed=0))
+    vmatchmgr.set_order_callback(on_order, None)
+    vmatchmgr.set_trade_callback(on_trade, None)
+    vmatchmgr.set_trading_day(date)
+    for i, symbol in enumerate(symbols):
+        for j in range(5):
+            direction = DIRECTION_LONG if j % 2 else DIRECTION_SHORT
+            price = 4000 - 3 * j if j % 2 else 4000 + 3 * j
+            vmatchmgr.req_input_order(make_order_req("A{:03d}".format(i % 10), symbol, direction, price, 5))
+    return QuoteEngine(vmatchmgr), records
+
+
+def bench_tick_store(n_rows=1000000, n_symbols=100):
+    """二进制tick存储：转换、内存映射回放与csv回放的一致性，以及按合约/时间截取"""
+    symbols = ["S{:04d}".format(i) for i in range(n_symbols)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "ticks.csv")
+        root = os.path.join(tmpdir, "store")
+        write_tick_csv(path, n_rows, symbols)
+
+        t0 = time.perf_counter()
+        convert_csv(path, root)
+        report("convert csv", n_rows, time.perf_counter() - t0)
+
+        qe, csv_records = _make_tick_replay(symbols)
+        qe.read_csv(path)
+        t0 = time.perf_counter()
+        qe.cast_quotes()
+        report("csv replay", n_rows, time.perf_counter() - t0)
+
+        store = TickStore(root)
+        qe, store_records = _make_tick_replay(symbols)
+        qe.put_tick_source(store.iter_ticks())
+        t0 = time.perf_counter()
+        qe.cast_quotes()
+        report("store replay", n_rows, time.perf_counter() - t0)
+        assert csv_records == store_records, "tick store replay differs from csv replay"
+        print("identical fills: {} records".format(len(csv_records)))
+
+        t0 = time.perf_counter()
+        count = sum(1 for _ in store.iter_ticks(symbols=symbols[:5], start_time="09:30:00", end_time="09:40:00"))
+        report("store seek 5 symbols x 10min", count, time.perf_counter() - t0)
+
+        # 按合约拆分的多个文件依次转换到同一交易日：索引合并，行号连续
+        split_root = os.path.join(tmpdir, "split")
+        with open(path, newline='') as f:
+            rows = list(csv.reader(f))
+        for symbol in symbols:
+            symbol_path = os.path.join(tmpdir, symbol + ".csv")
+            with open(symbol_path, 'w', newline='') as f:
+                csv.writer(f).writerows([rows[0]] + [row for row in rows[1:] if row[0] == symbol])
+            convert_csv(symbol_path, split_root)
+        split_store = TickStore(split_root)
+        trading_day = store.get_days()[0]
+        index = split_store.get_index(trading_day)
+        assert sorted(index['symbols']) == sorted(store.get_index(trading_day)['symbols'])
+        assert index['count'] == n_rows
+        seqs = np.concatenate([split_store.read_records(trading_day, symbol)['seq'] for symbol in symbols])
+        assert np.array_equal(np.sort(seqs), np.arange(n_rows)), "split convert seq not continuous"
+        for symbol in symbols:
+            split_records = split_store.read_records(trading_day, symbol)
+            records = store.read_records(trading_day, symbol)
+            assert np.array_equal(split_records[list(records.dtype.names[1:])],
+                                  records[list(records.dtype.names[1:])])
+        print("{:<40} files={} symbols={} identical".format("split convert merged", len(symbols),
+                                                            len(index['symbols'])))
+
+        # 拆分转换后的回放顺序与单文件转换相同
+        def replay_keys(tick_store):
+            return [(tick.btSymbol, tick.actionDay, tick.time, tick.volume) for tick in tick_store.iter_ticks()]
+        t0 = time.perf_counter()
+        split_keys = replay_keys(split_store)
+        report("split store replay", len(split_keys), time.perf_counter() - t0)
+        assert split_keys == replay_keys(store), "split store replay order differs from single-file store"
+        qe, split_records = _make_tick_replay(symbols)
+        qe.put_tick_source(split_store.iter_ticks())
+        qe.cast_quotes()
+        assert split_records == store_records, "split store fills differ from single-file store"
+        print("identical replay order and fills: {} ticks".format(len(split_keys)))
+
+        # 夜盘跨 actionDay：各合约分别转换，回放按 (actionDay, 时间) 合并
+        night_root = os.path.join(tmpdir, "night")
+        times = [("2019-01-02", "23:59:{:02d}.000".format(i)) for i in range(50, 60)] + \
+                [("2019-01-03", "00:00:{:02d}.000".format(i)) for i in range(10)]
+        expected = []
+        for i, symbol in enumerate(symbols[:3]):
+            symbol_path = os.path.join(tmpdir, "night_{}.csv".format(symbol))
+            write_symbol_csv(symbol_path, "2019-01-03", times[i::2], seed=i)
+            convert_csv(symbol_path, night_root, fixed_fields={'btSymbol': symbol})
+            expected.extend(times[i::2])
+        keys = [(tick.actionDay, tick.time) for tick in TickStore(night_root).iter_ticks()]
+        assert keys == sorted(expected), "night session replay out of order"
+        print("{:<40} ticks={} ordered".format("split convert night session", len(keys)))
+
+
+def write_symbol_csv(path, date, times, seed):
+    """生成单个合约一个交易日的tick行情csv文件（没有合约列），times 为 (actionDay, time) 列表"""
+    rnd = random.Random(seed)
+    price, volume = 4000.0, 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TICK_CSV_HEADER[1:])
+        for action_day, time_str in times:
+            price += rnd.choice((-1, 0, 1))
+            volume += rnd.randint(0, 20)
+            writer.writerow([date, time_str, action_day, price, volume,
+                             price + 1, rnd.randint(1, 100), price - 1, rnd.randint(1, 100)])
+
+
+def _symbol_fields(path):
+    """按文件名 <合约>_<交易日>.csv 指定合约"""
+    return {'btSymbol': os.path.basename(path).split('_')[0]}
+
+
+class _TickRecorder(object):
+    """记录回放顺序及交易日切换次数，代替 VMatchManager"""
+    def __init__(self, record=True):
+        self.record = record
+        self.days = []
+        self.ticks = []
+        self.tick_n = 0
+
+    def set_trading_day(self, trading_day):
+        self.days.append(trading_day)
+
+    def on_new_tick(self, tick):
+        self.tick_n += 1
+        if self.record:
+            self.ticks.append((tick.btSymbol, tick.date, tick.actionDay, tick.time, tick.lastPrice))
+
+
+def _replay_symbol_files(csv_files, merged, record=True):
+    """回放按合约存储的文件，merged 为 False 时全部读入后排序，返回 (recorder, 耗时)"""
+    recorder = _TickRecorder(record)
+    qe = QuoteEngine(recorder)
+    t0 = time.perf_counter()
+    if merged:
+        qe.read_csv_files(csv_files, fixed_fields=_symbol_fields)
+    else:
+        ticks = [tick for path in csv_files for tick in iter_csv_ticks(path, fixed_fields=_symbol_fields(path))]
+        ticks.sort(key=TICK_TIME_KEY)
+        qe.put_ticks(ticks)
+        del ticks
+    qe.cast_quotes()
+    return recorder, time.perf_counter() - t0
+
+
+def bench_merge_files(n_files=4000, n_days=2, n_rows=150):
+    """按合约、按交易日存储的多个文件按时间归并回放：与全部读入后排序的结果相同，每个交易日只切换一次"""
+    n_symbols = n_files // n_days
+    days = ["2019-01-{:02d}".format(3 + i) for i in range(n_days)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        csv_files = []
+        for d, date in enumerate(days):
+            for s in range(n_symbols):
+                symbol = "S{:04d}".format(s)
+                # 偶数合约有夜盘，自然日为前一日；各合约的时间错开
+                times = []
+                if d and s % 2 == 0:
+                    times.extend((days[d - 1], "21:{:02d}:{:02d}.{:03d}".format(k // 60, k % 60, s % 1000))
+                                 for k in range(n_rows // 5))
+                times.extend((date, "09:{:02d}:{:02d}.{:03d}".format(k // 60, k % 60, (7 * s) % 1000))
+                             for k in range(n_rows - len(times)))
+                path = os.path.join(tmpdir, "{}_{}.csv".format(symbol, date))
+                write_symbol_csv(path, date, times, seed=d * n_symbols + s)
+                csv_files.append(path)
+        # 文件顺序打乱，交易日由文件内容确定
+        random.Random(25).shuffle(csv_files)
+
+        sorted_rec, sorted_elapsed = _replay_symbol_files(csv_files, merged=False)
+        merged_rec, merged_elapsed = _replay_symbol_files(csv_files, merged=True)
+        n_ticks = len(sorted_rec.ticks)
+        report("load all + sort files={}".format(n_files), n_ticks, sorted_elapsed)
+        report("heap merge files={}".format(n_files), n_ticks, merged_elapsed)
+        assert sorted_rec.days == days and merged_rec.days == days, "set_trading_day not once per day"
+        # 时间相同的tick都按文件顺序，与稳定排序的结果逐笔相同
+        assert sorted_rec.ticks == merged_rec.ticks, "merged replay differs from sorted replay"
+        assert all(tick[0] for tick in merged_rec.ticks), "btSymbol not set from fixed_fields"
+        print("{:<40} ticks={} days={} identical".format("merge files equal", n_ticks, len(merged_rec.days)))
+
+        for merged in (False, True):
+            tracemalloc.start()
+            recorder, _ = _replay_symbol_files(csv_files, merged, record=False)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("{:<40} ticks={} peak={:.1f}MB".format("memory merged={}".format(merged), recorder.tick_n,
+                                                         peak / 1e6))
+
+
+def _run_sharded(vmatchmgr, n_accounts, symbols, ticks):
+    """下单并回放行情，返回 (耗时, 成交数)"""
+    rnd = random.Random(n_accounts)
+    trades = []
+    vmatchmgr.set_trade_callback(lambda userdata, trade: trades.append(trade), None)
+    vmatchmgr.set_trading_day("2019-01-03")
+    for i in range(n_accounts):
+        account_id = "A{:05d}".format(i)
+        for symbol in rnd.sample(symbols, 10):
+            for j in range(3):
+                # 大部分挂单远离盘口，少量可成交
+                price = 4000 - 50 * (j + 1) if rnd.random() < 0.95 else 4005
+                vmatchmgr.req_input_order(make_order_req(account_id, symbol, DIRECTION_LONG, price, 100))
+
+    t0 = time.perf_counter()
+    for tick in ticks:
+        vmatchmgr.on_new_tick(tick)
+    if isinstance(vmatchmgr, ShardedVMatchManager):
+        vmatchmgr.stop()
+    return time.perf_counter() - t0, len(trades)
+
+
+def bench_sharded(n_accounts=2000, n_symbols=50, n_ticks=5000, workers=(1, 2, 4, 8)):
+    """多进程分片撮合的扩展性"""
+    symbols = ["S{:04d}".format(i) for i in range(n_symbols)]
+    ticks = [make_tick(symbols[i % n_symbols], 4000, 10 * (i + 1), ask_price=4001, bid_price=3999)
+             for i in range(n_ticks)]
+
+    elapsed, n_trades = _run_sharded(VMatchManager(), n_accounts, symbols, ticks)
+    report("single process trades={}".format(n_trades), n_ticks, elapsed)
+    for n_workers in workers:
+        elapsed, n_trades = _run_sharded(ShardedVMatchManager(n_workers), n_accounts, symbols, ticks)
+        report("sharded workers={} trades={}".format(n_workers, n_trades), n_ticks, elapsed)
+
+    # 工作进程退出后，之后每次 flush 都抛出带分片序号的 RuntimeError，而不是 BrokenPipeError
+    vmatchmgr = ShardedVMatchManager(2)
+    vmatchmgr.set_trading_day("2019-01-03")
+    vmatchmgr.flush()
+    worker = multiprocessing.active_children()[0]
+    worker.kill()
+    worker.join()
+    for _ in range(2):
+        for i in range(4):
+            vmatchmgr.req_input_order(make_order_req("A{:05d}".format(i), symbols[0], DIRECTION_LONG, 4000, 1))
+        try:
+            vmatchmgr.flush()
+        except RuntimeError as e:
+            assert "shard" in str(e) and "failed" in str(e), str(e)
+        else:
+            raise AssertionError("flush after worker exit did not raise")
+    vmatchmgr.stop()
+    print("{:<40} RuntimeError on every flush".format("sharded dead worker"))
+
+
+def report_stats(name, stats):
+    """打印 LatencyStats.summary 的结果(us)"""
+    for stage, item in sorted(stats.items()):
+        print("{:<40} n={:<8} p50={:.2f}us p90={:.2f}us p99={:.2f}us max={:.2f}us"
+              .format("{} {}".format(name, stage), item['count'], item['p50'], item['p90'], item['p99'], item['max']))
+
+
+def bench_async_frontend(n_bursts=100, burst_size=200, pause=0.02, batches=(1, 1024)):
+    """突发订单流经工作线程撮合：吞吐与 入队->撮合->回报 延时"""
+    for max_batch in batches:
+        # 模拟交易所：每个突发内买卖单交替，逐对成交
+        exchange = VMatchExchange(max_queue=10000, max_batch=max_batch)
+        trades = []
+        exchange.set_rtn_func(None, lambda userdata, trade: trades.append(trade), None)
+        exchange.start()
+        t0 = time.perf_counter()
+        for _ in range(n_bursts):
+            for i in range(burst_size):
+                direction = DIRECTION_LONG if i % 2 else DIRECTION_SHORT
+                exchange.req_input_order(make_order_req("bench", "rb1905", direction, 4000, 1))
+            time.sleep(pause)
+        exchange.stop()
+        elapsed = time.perf_counter() - t0
+        report("exchange max_batch={} trades={}".format(max_batch, len(trades)), n_bursts * burst_size, elapsed)
+        report_stats("exchange max_batch={}".format(max_batch), exchange.get_latency_stats())
+
+        # 模拟撮合管理：订单与行情交替突发
+        vmatchmgr = VMatchManager(max_queue=10000, max_batch=max_batch)
+        trades = []
+        vmatchmgr.set_trade_callback(lambda userdata, trade: trades.append(trade), None)
+        vmatchmgr.start()
+        t0 = time.perf_counter()
+        for b in range(n_bursts):
+            for i in range(burst_size - 1):
+                vmatchmgr.req_input_order(make_order_req("acct{}".format(i % 50), "rb1905", DIRECTION_LONG, 4001, 1))
+            vmatchmgr.on_new_tick(make_tick("rb1905", 4000, (b + 1) * burst_size, ask_price=4000, bid_price=4000))
+            time.sleep(pause)
+        vmatchmgr.stop()
+        elapsed = time.perf_counter() - t0
+        report("manager max_batch={} trades={}".format(max_batch, len(trades)), n_bursts * burst_size, elapsed)
+        report_stats("manager max_batch={}".format(max_batch), vmatchmgr.get_latency_stats())
+
+    # 背压：队列满时不等待，直接拒绝
+    exchange = VMatchExchange(max_queue=100, max_batch=1024, block=False)
+    exchange.start()
+    rejected = 0
+    for i in range(n_bursts * burst_size // 10):
+        direction = DIRECTION_LONG if i % 2 else DIRECTION_SHORT
+        if not exchange.req_input_order(make_order_req("bench", "rb1905", direction, 4000, 1)):
+            rejected += 1
+    exchange.stop()
+    print("{:<40} {} of {} rejected".format("exchange max_queue=100 non-blocking", rejected, n_bursts * burst_size // 10))
+
+
+async def _run_server_load(max_batch, n_clients, n_orders):
+    service = VMatchService(port=0, max_batch=max_batch)
+    service.vmatchmgr.set_trading_day("2019-01-03")
+    await service.start()
+    try:
+        return await run_load(service.host, service.port, n_clients=n_clients, n_orders=n_orders)
+    finally:
+        await service.stop()
+
+
+def bench_server(n_clients=4, n_orders=20000, batches=(1, 256)):
+    """WebSocket 撮合服务：下单吞吐与确认延时（压测客户端与服务在同一进程）"""
+    for max_batch in batches:
+        result = asyncio.run(_run_server_load(max_batch, n_clients, n_orders))
+        report("server max_batch={} trades={}".format(max_batch, result['rtnTrades']),
+               result['orders'], result['elapsed'])
+        print("{:<40} ack p50={:.2f}ms p99={:.2f}ms".format("server max_batch={}".format(max_batch),
+                                                           result['ackP50'], result['ackP99']))
+
+
+def make_depth_tick(symbol, mid, depth, rnd, volume):
+    """构造多档tick行情，各档量随机"""
+    tick = make_tick(symbol, mid, volume, ask_price=mid + 1, bid_price=mid - 1)
+    for i in range(1, depth + 1):
+        setattr(tick, "askPrice%d" % i, mid + i)
+        setattr(tick, "bidPrice%d" % i, mid - i)
+        setattr(tick, "askVolume%d" % i, rnd.randint(1, 20))
+        setattr(tick, "bidVolume%d" % i, rnd.randint(1, 20))
+    return tick
+
+
+def bench_depth(n_ticks=1000, n_orders=20, depths=(1, 5, 10)):
+    """多档盘口撮合：每笔tick有 n_orders 个FAK单，同一笔tick内的订单共享各档挂单量，成交量不超过盘口量"""
+    for depth in depths:
+        rnd = random.Random(depth)
+        vmatch = VMatch(is_future=True)
+        vmatch.vmatch_engine.set_tick_depth(depth)
+        trades = []
+        vmatch.set_rtn_func(None, lambda userdata, trade: trades.append(trade), None)
+
+        elapsed = 0.0
+        for t in range(n_ticks):
+            tick = make_depth_tick("rb1905", 4000, max(depth, 2), rnd, (t + 1) * 100)
+            for i in range(n_orders):
+                direction = DIRECTION_LONG if i % 2 else DIRECTION_SHORT
+                price = 4000 + rnd.randint(1, 10) if i % 2 else 4000 - rnd.randint(1, 10)
+                order_req = make_order_req("bench", "rb1905", direction, price, rnd.randint(1, 30))
+                order_req.priceType = PRICETYPE_FAK
+                vmatch.req_input_order(order_req)
+            n_before = len(trades)
+            t0 = time.perf_counter()
+            vmatch.on_new_tick(tick)
+            elapsed += time.perf_counter() - t0
+
+            if depth > 1:
+                for side in ("ask", "bid"):
+                    direction = DIRECTION_LONG if side == "ask" else DIRECTION_SHORT
+                    book = sum(getattr(tick, "%sVolume%d" % (side, i)) for i in range(1, depth + 1))
+                    filled = sum(trade.volume for trade in trades[n_before:] if trade.direction == direction)
+                    assert filled <= book, "depth={} tick={} {} filled {} > {}".format(depth, t, side, filled, book)
+        report("depth={} trades={}".format(depth, len(trades)), n_ticks * n_orders, elapsed)
+
+
+def bench_shared_liquidity(n_accounts=1000, n_ticks=200, tick_volume=100):
+    """拥挤策略：所有账户在同一合约挂相同的买单，独立撮合 vs 跨账户共享每笔tick的成交量"""
+    for mode in (None, ALLOC_PRIORITY, ALLOC_PRO_RATA):
+        vmatchmgr = VMatchManager()
+        vmatchmgr.set_trading_day("2019-01-03")
+        if mode:
+            vmatchmgr.set_shared_liquidity(True, mode)
+        trades = []
+        vmatchmgr.set_trade_callback(lambda userdata, trade: trades.append(trade), None)
+        for i in range(n_accounts):
+            vmatchmgr.req_input_order(make_order_req("A{:05d}".format(i), "rb1905", DIRECTION_LONG, 4001, 10))
+
+        filled = 0
+        elapsed = 0.0
+        for t in range(n_ticks):
+            tick = make_tick("rb1905", 4000, (t + 1) * tick_volume, ask_price=4000, bid_price=3999)
+            t0 = time.perf_counter()
+            vmatchmgr.on_new_tick(tick)
+            elapsed += time.perf_counter() - t0
+            tick_filled = sum(trade.volume for trade in trades) - filled
+            filled += tick_filled
+            if mode:
+                assert tick_filled <= tick_volume, "{} tick {} filled {}".format(mode, t, tick_filled)
+        report("{} trades={} volume={}".format(mode or "independent", len(trades), filled), n_ticks, elapsed)
+
+
+def _run_fills(n_orders, with_callback, trace):
+    """n_orders 个挂单在一根bar上全部成交，返回 (耗时, 内存峰值MB, 每笔成交留存的内存块数)"""
+    vmatch = VMatch(is_future=True)
+    if with_callback:
+        received = []
+        vmatch.set_rtn_func(lambda userdata, order: received.append(order.status),
+                            lambda userdata, trade: received.append(trade.volume), None)
+    for i in range(n_orders):
+        vmatch.req_input_order(make_order_req("bench", "rb1905", DIRECTION_LONG, 4001, 1))
+    vmatch._process_new_orders()
+    bar = BtBarData()
+    bar.btSymbol = "rb1905"
+    bar.date, bar.time = "2019-01-03", "09:30:00"
+    bar.close, bar.volume = 4000, 1000000
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    if trace:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    vmatch.on_new_bar(bar)
+    elapsed = time.perf_counter() - t0
+    assert vmatch.journal.trade_n == n_orders
+    peak = 0
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+        tracemalloc.stop()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - blocks) / float(n_orders)
+    return elapsed, peak, retained
+
+
+def bench_records(n_orders=50000):
+    """撮合热路径上订单/成交记录的内存及分配：有/无回调"""
+    for with_callback in (False, True):
+        elapsed, _, _ = _run_fills(n_orders, with_callback, trace=False)
+        _, peak, retained = _run_fills(n_orders, with_callback, trace=True)
+        name = "fills callback={}".format(with_callback)
+        report(name, n_orders, elapsed)
+        print("{:<40} peak={:.1f}MB retained blocks/fill={:.1f}".format(name, peak, retained))
+
+
+def bench_journal(n_days=5, n_orders_per_day=100000, max_records=10000):
+    """交易流水：有界内存 + 写盘，按交易日流式对账、按订单号查询"""
+    rnd = random.Random(n_days)
+    with tempfile.TemporaryDirectory() as root:
+        journal = VMatchJournal(root, max_records)
+        order_fields = dict((name, '') for name in OrderRecord._fields)
+        trade_fields = dict((name, '') for name in TradeRecord._fields)
+        expected = {}
+        rss0 = peak_rss_mb()
+        t0 = time.perf_counter()
+        sys_id = 0
+        for d in range(n_days):
+            day = "2019-01-{:02d}".format(d + 2)
+            journal.set_trading_day(day)
+            volume_sum = 0
+            for i in range(n_orders_per_day):
+                sys_id += 1
+                order_fields.update(orderSysID=str(sys_id), btSymbol="rb1905", status=STATUS_ALLTRADED,
+                                    totalVolume=1, tradedVolume=1)
+                journal.append_order(OrderRecord(**order_fields))
+                volume = rnd.randint(1, 10)
+                volume_sum += volume
+                trade_fields.update(orderSysID=str(sys_id), btSymbol="rb1905", direction=DIRECTION_LONG,
+                                    price=4000.0, volume=volume, tradeID=str(sys_id))
+                journal.append_trade(TradeRecord(**trade_fields))
+            expected[day] = volume_sum
+        n = len(journal)
+        report("journal append max_records={}".format(max_records), n, time.perf_counter() - t0)
+        print("{:<40} rss growth={:.1f}MB".format("journal", peak_rss_mb() - rss0))
+
+        t0 = time.perf_counter()
+        for day, volume_sum in expected.items():
+            summary = journal.get_trade_summary(day)
+            assert summary[("rb1905", DIRECTION_LONG)][0] == volume_sum
+        report("journal eod summary (stream)", n, time.perf_counter() - t0)
+
+        sys_ids = [str(rnd.randint(1, sys_id)) for _ in range(1000)]
+        samples = []
+        for target in sys_ids:
+            t = time.perf_counter_ns()
+            records = list(journal.iter_records(orderSysID=target))
+            samples.append(time.perf_counter_ns() - t)
+            assert len(records) == 2 and records[1].orderSysID == target
+        report_latency("journal lookup by orderSysID", samples)
+
+
+def _run_trading_day(vmatchmgr, n_accounts, n_events, seed):
+    """模拟一个交易日：报单（含平仓单）、撤单、行情交替到达"""
+    rnd = random.Random(seed)
+    symbols = ["rb1905", "hc1905", "i1905"]
+    prices = {symbol: 4000.0 for symbol in symbols}
+    volumes = {symbol: 0 for symbol in symbols}
+    sys_ids = deque()
+    vmatchmgr.set_order_callback(lambda userdata, order: order.status == STATUS_NOTTRADED and sys_ids.append(
+        (order.accountID, order.btSymbol, order.orderSysID)), None)
+    vmatchmgr.set_trading_day("2019-01-03")
+    for i in range(n_events):
+        r = rnd.random()
+        if r < 0.4:
+            symbol = rnd.choice(symbols)
+            offset = OFFSET_OPEN if rnd.random() < 0.8 else OFFSET_CLOSE
+            vmatchmgr.req_input_order(make_order_req("acc{}".format(rnd.randrange(n_accounts)), symbol,
+                                                     rnd.choice((DIRECTION_LONG, DIRECTION_SHORT)),
+                                                     prices[symbol] + rnd.randint(-5, 5), rnd.randint(1, 5), offset))
+        elif r < 0.8 and sys_ids:
+            # 撤最早的挂单，挂单数量保持稳定
+            account_id, symbol, sys_id = sys_ids.popleft()
+            vmatchmgr.req_cancel_order(make_cancel_req(account_id, symbol, sys_id))
+        else:
+            symbol = rnd.choice(symbols)
+            prices[symbol] += rnd.choice((-1, 0, 1))
+            volumes[symbol] += rnd.randint(0, 20)
+            vmatchmgr.on_new_tick(make_tick(symbol, prices[symbol], volumes[symbol]))
+
+
+def _comparable_state(vmatchmgr):
+    accounts = {}
+    for state in vmatchmgr.get_state()['accounts']:
+        state = dict(state)
+        state['pos_dicts'] = {btSymbol: simpos.__getstate__() for btSymbol, simpos in state['pos_dicts'].items()}
+        accounts[state.pop('accountID')] = state
+    return accounts
+
+
+def bench_recovery(n_accounts=200, n_events=300000, snapshot_interval=100000):
+    """崩溃恢复：预写日志 + 快照的写入开销，以及重启恢复时间，恢复的挂单、持仓须与崩溃前一致"""
+    with tempfile.TemporaryDirectory() as root:
+        for persist in (False, True):
+            vmatchmgr = VMatchManager()
+            if persist:
+                vmatchmgr.set_persistence(root, snapshot_interval)
+            t0 = time.perf_counter()
+            _run_trading_day(vmatchmgr, n_accounts, n_events, seed=14)
+            report("trading day persist={}".format(persist), n_events, time.perf_counter() - t0)
+        expected = _comparable_state(vmatchmgr)
+        working_n = sum(len(state['working_orders']) for state in expected.values())
+
+        # 模拟进程崩溃：不调用 stop，日志末尾留下写了一半的记录
+        wal_name = max(name for name in os.listdir(root) if name.startswith('wal.'))
+        with open(os.path.join(root, wal_name), 'ab') as f:
+            f.write(b'\x40\x00\x00\x00partial')
+        del vmatchmgr
+
+        recovered = VMatchManager()
+        t0 = time.perf_counter()
+        replay_n = recovered.set_persistence(root, snapshot_interval)
+        elapsed = time.perf_counter() - t0
+        report("recover replay={} working={}".format(replay_n, working_n), replay_n, elapsed)
+        assert _comparable_state(recovered) == expected
+
+        # 恢复后可继续交易，编号不重复
+        _run_trading_day(recovered, n_accounts, 10000, seed=15)
+        recovered.stop()
+
+
+def _collect_ids(vmatchmgr, n_events, seed):
+    """模拟交易日，返回按回报顺序的 (报单编号, 成交编号) 列表"""
+    ids = []
+    vmatchmgr.set_trade_callback(lambda userdata, trade: ids.append((trade.orderSysID, trade.tradeID)), None)
+    _run_trading_day(vmatchmgr, 50, n_events, seed)
+    return ids
+
+
+def bench_ids(n_threads=4, n_ids=200000, n_events=50000):
+    """编号分配：多线程无竞争分配且不重复；指定 seed 时重放编号完全相同，分片之间不重复"""
+    # 多线程：各线程一个分配器，共用一个来源，只在取编号段时加锁
+    source = IDSource(seed=0, block_size=10000)
+    results = [None] * n_threads
+
+    def alloc_block(i):
+        allocator = IDAllocator(source)
+        results[i] = [allocator.next_id() for _ in range(n_ids)]
+
+    # 对照：所有线程共用一个加锁的计数器
+    lock = threading.Lock()
+    counter = [0]
+
+    def alloc_locked(i):
+        values = []
+        for _ in range(n_ids):
+            with lock:
+                counter[0] += 1
+                values.append(counter[0])
+        results[i] = values
+
+    for name, target in (("locked counter", alloc_locked), ("block allocator", alloc_block)):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(n_threads)]
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report("{} threads={}".format(name, n_threads), n_threads * n_ids, time.perf_counter() - t0)
+        all_ids = [value for values in results for value in values]
+        assert len(set(all_ids)) == len(all_ids)
+
+    # 可复现：相同 seed 的两次回放编号完全相同
+    first = _collect_ids(VMatchManager(id_source=IDSource(seed=15)), n_events, seed=15)
+    second = _collect_ids(VMatchManager(id_source=IDSource(seed=15)), n_events, seed=15)
+    assert first and first == second
+    print("{:<40} trades={} identical".format("seeded replay", len(first)))
+
+    # 分片：各分片编号交错，两次运行相同且互不重复
+    runs = []
+    for _ in range(2):
+        vmatchmgr = ShardedVMatchManager(n_workers=2, batch_size=256, id_seed=15)
+        runs.append(_collect_ids(vmatchmgr, n_events, seed=15))
+        vmatchmgr.stop()
+    assert runs[0] and runs[0] == runs[1]
+    trade_ids = [trade_id for _, trade_id in runs[0]]
+    assert len(set(trade_ids)) == len(trade_ids)
+    print("{:<40} trades={} identical, unique".format("sharded replay workers=2", len(runs[0])))
+
+
+def make_position(btSymbol="rb1905", multiplier=10):
+    """构造一个 VPosition2 持仓"""
+    contract = SimpleNamespace(btSymbol=btSymbol, symbol=btSymbol, exchange="SHFE", name=btSymbol,
+                               multiplier=multiplier, priceTick=1.0)
+    pos = VPosition2("bench", contract)
+    pos.logPrefix = ''
+    pos.update_margin_rate(SimpleNamespace(btSymbol=btSymbol, longMarginRatioByMoney=0.1,
+                                           shortMarginRatioByMoney=0.1))
+    return pos
+
+
+def make_trade(btSymbol, direction, offset, price, volume, trade_id, trading_day="2019-01-03"):
+    """构造一笔成交回报"""
+    trade = BtTradeData()
+    trade.gatewayName = "BENCH"
+    trade.accountID = "bench"
+    trade.symbol = btSymbol
+    trade.exchange = "SHFE"
+    trade.btSymbol = btSymbol
+    trade.tradeID = str(trade_id)
+    trade.direction = direction
+    trade.offset = offset
+    trade.price = price
+    trade.volume = volume
+    trade.tradingDay = trading_day
+    trade.tradeTime = "09:30:00"
+    return trade
+
+
+def _scan_position_price(pos, direction):
+    """遍历持仓明细计算持仓均价（原 calculate_position_price 的实现）"""
+    positionPrice = 0.0
+    totalVolume = 0
+    for posDetail in pos.positionDetails:
+        if direction != posDetail.direction:
+            continue
+        totalVolume += posDetail.volume
+        positionPrice += posDetail.positionPrice * posDetail.volume
+    if totalVolume > 0:
+        positionPrice = positionPrice / totalVolume
+    return positionPrice
+
+
+def _random_position_trades(pos, rnd, n_steps):
+    """随机开平仓（含昨仓明细、平今），逐步生成成交"""
+    trade_id = 0
+    for direction in (DIRECTION_LONG, DIRECTION_SHORT):
+        for _ in range(rnd.randint(0, 3)):
+            posDetail = BtPositionDetailData()
+            posDetail.btSymbol = pos.btSymbol
+            posDetail.direction = direction
+            posDetail.volume = rnd.randint(1, 20)
+            posDetail.positionPrice = 4000 + rnd.randint(-100, 100) + rnd.random()
+            posDetail.positionDate = POSITION_DATE_YESTERDAY
+            pos.update_position_by_detail(posDetail)
+            yield None
+
+    for _ in range(n_steps):
+        trade_id += 1
+        direction = rnd.choice((DIRECTION_LONG, DIRECTION_SHORT))
+        # 平仓单的方向与被平的持仓相反
+        held = pos.short_pos if direction == DIRECTION_LONG else pos.long_pos
+        if held > 0 and rnd.random() < 0.45:
+            offset = rnd.choice((OFFSET_CLOSE, OFFSET_CLOSE, OFFSET_CLOSETODAY))
+            volume = rnd.randint(1, held)
+        else:
+            offset = OFFSET_OPEN
+            volume = rnd.randint(1, 10)
+        price = 4000 + rnd.randint(-100, 100) + rnd.choice((0.0, 0.2, 0.5, rnd.random()))
+        pos.process_order_trade(make_trade(pos.btSymbol, direction, offset, price, volume, trade_id))
+        yield direction, offset
+
+
+def bench_position_price(n_cases=300, n_steps=200, n_lots=2000):
+    """持仓均价：按明细汇总增量维护，与遍历明细的结果一致，平仓时不再遍历"""
+    # 随机性质检验：每一步两种计算结果相同
+    checks = 0
+    for case in range(n_cases):
+        rnd = random.Random(case)
+        pos = make_position()
+        for _ in _random_position_trades(pos, rnd, n_steps):
+            for direction in (DIRECTION_LONG, DIRECTION_SHORT):
+                expected = _scan_position_price(pos, direction)
+                actual = pos.calculate_position_price(direction)
+                assert abs(actual - expected) <= 1e-9 * max(1.0, abs(expected)), \
+                    "case {} {}: {} != {}".format(case, direction, actual, expected)
+                checks += 1
+    print("{:<40} cases={} checks={} equal".format("position price property", n_cases, checks))
+
+    # 持有大量开仓明细时逐笔平仓
+    for name, rescan in (("rescan", True), ("aggregate", False)):
+        pos = make_position()
+        if rescan:
+            pos.calculate_position_price = lambda direction: _scan_position_price(pos, direction)
+        for i in range(n_lots):
+            pos.process_order_trade(make_trade("rb1905", DIRECTION_LONG, OFFSET_OPEN, 4000 + i % 50, 1, i))
+            pos.process_order_trade(make_trade("rb1905", DIRECTION_SHORT, OFFSET_OPEN, 4000 + i % 50, 1, i))
+        t0 = time.perf_counter()
+        for i in range(n_lots // 2):
+            pos.process_order_trade(make_trade("rb1905", DIRECTION_SHORT, OFFSET_CLOSE, 4010, 1, n_lots + i))
+        report("close lots={} {}".format(n_lots, name), n_lots // 2, time.perf_counter() - t0)
+
+
+def _close_detail_list(details, trade, multiplier):
+    """在持仓明细列表上平仓（原 close_position_detail_data 的实现），返回 (平仓盈亏, 保证金)"""
+    margin = 0.0
+    realizedPnl = 0.0
+    volume = trade.volume
+    removes = []
+    for posDetail in details:
+        if trade.direction == posDetail.direction:
+            continue
+        if trade.offset == OFFSET_CLOSETODAY and posDetail.positionDate == POSITION_DATE_YESTERDAY:
+            continue
+        if volume < posDetail.volume:
+            closedVolume = volume
+            posDetail.volume -= volume
+            volume = 0
+        else:
+            closedVolume = posDetail.volume
+            volume -= posDetail.volume
+            removes.append(posDetail)
+        margin += posDetail.margin
+        if posDetail.direction == DIRECTION_LONG:
+            realizedPnl += (trade.price - posDetail.positionPrice) * closedVolume * multiplier
+        else:
+            realizedPnl += (posDetail.positionPrice - trade.price) * closedVolume * multiplier
+        if volume <= 0:
+            break
+    for posDetail in removes:
+        details.remove(posDetail)
+    return realizedPnl, margin
+
+
+def bench_close_lots(n_lots=10000, n_yd_lots=1000):
+    """持仓明细按方向、今/昨仓分队列，逐笔平掉大量开仓明细，结果与原列表实现一致"""
+    rnd = random.Random(n_lots)
+    pos = make_position()
+    for i in range(n_yd_lots):
+        posDetail = BtPositionDetailData()
+        posDetail.btSymbol = pos.btSymbol
+        posDetail.direction = (DIRECTION_LONG, DIRECTION_SHORT)[i % 2]
+        posDetail.volume = rnd.randint(1, 3)
+        posDetail.positionPrice = 4000.0 + rnd.randint(-50, 50)
+        posDetail.positionDate = POSITION_DATE_YESTERDAY
+        pos.update_position_by_detail(posDetail)
+    for i in range(n_lots):
+        direction = (DIRECTION_LONG, DIRECTION_SHORT)[i % 2]
+        pos.process_order_trade(make_trade(pos.btSymbol, direction, OFFSET_OPEN, 4000.0 + rnd.randint(-50, 50),
+                                           rnd.randint(1, 3), i))
+    details = [copy(posDetail) for posDetail in pos.positionDetails]
+    # 原实现按加入顺序平仓：先加入的昨仓在前
+    details.sort(key=lambda posDetail: posDetail.positionDate != POSITION_DATE_YESTERDAY)
+
+    trades = []
+    remaining = {DIRECTION_LONG: pos.long_pos, DIRECTION_SHORT: pos.short_pos}
+    while any(remaining.values()):
+        held = rnd.choice([direction for direction, volume in remaining.items() if volume])
+        volume = min(remaining[held], rnd.randint(1, 5))
+        remaining[held] -= volume
+        direction = DIRECTION_SHORT if held == DIRECTION_LONG else DIRECTION_LONG
+        trades.append(make_trade(pos.btSymbol, direction, OFFSET_CLOSE, 4000.0 + rnd.randint(-50, 50), volume,
+                                 n_lots + len(trades)))
+
+    t0 = time.perf_counter()
+    expected = [_close_detail_list(details, trade, pos.multiplier) for trade in trades]
+    report("close lots={} list".format(n_lots + n_yd_lots), len(trades), time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    actual = [pos.close_position_detail_data(trade) for trade in trades]
+    report("close lots={} deque".format(n_lots + n_yd_lots), len(trades), time.perf_counter() - t0)
+
+    assert not pos.positionDetails and not details
+    for (pnl, margin), (expected_pnl, expected_margin) in zip(actual, expected):
+        assert abs(pnl - expected_pnl) < 1e-6 and abs(margin - expected_margin) < 1e-6
+
+    # 平今跳过昨仓，不随昨仓数量变慢
+    for n_yd in (0, 100000):
+        pos = make_position()
+        for i in range(n_yd):
+            posDetail = BtPositionDetailData()
+            posDetail.btSymbol = pos.btSymbol
+            posDetail.direction = DIRECTION_LONG
+            posDetail.volume = 1
+            posDetail.positionPrice = 4000.0
+            posDetail.positionDate = POSITION_DATE_YESTERDAY
+            pos.update_position_by_detail(posDetail)
+        for i in range(n_lots):
+            pos.process_order_trade(make_trade(pos.btSymbol, DIRECTION_LONG, OFFSET_OPEN, 4000.0, 1, i))
+        t0 = time.perf_counter()
+        for i in range(n_lots):
+            pos.close_position_detail_data(make_trade(pos.btSymbol, DIRECTION_SHORT, OFFSET_CLOSETODAY,
+                                                      4001.0, 1, n_lots + i))
+        report("close today lots={} yd={}".format(n_lots, n_yd), n_lots, time.perf_counter() - t0)
+
+
+class _EagerLogPosition(VPosition2):
+    """对照：先格式化日志再判断是否输出（原 pos_log 调用方式）"""
+    def pos_log(self, level, fmt, *args):
+        content = fmt.format(*args)
+        if vposition.log:
+            vposition.log.async_log(level, self.logPrefix + content)
+
+
+def bench_position_log(n_trades=50000):
+    """持仓日志：关闭/环形缓冲/输出时每笔成交的开销"""
+    sink = []
+    stub_log = SimpleNamespace(async_log=lambda level, content: sink.append(content))
+    # (名称, 持仓类, 全局 log, 输出级别, 环形缓冲大小)
+    modes = [("eager format, log off", _EagerLogPosition, None, LEVEL_INFO, 0),
+             ("lazy, log off", VPosition2, None, LEVEL_INFO, 0),
+             ("lazy, ring buffer", VPosition2, None, LEVEL_INFO, 4096),
+             ("lazy, log on info", VPosition2, stub_log, LEVEL_INFO, 0),
+             ("lazy, log on debug", VPosition2, stub_log, LEVEL_DEBUG, 0)]
+    saved_log = vposition.log
+    outputs = {}
+    try:
+        for name, cls, log, level, ring_size in modes:
+            contract = SimpleNamespace(btSymbol="rb1905", symbol="rb1905", exchange="SHFE", name="rb1905",
+                                       multiplier=10, priceTick=1.0)
+            pos = cls("bench", contract)
+            pos.update_margin_rate(SimpleNamespace(btSymbol="rb1905", longMarginRatioByMoney=0.1,
+                                                   shortMarginRatioByMoney=0.1))
+            pos.set_log_prefix("[bench] ")
+            pos.set_log_level(level)
+            pos.enable_log_ring(ring_size)
+            vposition.log = log
+            trades = []
+            for i in range(n_trades // 2):
+                trades.append(make_trade("rb1905", DIRECTION_LONG, OFFSET_OPEN, 4000.0 + i % 7, 1, 2 * i))
+                trades.append(make_trade("rb1905", DIRECTION_SHORT, OFFSET_CLOSE, 4001.0 + i % 5, 1, 2 * i + 1))
+            del sink[:]
+            t0 = time.perf_counter()
+            for trade in trades:
+                if trade.offset != OFFSET_OPEN:
+                    pos.process_order_req(trade.direction, trade.offset, trade.volume)
+                pos.process_order_trade(trade)
+            elapsed = time.perf_counter() - t0
+            print("{:<40} {:>8.2f}us/trade lines={} ring={}".format(
+                "position log " + name, elapsed / n_trades * 1e6, len(sink), len(pos.logRing or ())))
+            outputs[name] = pos.dump_log_ring() if ring_size else sink[-4096:]
+        # 环形缓冲按需格式化的内容与全部输出时的最后几条相同
+        assert [content for _, content in outputs["lazy, ring buffer"]] == outputs["lazy, log on debug"]
+    finally:
+        vposition.log = saved_log
+
+
+def bench_portfolio(n_symbols=5000, n_ticks=200, n_trades=20000):
+    """组合盯市：一批最新价一次向量化计算，与逐个 VPosition2.process_tick_updated 结果一致"""
+    rnd = random.Random(n_symbols)
+    margin_rate = SimpleNamespace(btSymbol='', longMarginRatioByMoney=0.1, shortMarginRatioByMoney=0.12)
+    portfolio = VPortfolio("bench")
+    plain = []
+    for i in range(n_symbols):
+        btSymbol = "S{:05d}".format(i)
+        contract = SimpleNamespace(btSymbol=btSymbol, symbol=btSymbol, exchange="SHFE", name=btSymbol,
+                                   multiplier=rnd.choice((1, 5, 10, 100)), priceTick=1.0)
+        margin_rate.btSymbol = btSymbol
+        portfolio.add_position(contract, margin_rate)
+        pos = VPosition2("bench", contract)
+        pos.update_margin_rate(margin_rate)
+        plain.append(pos)
+
+    # 两边按相同成交建仓
+    for i in range(n_trades):
+        k = rnd.randrange(n_symbols)
+        pos = plain[k]
+        direction = rnd.choice((DIRECTION_LONG, DIRECTION_SHORT))
+        held = pos.short_pos if direction == DIRECTION_LONG else pos.long_pos
+        offset = OFFSET_CLOSE if held and rnd.random() < 0.3 else OFFSET_OPEN
+        volume = rnd.randint(1, held) if offset == OFFSET_CLOSE else rnd.randint(1, 10)
+        trade = make_trade(pos.btSymbol, direction, offset, 100.0 + rnd.randint(0, 100), volume, i)
+        pos.process_order_trade(trade)
+        portfolio.positions[k].process_order_trade(trade)
+
+    ticks = [[100.0 + rnd.randint(0, 100) for _ in range(n_symbols)] for _ in range(n_ticks)]
+
+    t0 = time.perf_counter()
+    for prices in ticks:
+        for pos, price in zip(plain, prices):
+            pos.process_tick_updated(price)
+    report("mark to market per position x{}".format(n_symbols), n_ticks, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for prices in ticks:
+        portfolio.update_prices(prices)
+    report("mark to market vectorized x{}".format(n_symbols), n_ticks, time.perf_counter() - t0)
+
+    # 部分合约的行情
+    subset = portfolio.btSymbols[::7]
+    indexes = portfolio.get_indexes(subset)
+    t0 = time.perf_counter()
+    for prices in ticks:
+        portfolio.update_prices(np.asarray(prices)[indexes], indexes=indexes)
+    report("mark to market vectorized subset x{}".format(len(subset)), n_ticks, time.perf_counter() - t0)
+    for prices in ticks:
+        for k in indexes:
+            plain[k].process_tick_updated(prices[k])
+
+    total_pnl = 0.0
+    for pos, view in zip(plain, portfolio.positions):
+        for getter in ("get_position_long", "get_position_short"):
+            expected, actual = vars(getattr(pos, getter)()), vars(getattr(view, getter)())
+            assert expected.keys() == actual.keys()
+            for key, value in expected.items():
+                if isinstance(value, float):
+                    assert abs(value - actual[key]) <= 1e-6 * max(1.0, abs(value)), (pos.btSymbol, key)
+                else:
+                    assert value == actual[key] and type(value) is type(actual[key]), (pos.btSymbol, key)
+        assert pos.tickUpdateN == view.tickUpdateN
+        total_pnl += pos.get_position_pnl()
+    assert abs(total_pnl - portfolio.get_position_pnl()) <= 1e-6 * max(1.0, abs(total_pnl))
+    print("{:<40} positions={} pnl={:.2f} net exposure={:.2f} market margin={:.2f}".format(
+        "portfolio equal", n_symbols, portfolio.get_position_pnl(), portfolio.get_net_exposure(),
+        portfolio.get_market_margin()))
+
+
+def bench_lazy_pnl(n_symbols=200, n_ticks=500000, snapshot_interval=20000, trade_ratio=0.005):
+    """持仓盈亏懒计算：行情只记最新价，快照读取时才计算，结果与逐笔计算一致"""
+    rnd = random.Random(n_symbols)
+    events = []
+    for i in range(n_ticks):
+        k = rnd.randrange(n_symbols)
+        if rnd.random() < trade_ratio:
+            events.append((k, make_trade("S{:04d}".format(k), DIRECTION_LONG, OFFSET_OPEN,
+                                         3000.0 + rnd.randint(0, 50), rnd.randint(1, 5), i)))
+        else:
+            events.append((k, 3000.0 + rnd.randint(0, 50)))
+
+    snapshots = {}
+    for lazy in (False, True):
+        positions = [make_position("S{:04d}".format(k)) for k in range(n_symbols)]
+        for pos in positions:
+            pos.set_lazy_pnl(lazy)
+        snapshots[lazy] = snaps = []
+        t0 = time.perf_counter()
+        for i, (k, data) in enumerate(events, 1):
+            if isinstance(data, float):
+                positions[k].process_tick_updated(data)
+            else:
+                positions[k].process_order_trade(data)
+            if i % snapshot_interval == 0:
+                snaps.append([pos.to_dict() for pos in positions])
+        report("position ticks lazy={}".format(lazy), n_ticks, time.perf_counter() - t0)
+        calc_n = sum(pos.pnlCalcN for pos in positions)
+        skip_n = sum(pos.pnlSkipN for pos in positions)
+        print("{:<40} ticks={} pnl calcs={} saved={}".format(
+            "pnl recompute lazy={}".format(lazy), sum(pos.tickUpdateN for pos in positions), calc_n, skip_n))
+    assert snapshots[False] == snapshots[True]
+    print("{:<40} snapshots={} identical".format("lazy pnl equal", len(snapshots[True])))
+
+
+class _LinearVMatch(VMatch):
+    """逐个撮合全部挂单的 VMatch（排序挂单之前的实现），用于对比"""
+    def on_new_tick(self, tick):
+        self._process_new_orders()
+        orders = self._get_working_orders(tick.btSymbol)
+        if not orders:
+            return
+        trade_infos = []
+        match_by_tick = self.vmatch_engine.match_by_tick
+        for order in list(orders):
+            match_by_tick(order, tick, trade_infos)
+        self.vmatch_engine.last_mds[tick.btSymbol] = tick
+        self._process_trade_infos(orders, trade_infos)
+
+
+def bench_resting(n_orders=50000, n_ticks=200, depths=(1, 5)):
+    """大量远离盘口的挂单：每笔tick只撮合价格可成交的挂单，与逐个撮合全部挂单的结果一致（多档）"""
+    for depth in depths:
+        outputs = {}
+        for cls in (_LinearVMatch, VMatch):
+            rnd = random.Random(depth)
+            id_source = IDSource(seed=21)
+            vmatch = cls(is_future=True, sysids=IDAllocator(id_source), trade_ids=IDAllocator(id_source))
+            vmatch.set_trading_day("2019-01-03")
+            vmatch.vmatch_engine.set_tick_depth(depth)
+            outputs[cls] = records = []
+            vmatch.set_rtn_func(lambda userdata, order: records.append(order),
+                                lambda userdata, trade: records.append(trade), None, raw=True)
+            # 买单挂在盘口下方、卖单挂在上方，大部分远离盘口
+            for i in range(n_orders):
+                if i % 2:
+                    price = 4000 - int(rnd.expovariate(1 / 200.0)) - 1
+                    vmatch.req_input_order(make_order_req("bench", "rb1905", DIRECTION_LONG, price, rnd.randint(1, 10)))
+                else:
+                    price = 4000 + int(rnd.expovariate(1 / 200.0)) + 1
+                    vmatch.req_input_order(make_order_req("bench", "rb1905", DIRECTION_SHORT, price, rnd.randint(1, 10)))
+            vmatch._process_new_orders()
+            del records[:]
+
+            mid = 4000
+            elapsed = 0.0
+            for t in range(n_ticks):
+                mid += rnd.choice((-2, -1, 0, 1, 2))
+                tick = make_depth_tick("rb1905", mid, max(depth, 2), rnd, (t + 1) * 50)
+                # 每笔tick一个FAK单
+                order_req = make_order_req("bench", "rb1905", rnd.choice((DIRECTION_LONG, DIRECTION_SHORT)),
+                                           mid + rnd.randint(-3, 3), rnd.randint(1, 5))
+                order_req.priceType = PRICETYPE_FAK
+                vmatch.req_input_order(order_req)
+                t0 = time.perf_counter()
+                vmatch.on_new_tick(tick)
+                elapsed += time.perf_counter() - t0
+            name = "linear" if cls is _LinearVMatch else "sorted"
+            report("resting depth={} {} records={}".format(depth, name, len(records)), n_ticks, elapsed)
+        if depth > 1:
+            assert outputs[_LinearVMatch] == outputs[VMatch]
+            print("{:<40} records={} identical".format("resting depth={} equal".format(depth), len(outputs[VMatch])))
+
+
+class _PerInfoVMatch(VMatch):
+    """逐条成交信息移除挂单的 VMatch（一次性压缩之前的实现，部分成交的继续挂单），用于对比回调顺序"""
+    def _process_trade_infos(self, orders, trade_infos):
+        for trade_info in trade_infos:
+            order = trade_info.order
+            if order.status != STATUS_PARTTRADED:
+                try:
+                    orders.remove(order)
+                    self._remove_working_order(order)
+                except ValueError:
+                    pass
+            traded_order = trade_info.traded_order
+            self.journal.append_order(traded_order)
+            trade = self.gen_trade_record(trade_info) if trade_info.trade_volume else None
+            if trade:
+                self.journal.append_trade(trade)
+            if self.rtn_order_func:
+                self.rtn_order_func(self.rtn_userdata, traded_order)
+            if self.rtn_trade_func and trade:
+                self.rtn_trade_func(self.rtn_userdata, trade)
+
+
+def bench_compact(sizes=(10000, 50000), n_bars=100):
+    """每根bar/每笔tick有数千笔成交：撮合结束的订单一次性移除，回调顺序与逐条移除相同"""
+    for n_orders in sizes:
+        outputs = {}
+        for cls in (_PerInfoVMatch, VMatch):
+            rnd = random.Random(n_orders)
+            id_source = IDSource(seed=22)
+            vmatch = cls(is_future=True, sysids=IDAllocator(id_source), trade_ids=IDAllocator(id_source))
+            vmatch.set_trading_day("2019-01-03")
+            vmatch.vmatch_engine.set_tick_depth(5)
+            outputs[cls] = records = []
+            vmatch.set_rtn_func(lambda userdata, order: records.append(order),
+                                lambda userdata, trade: records.append(trade), None, raw=True)
+            for i in range(n_orders):
+                direction = DIRECTION_LONG if i % 2 else DIRECTION_SHORT
+                vmatch.req_input_order(make_order_req("bench", "rb1905", direction, 4000 + rnd.randint(-100, 100),
+                                                      rnd.randint(1, 20)))
+            vmatch._process_new_orders()
+            del records[:]
+
+            close = 4000
+            elapsed = 0.0
+            for t in range(n_bars):
+                close += rnd.randint(-30, 30)
+                if t % 2:
+                    md = make_depth_tick("rb1905", close, 5, rnd, (t + 1) * 1000)
+                    for i in range(1, 6):
+                        setattr(md, "askVolume%d" % i, rnd.randint(100, 1000))
+                        setattr(md, "bidVolume%d" % i, rnd.randint(100, 1000))
+                    on_new_md = vmatch.on_new_tick
+                else:
+                    md = BtBarData()
+                    md.btSymbol = "rb1905"
+                    md.date, md.time = "2019-01-03", "09:{:02d}:00".format(t % 60)
+                    md.close, md.volume = close, 400
+                    on_new_md = vmatch.on_new_bar
+                # 补充新挂单
+                for i in range(n_orders // 50):
+                    direction = DIRECTION_LONG if i % 2 else DIRECTION_SHORT
+                    vmatch.req_input_order(make_order_req("bench", "rb1905", direction,
+                                                          close + rnd.randint(-100, 100), rnd.randint(1, 20)))
+                t0 = time.perf_counter()
+                on_new_md(md)
+                elapsed += time.perf_counter() - t0
+            name = "per info" if cls is _PerInfoVMatch else "compact"
+            report("fills resting={} {} records={}".format(n_orders, name, len(records)), n_bars, elapsed)
+        assert outputs[_PerInfoVMatch] == outputs[VMatch]
+        print("{:<40} records={} identical".format("compact resting={} equal".format(n_orders), len(outputs[VMatch])))
+
+
+def _run_batch_returns(mode, n_accounts, n_ticks, seed):
+    """每笔tick所有账户各报一笔FAK单，返回 (回报键序列, 耗时, 回调次数)"""
+    rnd = random.Random(seed)
+    vmatchmgr = VMatchManager(id_source=IDSource(seed=23))
+    vmatchmgr.set_trading_day("2019-01-03")
+    vmatchmgr.set_tick_depth(5)
+    keys = []
+    calls = [0]
+
+    def on_order(userdata, order):
+        calls[0] += 1
+        keys.append(('O', order.orderSysID, order.status, order.tradedVolume))
+
+    def on_trade(userdata, trade):
+        calls[0] += 1
+        keys.append(('T', trade.tradeID, trade.price, trade.volume))
+
+    def on_batch(userdata, returns):
+        calls[0] += 1
+        keys.extend(('T', r.tradeID, r.price, r.volume) if isinstance(r, TradeRecord) else
+                    ('O', r.orderSysID, r.status, r.tradedVolume) for r in returns)
+
+    if mode == "per event":
+        vmatchmgr.set_order_callback(on_order, None)
+        vmatchmgr.set_trade_callback(on_trade, None)
+    else:
+        vmatchmgr.set_batch_callback(on_batch, None)
+    if mode == "batch async":
+        vmatchmgr.start()
+
+    events = []
+    for t in range(n_ticks):
+        for i in range(n_accounts):
+            order_req = make_order_req("A{:05d}".format(i), "rb1905", rnd.choice((DIRECTION_LONG, DIRECTION_SHORT)),
+                                       4000 + rnd.randint(-3, 3), rnd.randint(1, 5))
+            order_req.priceType = PRICETYPE_FAK
+            events.append((EV_REQ_ORDER, order_req))
+        tick = make_depth_tick("rb1905", 4000, 5, rnd, (t + 1) * 1000)
+        events.append((EV_TICK, tick))
+
+    t0 = time.perf_counter()
+    for ev_type, data in events:
+        if ev_type == EV_TICK:
+            vmatchmgr.on_new_tick(data)
+        else:
+            vmatchmgr.req_input_order(data)
+    vmatchmgr.stop()
+    return keys, time.perf_counter() - t0, calls[0]
+
+
+def bench_batch_returns(n_accounts=2000, n_ticks=50):
+    """批量回报：每笔tick的全部回报一次回调，与逐笔回调的回报及顺序相同"""
+    outputs = {}
+    for mode in ("per event", "batch", "batch async"):
+        keys, elapsed, calls = _run_batch_returns(mode, n_accounts, n_ticks, seed=23)
+        report("returns {} calls={}".format(mode, calls), len(keys), elapsed)
+        outputs[mode] = keys
+    assert outputs["per event"] == outputs["batch"] == outputs["batch async"]
+    print("{:<40} returns={} identical".format("batch returns equal", len(outputs["batch"])))
+
+
+def _run_order_entry(batched, n_accounts, n_orders, seed):
+    """开盘调仓：各账户已有持仓，一次提交大量开/平仓单，返回 (委托确认, 各账户冻结量, 耗时)"""
+    rnd = random.Random(seed)
+    symbols = ["S{:03d}".format(i) for i in range(50)]
+    vmatchmgr = VMatchManager(id_source=IDSource(seed=24))
+    vmatchmgr.set_trading_day("2019-01-03")
+    acks = []
+    vmatchmgr.set_batch_callback(lambda userdata, returns: acks.append(returns), None)
+    for i in range(n_accounts):
+        vmatch = vmatchmgr._get_vmatch("A{:04d}".format(i))
+        for symbol in symbols:
+            simpos = SimPosition(10, True)
+            simpos.long_share = simpos.short_share = 20
+            vmatch.pos_dicts[symbol] = simpos
+
+    order_reqs = []
+    for i in range(n_orders):
+        offset = OFFSET_OPEN if rnd.random() < 0.5 else OFFSET_CLOSE
+        order_reqs.append(make_order_req("A{:04d}".format(rnd.randrange(n_accounts)), rnd.choice(symbols),
+                                         rnd.choice((DIRECTION_LONG, DIRECTION_SHORT)), 4000 + rnd.randint(-50, 50),
+                                         rnd.randint(1, 5), offset))
+
+    # 同 timeit，计时期间关闭GC，避免两种方式因先后运行而受GC影响不同
+    gc.collect()
+    gc.disable()
+    t0 = time.perf_counter()
+    if batched:
+        vmatchmgr.req_input_orders(order_reqs)
+    else:
+        for order_req in order_reqs:
+            vmatchmgr.req_input_order(order_req)
+        # 单笔订单在下一笔行情到达时处理
+        vmatchmgr.on_new_tick(make_tick("none", 4000, 0))
+    elapsed = time.perf_counter() - t0
+    gc.enable()
+    frozen = {(accountID, symbol): (simpos.long_frozen, simpos.short_frozen)
+              for accountID, vmatch in vmatchmgr.vmatch_dicts.items() for symbol, simpos in vmatch.pos_dicts.items()}
+    return acks, frozen, elapsed
+
+
+def bench_order_entry(n_accounts=500, n_orders=100000):
+    """批量报单：按账户、合约分组检查可平仓位并冻结，一次批量回报，结果与逐笔报单相同"""
+    outputs = {}
+    for batched in (False, True):
+        acks, frozen, elapsed = _run_order_entry(batched, n_accounts, n_orders, seed=24)
+        rejected = sum(1 for returns in acks for record in returns if record.status == STATUS_REJECTED)
+        report("order entry batched={} callbacks={} rejected={}".format(batched, len(acks), rejected),
+               n_orders, elapsed)
+        outputs[batched] = ([record for returns in acks for record in returns], frozen)
+    assert outputs[False] == outputs[True]
+    print("{:<40} acks={} identical".format("order entry equal", len(outputs[True][0])))
+
+
+BENCHES = {
+    'order_book': bench_order_book,
+    'cancel': bench_cancel,
+    'dispatch': bench_dispatch,
+    'bar_replay': bench_bar_replay,
+    'csv_ticks': bench_csv_ticks,
+    'tick_store': bench_tick_store,
+    'sharded': bench_sharded,
+    'async_frontend': bench_async_frontend,
+    'server': bench_server,
+    'depth': bench_depth,
+    'shared_liquidity': bench_shared_liquidity,
+    'records': bench_records,
+    'journal': bench_journal,
+    'recovery': bench_recovery,
+    'ids': bench_ids,
+    'position_price': bench_position_price,
+    'close_lots': bench_close_lots,
+    'position_log': bench_position_log,
+    'portfolio': bench_portfolio,
+    'lazy_pnl': bench_lazy_pnl,
+    'resting': bench_resting,
+    'compact': bench_compact,
+    'batch_returns': bench_batch_returns,
+    'order_entry': bench_order_entry,
+    'merge_files': bench_merge_files,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES.keys())
+    for name in names:
+        print("==== {} ====".format(name))
+        BENCHES[name]()
@@ -0,0 +1,698 @@
+# encoding: UTF-8
+#
+# Copyright 2018 BigQuant, Inc.
+#
+# 实时模拟撮合服务：asyncio 实现的 HTTP/WebSocket 接口，撮合由 VMatchManager 完成
+#
+# WebSocket (GET /ws)，消息均为 json 文本：
+#   请求: {"type": "order", "reqID": 1, "accountID": ..., "btSymbol": ..., "direction": ..., "price": ..., "volume": ...,
+#          "offset": ..., "priceType": ...}   offset/priceType 缺省为开仓/限价
+#         {"type": "cancel", "reqID": 2, "accountID": ..., "btSymbol": ..., "orderSysID": ...}
+#         {"type": "tick", "btSymbol": ..., "lastPrice": ..., "volume": ..., "askPrice1": ..., ...}
+#         {"type": "tradingDay", "tradingDay": "2019-01-03"}
+#         {"type": "subscribe", "accountID": ...}
+#   推送: {"type": "ack", "reqID": 1, "result": ...}
+#         {"type": "rtnOrder", "data": {...}}, {"type": "rtnTrade", "data": {...}}
+#         {"type": "error", "reqID": 1, "msg": ...}
+# HTTP: POST /order, /cancel, /tick, /tradingDay 请求体同上，返回 ack；GET /stats 返回服务统计
+#
+
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import os
+import re
+import struct
+import sys
+import time
+
+from bigtrader.btConstant import *
+from bigtrader.btObject import BtOrderReq, BtCancelOrderReq, BtTickData
+
+from btVMatch import VMatchManager, TICK_FIELD_TYPES
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_OP_CONT = 0x0
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+WS_MAX_SIZE = 1 << 20
+
+MSG_ORDER = 'order'
+MSG_CANCEL = 'cancel'
+MSG_TICK = 'tick'
+MSG_TRADING_DAY = 'tradingDay'
+MSG_SUBSCRIBE = 'subscribe'
+
+# 请求中不属于订单/行情字段的键
+CONTROL_KEYS = {'type', 'reqID'}
+
+DIRECTIONS = {DIRECTION_LONG, DIRECTION_SHORT}
+OFFSETS = {OFFSET_OPEN, OFFSET_CLOSE, OFFSET_CLOSETODAY, OFFSET_CLOSEYESTERDAY}
+PRICE_TYPES = {PRICETYPE_LIMITPRICE, PRICETYPE_MARKETPRICE, PRICETYPE_FAK, PRICETYPE_FOK}
+
+# 请求中允许的字段（白名单），其余字段拒绝
+ORDER_STR_FIELDS = ('symbol', 'exchange', 'orderID', 'gatewayName', 'brokerID', 'userID')
+ORDER_KEYS = set(ORDER_STR_FIELDS) | {'accountID', 'btSymbol', 'direction', 'offset', 'priceType', 'price', 'volume',
+                                      'multiplier'}
+CANCEL_STR_FIELDS = ('orderSysID', 'orderID', 'btSymbol', 'symbol', 'exchange', 'gatewayName', 'brokerID', 'userID')
+CANCEL_KEYS = set(CANCEL_STR_FIELDS) | {'accountID'}
+TICK_STR_FIELDS = ('symbol', 'exchange', 'gatewayName')
+TICK_DATE_FIELDS = ('date', 'actionDay', 'tradingDay')
+TICK_KEYS = set(TICK_FIELD_TYPES) | set(TICK_STR_FIELDS) | set(TICK_DATE_FIELDS) | {'btSymbol', 'time'}
+DATE_RE = re.compile(r'^\d{4}-?\d{2}-?\d{2}$')
+TIME_RE = re.compile(r'^\d{2}:\d{2}:\d{2}(\.\d{1,6})?$')
+
+
+def _apply_mask(data, mask):
+    """WebSocket 掩码异或"""
+    n = len(data)
+    if not n:
+        return data
+    key = int.from_bytes((mask * (n // 4 + 1))[:n], 'big')
+    return (int.from_bytes(data, 'big') ^ key).to_bytes(n, 'big')
+
+
+def encode_frame(opcode, payload, mask=False):
+    """编码一个 WebSocket 帧，客户端发送的帧需要掩码"""
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, (0x80 if mask else 0) | n)
+    elif n < (1 << 16):
+        header = struct.pack('!BBH', 0x80 | opcode, (0x80 if mask else 0) | 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, (0x80 if mask else 0) | 127, n)
+    if mask:
+        mask_key = os.urandom(4)
+        return header + mask_key + _apply_mask(payload, mask_key)
+    return header + payload
+
+
+async def read_http_head(reader):
+    """读取 HTTP 请求/响应头，返回 (首行, {小写头名: 值})，连接关闭返回 (None, None)"""
+    line = await reader.readline()
+    if not line:
+        return None, None
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return line.decode('latin-1').strip(), headers
+
+
+class WebSocket(object):
+    """基于 asyncio 流的 WebSocket 连接（RFC 6455 的文本消息子集）"""
+    def __init__(self, reader, writer, is_client=False):
+        self.reader = reader
+        self.writer = writer
+        self.is_client = is_client
+        self.closed = False
+
+    @staticmethod
+    def accept_key(key):
+        return base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+
+    @classmethod
+    async def connect(cls, host, port, path='/ws'):
+        """客户端连接"""
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        writer.write(('GET {} HTTP/1.1\r\nHost: {}:{}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n')
+                     .format(path, host, port, key).encode('latin-1'))
+        await writer.drain()
+        status, headers = await read_http_head(reader)
+        if not status or status.split(' ')[1:2] != ['101'] or \
+           headers.get('sec-websocket-accept') != cls.accept_key(key):
+            writer.close()
+            raise ConnectionError("websocket handshake failed: {}".format(status))
+        return cls(reader, writer, is_client=True)
+
+    async def recv(self):
+        """接收一条消息，连接关闭返回 None"""
+        chunks = []
+        while True:
+            try:
+                head = await self.reader.readexactly(2)
+                fin, opcode = head[0] & 0x80, head[0] & 0x0F
+                masked, length = head[1] & 0x80, head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+                if length > WS_MAX_SIZE:
+                    await self.close(1009)
+                    return None
+                mask_key = await self.reader.readexactly(4) if masked else None
+                payload = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                return None
+            if mask_key:
+                payload = _apply_mask(payload, mask_key)
+
+            if opcode == WS_OP_CLOSE:
+                await self.close()
+                return None
+            elif opcode == WS_OP_PING:
+                self.send_frame(WS_OP_PONG, payload)
+                continue
+            elif opcode == WS_OP_PONG:
+                continue
+
+            chunks.append(payload)
+            if fin:
+                return b''.join(chunks).decode('utf-8')
+
+    def send_frame(self, opcode, payload):
+        if not self.closed:
+            self.writer.write(encode_frame(opcode, payload, self.is_client))
+
+    def send(self, text):
+        """发送文本消息（写入缓冲，需调用 drain 等待发送）"""
+        self.send_frame(WS_OP_TEXT, text.encode('utf-8'))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def close(self, code=1000):
+        if self.closed:
+            return
+        self.send_frame(WS_OP_CLOSE, struct.pack('!H', code))
+        self.closed = True
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+def obj_to_dict(obj):
+    """订单/成交对象转为可 json 序列化的字典"""
+    return dict(vars(obj))
+
+
+def _require_str(fields, key):
+    value = fields.get(key)
+    if not isinstance(value, str) or not value:
+        raise ValueError("'{}' must be a non-empty string, got {!r}".format(key, value))
+    return value
+
+
+def _to_str(key, value):
+    """字符串字段，编号类字段可为整数"""
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise ValueError("'{}' must be a string, got {!r}".format(key, value))
+    return str(value)
+
+
+def _to_float(key, value):
+    """数值字段只接受 json 数字，不接受字符串和布尔值"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("'{}' must be a number, got {!r}".format(key, value))
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("'{}' must be finite, got {!r}".format(key, value))
+    return value
+
+
+def _to_int(key, value):
+    number = _to_float(key, value)
+    if number != int(number):
+        raise ValueError("'{}' must be an integer, got {!r}".format(key, value))
+    return int(number)
+
+
+def _to_date(key, value):
+    if not isinstance(value, str) or not DATE_RE.match(value):
+        raise ValueError("'{}' must be a date string like 2019-01-03, got {!r}".format(key, value))
+    return value
+
+
+def _to_time(key, value):
+    if not isinstance(value, str) or not TIME_RE.match(value):
+        raise ValueError("'{}' must be a time string like 09:30:00.500, got {!r}".format(key, value))
+    return value
+
+
+def _check_keys(fields, allowed, what):
+    unknown = [key for key in fields if key not in allowed and key not in CONTROL_KEYS]
+    if unknown:
+        raise ValueError("unknown {} fields {}".format(what, sorted(unknown)))
+
+
+def parse_order_req(fields):
+    """按白名单校验请求字典并转为 BtOrderReq，各字段转换类型，不合法或有未知字段时抛出 ValueError"""
+    _check_keys(fields, ORDER_KEYS, 'order')
+    order_req = BtOrderReq()
+    order_req.accountID = _require_str(fields, 'accountID')
+    order_req.btSymbol = _require_str(fields, 'btSymbol')
+    for key in ORDER_STR_FIELDS:
+        if key in fields:
+            setattr(order_req, key, _to_str(key, fields[key]))
+
+    order_req.direction = fields.get('direction')
+    if order_req.direction not in DIRECTIONS:
+        raise ValueError("invalid direction {!r}".format(order_req.direction))
+    order_req.offset = fields.get('offset', OFFSET_OPEN)
+    if order_req.offset not in OFFSETS:
+        raise ValueError("invalid offset {!r}".format(order_req.offset))
+    order_req.priceType = fields.get('priceType', PRICETYPE_LIMITPRICE)
+    if order_req.priceType not in PRICE_TYPES:
+        raise ValueError("invalid priceType {!r}".format(order_req.priceType))
+
+    order_req.price = _to_float('price', fields.get('price'))
+    if order_req.price < 0:
+        raise ValueError("'price' must not be negative, got {!r}".format(fields['price']))
+    order_req.volume = _to_int('volume', fields.get('volume'))
+    if order_req.volume <= 0:
+        raise ValueError("'volume' must be positive, got {!r}".format(fields['volume']))
+    if 'multiplier' in fields:
+        multiplier = _to_float('multiplier', fields['multiplier'])
+        if multiplier <= 0:
+            raise ValueError("'multiplier' must be positive, got {!r}".format(fields['multiplier']))
+        # 整数乘数保持 int
+        order_req.multiplier = int(multiplier) if multiplier == int(multiplier) else multiplier
+    return order_req
+
+
+def parse_cancel_req(fields):
+    """按白名单校验撤单请求并转为 BtCancelOrderReq"""
+    _check_keys(fields, CANCEL_KEYS, 'cancel')
+    cancel_req = BtCancelOrderReq()
+    cancel_req.accountID = _require_str(fields, 'accountID')
+    for key in CANCEL_STR_FIELDS:
+        if key in fields:
+            setattr(cancel_req, key, _to_str(key, fields[key]))
+    if not cancel_req.orderSysID:
+        raise ValueError("'orderSysID' is required")
+    return cancel_req
+
+
+def parse_tick(fields):
+    """按白名单校验行情并转为 BtTickData，数值字段按 TICK_FIELD_TYPES 转换，日期、时间检查格式"""
+    _check_keys(fields, TICK_KEYS, 'tick')
+    tick = BtTickData()
+    tick.btSymbol = _require_str(fields, 'btSymbol')
+    tick.time = _to_time('time', fields.get('time'))
+    for key, value in fields.items():
+        conv = TICK_FIELD_TYPES.get(key)
+        if conv is not None:
+            value = _to_float(key, value)
+            # 成交量等整数字段同 iter_csv_ticks 取整
+            setattr(tick, key, value if conv is float else int(value))
+        elif key in TICK_DATE_FIELDS:
+            setattr(tick, key, _to_date(key, value))
+        elif key in TICK_STR_FIELDS:
+            setattr(tick, key, _to_str(key, value))
+    return tick
+
+
+class _Session(object):
+    """一个 WebSocket 连接
+    1. 未确认的请求数不超过 max_inflight，超过时暂停读取该连接（背压传递到客户端的 TCP 发送）
+    2. 推送消息进入有界队列由发送任务写出，客户端消费过慢导致队列满时断开该连接
+    """
+    def __init__(self, ws, max_inflight, max_outbound):
+        self.ws = ws
+        self.accounts = set()
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.outbound = asyncio.Queue(maxsize=max_outbound)
+        self.overflow = False
+        self.sender = None
+
+    def push(self, text):
+        if self.overflow:
+            return
+        try:
+            self.outbound.put_nowait(text)
+        except asyncio.QueueFull:
+            # 慢消费者，断开连接
+            self.overflow = True
+            self.outbound = None
+            self.sender.cancel()
+
+    async def send_loop(self):
+        """批量写出推送消息"""
+        ws = self.ws
+        try:
+            while True:
+                outbound = self.outbound
+                ws.send(await outbound.get())
+                while not outbound.empty():
+                    ws.send(outbound.get_nowait())
+                await ws.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            if self.overflow:
+                await ws.close(1008)
+
+
+class VMatchService(object):
+    """实时模拟撮合服务
+    1. 各连接的请求进入同一个入站队列，撮合任务每次唤醒后批量取出（最多 max_batch 个），
+       按到达顺序在事件循环中同步调用 VMatchManager，再批量发出确认
+    2. batch_interval > 0 时，取到第一个请求后再等待该时间以积攒更多请求
+    3. 订单/成交回报按 accountID 推送给订阅该账户的连接，连接下单时自动订阅该账户
+    注意：VMatchManager 在服务的事件循环中同步使用，不要再调用其 start
+    """
+    def __init__(self, vmatchmgr=None, host='127.0.0.1', port=8765, max_batch=1024, batch_interval=0,
+                 max_pending=100000, max_inflight=1000, max_outbound=100000):
+        self.vmatchmgr = vmatchmgr or VMatchManager()
+        self.host = host
+        self.port = port
+        self.max_batch = max(1, max_batch)
+        self.batch_interval = batch_interval
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        self.max_outbound = max_outbound
+
+        self.subscribers = {}   # {accountID: set(_Session)}
+        self.stats = {'requests': 0, 'batches': 0, 'rtnOrders': 0, 'rtnTrades': 0,
+                      'connections': 0, 'slowConsumers': 0}
+
+        self.vmatchmgr.set_order_callback(self.on_rtn_order, self)
+        self.vmatchmgr.set_trade_callback(self.on_rtn_trade, self)
+
+        self.__server = None
+        self.__batcher = None
+        self.__que = None
+        self.__sessions = {}    # {_Session: 连接处理任务}
+
+    async def start(self):
+        """开始监听，port=0 时使用系统分配的端口"""
+        self.__que = asyncio.Queue(maxsize=self.max_pending)
+        self.__batcher = asyncio.ensure_future(self._batch_loop())
+        self.__server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """停止监听，处理完已入队的请求后关闭所有连接"""
+        if self.__server:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+        if self.__sessions:
+            for session in list(self.__sessions.keys()):
+                await session.ws.close(1001)
+            await asyncio.gather(*self.__sessions.values(), return_exceptions=True)
+        if self.__batcher:
+            await self.__que.join()
+            self.__batcher.cancel()
+            self.__batcher = None
+
+    async def serve_forever(self):
+        await self.start()
+        await self.__server.serve_forever()
+
+    async def submit(self, msg_type, fields, reply):
+        """请求入队，入站队列满时等待；reply(result, error) 在撮合任务中调用"""
+        await self.__que.put((msg_type, fields, reply))
+
+    async def _batch_loop(self):
+        """撮合任务：批量取出请求，依次交给 VMatchManager 处理"""
+        que = self.__que
+        while True:
+            batch = [await que.get()]
+            if self.batch_interval > 0:
+                await asyncio.sleep(self.batch_interval)
+            while len(batch) < self.max_batch and not que.empty():
+                batch.append(que.get_nowait())
+
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(batch)
+            for msg_type, fields, reply in batch:
+                try:
+                    result = self.process_request(msg_type, fields)
+                except Exception as e:
+                    reply(None, '{}: {}'.format(type(e).__name__, e))
+                else:
+                    reply(result, None)
+                que.task_done()
+            # 让出执行，发送确认及回报
+            await asyncio.sleep(0)
+
+    def process_request(self, msg_type, fields):
+        """同步处理一个请求，请求先校验，不合法时抛出 ValueError，不会进入 VMatchManager"""
+        vmatchmgr = self.vmatchmgr
+        if msg_type == MSG_ORDER:
+            vmatchmgr.req_input_order(parse_order_req(fields))
+            return True
+        elif msg_type == MSG_CANCEL:
+            return vmatchmgr.req_cancel_order(parse_cancel_req(fields))
+        elif msg_type == MSG_TICK:
+            vmatchmgr.on_new_tick(parse_tick(fields))
+            return True
+        elif msg_type == MSG_TRADING_DAY:
+            vmatchmgr.set_trading_day(_to_date('tradingDay', fields.get('tradingDay')))
+            return True
+        raise ValueError("unknown request type {}".format(msg_type))
+
+    def on_rtn_order(self, userdata, order):
+        """订单回报，订单对象之后还会被修改，立即序列化"""
+        self.stats['rtnOrders'] += 1
+        self._publish(order.accountID, 'rtnOrder', order)
+
+    def on_rtn_trade(self, userdata, trade):
+        """成交回报"""
+        self.stats['rtnTrades'] += 1
+        self._publish(trade.accountID, 'rtnTrade', trade)
+
+    def _publish(self, accountID, msg_type, obj):
+        sessions = self.subscribers.get(accountID)
+        if not sessions:
+            return
+        text = json.dumps({'type': msg_type, 'data': obj_to_dict(obj)}, default=str)
+        for session in list(sessions):
+            session.push(text)
+            if session.overflow:
+                self.stats['slowConsumers'] += 1
+                self._unsubscribe(session)
+
+    def _subscribe(self, session, accountID):
+        if accountID in session.accounts:
+            return
+        session.accounts.add(accountID)
+        try:
+            self.subscribers[accountID].add(session)
+        except KeyError:
+            self.subscribers[accountID] = {session}
+
+    def _unsubscribe(self, session):
+        for accountID in session.accounts:
+            sessions = self.subscribers.get(accountID)
+            if sessions:
+                sessions.discard(session)
+                if not sessions:
+                    del self.subscribers[accountID]
+        session.accounts.clear()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                request_line, headers = await read_http_head(reader)
+                if not request_line:
+                    break
+                method, path = (request_line.split(' ') + ['', ''])[:2]
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self._handle_websocket(reader, writer, headers)
+                    return
+                if not await self._handle_http(reader, writer, method, path, headers):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_http(self, reader, writer, method, path, headers):
+        """处理一个 HTTP 请求，返回连接是否保持"""
+        body = b''
+        length = int(headers.get('content-length', 0) or 0)
+        if length:
+            body = await reader.readexactly(length)
+
+        status, result = '200 OK', None
+        if method == 'GET' and path == '/stats':
+            result = dict(self.stats, pending=self.__que.qsize())
+        elif method == 'POST' and path.lstrip('/') in (MSG_ORDER, MSG_CANCEL, MSG_TICK, MSG_TRADING_DAY):
+            try:
+                fields = json.loads(body.decode('utf-8') or '{}')
+                if not isinstance(fields, dict):
+                    raise ValueError('request body must be a JSON object')
+            except ValueError as e:
+                status, result = '400 Bad Request', {'type': 'error', 'msg': str(e)}
+            else:
+                future = asyncio.get_event_loop().create_future()
+                await self.submit(path.lstrip('/'), fields,
+                                  lambda result, error: future.done() or future.set_result((result, error)))
+                result, error = await future
+                if error:
+                    status, result = '400 Bad Request', {'type': 'error', 'reqID': fields.get('reqID'), 'msg': error}
+                else:
+                    result = {'type': 'ack', 'reqID': fields.get('reqID'), 'result': result}
+        else:
+            status, result = '404 Not Found', {'type': 'error', 'msg': 'not found'}
+
+        payload = json.dumps(result, default=str).encode('utf-8')
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        writer.write(('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                      'Connection: {}\r\n\r\n').format(status, len(payload), 'keep-alive' if keep_alive else 'close')
+                     .encode('latin-1') + payload)
+        await writer.drain()
+        return keep_alive
+
+    async def _handle_websocket(self, reader, writer, headers):
+        key = headers.get('sec-websocket-key')
+        if not key:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+            return
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: {}\r\n\r\n').format(WebSocket.accept_key(key)).encode('latin-1'))
+        await writer.drain()
+
+        ws = WebSocket(reader, writer)
+        session = _Session(ws, self.max_inflight, self.max_outbound)
+        session.sender = asyncio.ensure_future(session.send_loop())
+        self.__sessions[session] = asyncio.current_task()
+        self.stats['connections'] += 1
+        try:
+            while not session.overflow:
+                text = await ws.recv()
+                if text is None:
+                    break
+                try:
+                    fields = json.loads(text)
+                    if not isinstance(fields, dict):
+                        raise ValueError('message must be a JSON object')
+                    msg_type = fields.get('type')
+                except ValueError as e:
+                    session.push(json.dumps({'type': 'error', 'msg': str(e)}))
+                    continue
+
+                if msg_type == MSG_SUBSCRIBE:
+                    if not isinstance(fields.get('accountID'), str):
+                        session.push(json.dumps({'type': 'error', 'reqID': fields.get('reqID'),
+                                                 'msg': "'accountID' must be a string"}))
+                        continue
+                    self._subscribe(session, fields['accountID'])
+                    continue
+                if msg_type in (MSG_ORDER, MSG_CANCEL) and isinstance(fields.get('accountID'), str):
+                    self._subscribe(session, fields['accountID'])
+
+                # 未确认的请求过多时暂停读取
+                await session.inflight.acquire()
+                await self.submit(msg_type, fields, self._make_ws_reply(session, fields.get('reqID')))
+        finally:
+            self._unsubscribe(session)
+            if not session.overflow:
+                # 发送完已入队的推送
+                while session.outbound is not None and not session.outbound.empty() and not ws.closed:
+                    await asyncio.sleep(0)
+                session.sender.cancel()
+                await ws.close()
+            self.__sessions.pop(session, None)
+            self.stats['connections'] -= 1
+
+    @staticmethod
+    def _make_ws_reply(session, reqID):
+        def reply(result, error):
+            session.inflight.release()
+            if error:
+                session.push(json.dumps({'type': 'error', 'reqID': reqID, 'msg': error}))
+            else:
+                session.push(json.dumps({'type': 'ack', 'reqID': reqID, 'result': result}, default=str))
+        return reply
+
+
+############################################################
+async def run_load(host, port, n_clients=4, n_orders=10000, window=200, n_accounts=10, btSymbol='rb1905',
+                   tick_every=100):
+    """本地压测：n_clients 个连接共发送 n_orders 个订单，每个连接最多 window 个未确认请求，
+    第一个连接每发送 tick_every 个订单再发送一笔可成交的tick
+    返回 {'orders', 'elapsed', 'ordersPerSec', 'ackP50', 'ackP99'(ms), 'rtnOrders', 'rtnTrades'}
+    """
+    sockets = [await WebSocket.connect(host, port) for _ in range(n_clients)]
+    per_client = n_orders // n_clients
+    latencies = []
+    counts = {'rtnOrder': 0, 'rtnTrade': 0}
+
+    async def client(idx, ws):
+        sent = {}
+        window_sem = asyncio.Semaphore(window)
+        done = asyncio.Event()
+        total = per_client + (per_client // tick_every if idx == 0 and tick_every else 0)
+        if not total:
+            done.set()
+
+        async def reader():
+            acked = 0
+            while acked < total:
+                text = await ws.recv()
+                if text is None:
+                    break
+                msg = json.loads(text)
+                if msg['type'] in ('ack', 'error'):
+                    latencies.append(time.perf_counter() - sent.pop(msg['reqID']))
+                    window_sem.release()
+                    acked += 1
+                elif msg['type'] in counts:
+                    counts[msg['type']] += 1
+            done.set()
+
+        reader_task = asyncio.ensure_future(reader())
+        req_id = 0
+        tick_volume = 0
+        for i in range(per_client):
+            req_id += 1
+            await window_sem.acquire()
+            sent[req_id] = time.perf_counter()
+            ws.send(json.dumps({'type': MSG_ORDER, 'reqID': req_id,
+                                'accountID': 'load{}_{}'.format(idx, i % n_accounts), 'btSymbol': btSymbol,
+                                'symbol': btSymbol, 'direction': DIRECTION_LONG if i % 2 else DIRECTION_SHORT,
+                                'offset': OFFSET_OPEN, 'priceType': PRICETYPE_LIMITPRICE,
+                                'price': 4000.0, 'volume': 1, 'orderID': str(req_id)}))
+            if idx == 0 and tick_every and (i + 1) % tick_every == 0:
+                req_id += 1
+                tick_volume += tick_every * n_clients
+                await window_sem.acquire()
+                sent[req_id] = time.perf_counter()
+                ws.send(json.dumps({'type': MSG_TICK, 'reqID': req_id, 'btSymbol': btSymbol, 'symbol': btSymbol,
+                                    'lastPrice': 4000.0, 'askPrice1': 4000.0, 'bidPrice1': 4000.0,
+                                    'volume': tick_volume, 'date': '2019-01-03', 'actionDay': '2019-01-03',
+                                    'time': '09:30:00'}))
+            await ws.drain()
+        await done.wait()
+        await reader_task
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[client(i, ws) for i, ws in enumerate(sockets)])
+    elapsed = time.perf_counter() - t0
+    for ws in sockets:
+        await ws.close()
+
+    latencies.sort()
+    n = len(latencies)
+    pct = lambda p: latencies[min(n - 1, int(n * p))] * 1000.0 if n else 0.0
+    return {'orders': per_client * n_clients, 'elapsed': elapsed,
+            'ordersPerSec': per_client * n_clients / elapsed if elapsed else 0.0,
+            'ackP50': pct(0.5), 'ackP99': pct(0.99),
+            'rtnOrders': counts['rtnOrder'], 'rtnTrades': counts['rtnTrade']}
+
+
+if __name__ == "__main__":
+    # python btVMatchServer.py [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    service = VMatchService(port=port)
+    try:
+        asyncio.run(service.serve_forever())
+    except KeyboardInterrupt:
+        pass
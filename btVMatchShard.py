@@ -0,0 +1,298 @@
+# encoding: UTF-8
+#
+# Copyright 2018 BigQuant, Inc.
+#
+# 多进程分片撮合：账户按编号分配到多个工作进程，各进程内运行独立的 VMatchManager
+#
+
+import heapq
+import pickle
+import traceback
+import zlib
+from multiprocessing import get_context
+
+from btVMatch import VMatchManager, IDSource, EV_REQ_ORDER, EV_REQ_ORDERS, EV_REQ_CANCEL, EV_TICK, EV_BAR
+from btVMatch import ALLOC_PRIORITY, ALLOC_PRO_RATA
+
+EV_TRADING_DAY = 'eTradingDay'
+EV_SETTING = 'eSetting'
+EV_RTN_ORDER = 'eRtnOrder'
+EV_RTN_TRADE = 'eRtnTrade'
+
+
+class _ShardCollector(object):
+    """工作进程内收集回报，记录产生回报的事件序号"""
+    def __init__(self):
+        self.event_idx = 0
+        self.outputs = []
+
+    def on_rtn_order(self, userdata, order):
+        # VMatchManager 每次回报都生成新的 BtOrderData，可直接保存
+        self.outputs.append((self.event_idx, EV_RTN_ORDER, order))
+
+    def on_rtn_trade(self, userdata, trade):
+        self.outputs.append((self.event_idx, EV_RTN_TRADE, trade))
+
+
+def _shard_worker(conn, id_seed, shard, n_shards):
+    """工作进程：按顺序处理一批事件，返回这批事件产生的回报及异常 (outputs, error)
+    处理某个事件出现异常时，这批之后的事件不再处理，返回之前的回报及 (异常, traceback)，进程继续运行
+    """
+    # 各分片的编号段交错分配，互不重复
+    vmatchmgr = VMatchManager(id_source=IDSource(id_seed, shard=shard, n_shards=n_shards))
+    collector = _ShardCollector()
+    vmatchmgr.set_order_callback(collector.on_rtn_order, None)
+    vmatchmgr.set_trade_callback(collector.on_rtn_trade, None)
+
+    while True:
+        events = pickle.loads(conn.recv_bytes())
+        if events is None:
+            break
+
+        error = None
+        for event_idx, ev_type, data in events:
+            collector.event_idx = event_idx
+            try:
+                if ev_type == EV_TICK:
+                    vmatchmgr.on_new_tick(data)
+                elif ev_type == EV_BAR:
+                    vmatchmgr.on_new_bar(data)
+                elif ev_type == EV_REQ_ORDER:
+                    vmatchmgr.req_input_order(data)
+                elif ev_type == EV_REQ_ORDERS:
+                    vmatchmgr.req_input_orders(data)
+                elif ev_type == EV_REQ_CANCEL:
+                    vmatchmgr.req_cancel_order(data)
+                elif ev_type == EV_TRADING_DAY:
+                    vmatchmgr.set_trading_day(data)
+                elif ev_type == EV_SETTING:
+                    method, args = data
+                    getattr(vmatchmgr, method)(*args)
+            except Exception as e:
+                error = (e, traceback.format_exc())
+                break
+
+        try:
+            payload = pickle.dumps((collector.outputs, error), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # 异常对象不能序列化时只返回其描述
+            error = (RuntimeError(repr(error[0])), error[1])
+            payload = pickle.dumps((collector.outputs, error), pickle.HIGHEST_PROTOCOL)
+        conn.send_bytes(payload)
+        collector.outputs = []
+    conn.close()
+
+
+class ShardedVMatchManager(object):
+    """多进程分片的模拟撮合管理
+    支持 VMatchManager 的下单、撤单、行情、交易日及回调接口，设置 set_tick_depth、set_journal_root、
+    set_shared_liquidity 广播到各分片；不支持持久化 (set_persistence/set_wal/snapshot)、批量回报及延迟统计
+    1. 账户按 accountID 固定分配到某个分片，订单/撤单只发送到所在分片
+    2. 行情及交易日切换广播到所有分片，同一批事件只序列化一次
+    3. 事件先缓存，满 batch_size 个或调用 flush 时批量发送，各分片的回报按
+       (事件序号, 分片序号, 分片内顺序) 合并后依次回调，回调顺序是确定的
+    4. 各分片从同一编号基数交错分配报单、成交编号，不会重复；指定 id_seed 时编号可复现
+    5. 某个分片处理事件出现异常时，仍发出各分片已产生的回报，之后在 flush 中抛出带分片序号的 RuntimeError，
+       原异常为其 __cause__；工作进程退出的分片记为失效，之后每次 flush 都抛出该分片的 RuntimeError
+    6. 分片间不共享可成交量，多个分片时不支持 set_shared_liquidity(True)
+    注意：回报在 flush 时才发出，需要逐笔回报时可设置 batch_size=1
+    """
+    def __init__(self, n_workers=4, batch_size=1024, id_seed=None):
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        # 未指定时取当前时间的编号基数，所有分片使用同一基数
+        self.id_seed = id_seed if id_seed is not None else IDSource().base
+        self.trading_day = ''
+
+        self.order_userdata = None
+        self.order_callback = None
+        self.trade_userdata = None
+        self.trade_callback = None
+
+        self.__conns = []
+        self.__procs = []
+        self.__events = [[] for _ in range(n_workers)]  # 各分片待发送的事件
+        self.__broadcasts = []      # 待广播的事件
+        self.__event_n = 0          # 事件序号
+        self.__pending_n = 0        # 缓存的事件数
+        self.__flushing = False
+        self.__dead = {}            # {分片序号: 工作进程退出的异常}
+
+    def start(self):
+        """启动工作进程"""
+        if self.__procs:
+            return
+        ctx = get_context()
+        for shard in range(self.n_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_shard_worker, args=(child_conn, self.id_seed, shard, self.n_workers),
+                               daemon=True)
+            proc.start()
+            child_conn.close()
+            self.__conns.append(parent_conn)
+            self.__procs.append(proc)
+
+    def stop(self):
+        """处理完缓存的事件后停止工作进程"""
+        if not self.__procs:
+            return
+        try:
+            self.flush()
+        finally:
+            stop_msg = pickle.dumps(None)
+            for shard, conn in enumerate(self.__conns):
+                if shard not in self.__dead:
+                    conn.send_bytes(stop_msg)
+            for proc in self.__procs:
+                proc.join()
+            for conn in self.__conns:
+                conn.close()
+            self.__conns = []
+            self.__procs = []
+
+    def get_shard(self, accountID):
+        """账户所在分片"""
+        return zlib.crc32(str(accountID).encode('utf-8')) % self.n_workers
+
+    def set_trading_day(self, trading_day):
+        """设置交易日"""
+        self.trading_day = trading_day
+        self._put_broadcast(EV_TRADING_DAY, trading_day)
+
+    def set_tick_depth(self, depth):
+        """设置tick撮合的盘口档数"""
+        self._put_broadcast(EV_SETTING, ('set_tick_depth', (depth,)))
+
+    def set_journal_root(self, root, max_records=100000):
+        """设置交易流水的写盘目录，各分片按账户写到 root 下，同 VMatchManager.set_journal_root"""
+        self._put_broadcast(EV_SETTING, ('set_journal_root', (root, max_records)))
+
+    def set_shared_liquidity(self, enabled, allocation=ALLOC_PRIORITY):
+        """设置是否跨账户共享tick的可成交量，只在单个分片时支持"""
+        if allocation not in (ALLOC_PRIORITY, ALLOC_PRO_RATA):
+            raise ValueError("unknown allocation {}".format(allocation))
+        if enabled and self.n_workers > 1:
+            raise ValueError("shared liquidity needs all accounts in one shard, n_workers={}".format(self.n_workers))
+        self._put_broadcast(EV_SETTING, ('set_shared_liquidity', (enabled, allocation)))
+
+    def set_order_callback(self, callback, userdata):
+        self.order_callback = callback
+        self.order_userdata = userdata
+
+    def set_trade_callback(self, callback, userdata):
+        self.trade_callback = callback
+        self.trade_userdata = userdata
+
+    def req_input_order(self, order_req):
+        """有新订单请求"""
+        self._put_event(self.get_shard(order_req.accountID), EV_REQ_ORDER, order_req)
+
+    def req_input_orders(self, order_reqs):
+        """一批新订单请求，按分片分组，每个分片作为一个事件发送"""
+        shard_reqs = {}
+        for order_req in order_reqs:
+            try:
+                shard_reqs[self.get_shard(order_req.accountID)].append(order_req)
+            except KeyError:
+                shard_reqs[self.get_shard(order_req.accountID)] = [order_req]
+        for shard, reqs in shard_reqs.items():
+            self._put_event(shard, EV_REQ_ORDERS, reqs)
+
+    def req_cancel_order(self, cancel_req):
+        """撤单请求"""
+        self._put_event(self.get_shard(cancel_req.accountID), EV_REQ_CANCEL, cancel_req)
+
+    def on_new_tick(self, tick):
+        """新行情"""
+        self._put_broadcast(EV_TICK, tick)
+
+    def on_new_bar(self, bar):
+        """新行情"""
+        self._put_broadcast(EV_BAR, bar)
+
+    def _put_event(self, shard, ev_type, data):
+        # 广播事件需先于之后的单分片事件，保持事件顺序
+        if self.__broadcasts:
+            self._spread_broadcasts()
+        self.__events[shard].append((self.__event_n, ev_type, data))
+        self.__event_n += 1
+        self._check_flush()
+
+    def _put_broadcast(self, ev_type, data):
+        self.__broadcasts.append((self.__event_n, ev_type, data))
+        self.__event_n += 1
+        self._check_flush()
+
+    def _spread_broadcasts(self):
+        for events in self.__events:
+            events.extend(self.__broadcasts)
+        self.__broadcasts = []
+
+    def _check_flush(self):
+        self.__pending_n += 1
+        # 回报回调中产生的请求留到下一批
+        if self.__pending_n >= self.batch_size and not self.__flushing:
+            self.flush()
+
+    def flush(self):
+        """发送缓存的事件，等待各分片处理完成并按顺序发出回报"""
+        if not self.__pending_n or self.__flushing:
+            return
+        self.start()
+
+        # 无单分片事件时，所有分片的事件相同，只需序列化一次
+        if self.__broadcasts and not any(self.__events):
+            payloads = [pickle.dumps(self.__broadcasts, pickle.HIGHEST_PROTOCOL)] * self.n_workers
+        else:
+            self._spread_broadcasts()
+            payloads = [pickle.dumps(events, pickle.HIGHEST_PROTOCOL) for events in self.__events]
+        self.__events = [[] for _ in range(self.n_workers)]
+        self.__broadcasts = []
+        self.__pending_n = 0
+
+        for shard, (conn, payload) in enumerate(zip(self.__conns, payloads)):
+            if shard in self.__dead:
+                continue
+            try:
+                conn.send_bytes(payload)
+            except OSError as e:
+                self.__dead[shard] = e
+        results = []
+        errors = []
+        for shard, conn in enumerate(self.__conns):
+            outputs, error = [], None
+            if shard not in self.__dead:
+                try:
+                    outputs, error = pickle.loads(conn.recv_bytes())
+                except (EOFError, OSError) as e:
+                    self.__dead[shard] = e
+            if shard in self.__dead:
+                # 已退出的分片不再发送事件，每次 flush 都报告
+                error = (self.__dead[shard], 'worker exited')
+            results.append(outputs)
+            if error:
+                errors.append((shard, error))
+
+        self.__flushing = True
+        try:
+            for _, ev_type, data in heapq.merge(*results, key=lambda output: output[0]):
+                if ev_type == EV_RTN_ORDER:
+                    self.on_rtn_order(self, data)
+                else:
+                    self.on_rtn_trade(self, data)
+        finally:
+            self.__flushing = False
+
+        if errors:
+            shard, (error, tb) = errors[0]
+            raise RuntimeError("shard {} failed: {!r}\n{}".format(shard, error, tb)) from error
+
+    def on_rtn_order(self, userdata, order):
+        """订单回报"""
+        if self.order_callback:
+            self.order_callback(self.order_userdata, order)
+
+    def on_rtn_trade(self, userdata, trade):
+        """成交回报"""
+        if self.trade_callback:
+            self.trade_callback(self.trade_userdata, trade)
@@ -0,0 +1,333 @@
+# encoding: UTF-8
+#
+# Copyright 2018 BigQuant, Inc.
+#
+# 向量化的bar行情回放撮合
+#
+
+import heapq
+
+import numpy as np
+
+from bigtrader.btConstant import *
+from bigtrader.btObject import BtBarData
+
+
+class BarReplayEngine(object):
+    """按列存储的bar行情回放（numpy）
+    与逐个 BtBarData 调用 VMatchManager.on_new_bar 的撮合结果一致：
+    1. 按bar撮合时各挂单相互独立，限价单在第一根 "价格可成交且成交量有效" 的bar触发撮合，
+       市价/FAK/FOK单在进入挂单队列后的第一根bar即触发（成交或撤单），
+       因此对所有挂单可在区间最值表（sparse table）上自起始bar向后倍增查找，一次性算出触发的bar，
+       而不必逐bar遍历挂单；区间最值表每次回放只计算一次，部分成交后重新挂单的订单不会重复计算
+    2. 按 (bar, 账户, 挂单) 的顺序依次应用撮合结果并发出回报，成交编号的分配顺序与逐bar撮合相同
+    3. 回报回调中产生的新订单，以及撮合后仍在挂单队列中的订单，从下一根bar起重新计算
+    4. 连续 DENSE_BARS 根bar都有部分成交后继续挂单的订单时（如大单每根bar部分成交），跳过bar已无收益，
+       之后 OBJECT_BARS 根bar逐根调用 VMatchManager.on_new_bar，再重新计算所有挂单触发的bar
+    """
+    SCAN_BARS = 16      # 倍增查找前先逐个检查的bar数
+    SCALAR_ORDERS = 8   # 订单数不超过该值时逐个计算，避免小数组上的numpy开销
+    DENSE_BARS = 8      # 连续有部分成交的bar数达到该值时改为逐bar撮合
+    OBJECT_BARS = 256   # 每次逐bar撮合的bar数
+
+    def __init__(self, vmatchmgr):
+        self.vmatchmgr = vmatchmgr
+
+        self.closes = None
+        self.volumes = None
+        self._cache = {}        # 本次回放的区间最值表 {(volume_limit, volume_round): arrays}
+
+    def replay(self, btSymbol, dates, times, closes, volumes):
+        """回放一个合约的bar序列
+        dates/times: 日期、时间字符串数组
+        closes/volumes: 收盘价、成交量数组
+        """
+        self.closes = np.asarray(closes, dtype=np.float64)
+        self.volumes = np.asarray(volumes, dtype=np.float64)
+        self._cache.clear()
+        vmatchmgr = self.vmatchmgr
+
+        n = len(self.closes)
+        events = []     # 小顶堆 (bar, seq, vmatch, order, trade_price, trade_volume)
+        seqs = {}       # 订单在挂单队列中的先后顺序 {order: seq}
+        start = 0
+        resume = True   # 重新计算所有挂单（开始时及逐bar撮合之后）
+        dense = 0       # 连续有部分成交的bar数
+        last_bar = -1
+        while start < n:
+            # 新订单进入挂单队列
+            if resume:
+                vmatchmgr._process_new_orders()
+                subs = vmatchmgr.symbol_subs.get(btSymbol)
+                changed = list(subs.values()) if subs else []
+            elif vmatchmgr.pending_vmatchs:
+                changed = list(vmatchmgr.pending_vmatchs.values())
+                vmatchmgr._process_new_orders()
+            else:
+                changed = []
+
+            for vmatch in changed:
+                orders = vmatch._get_working_orders(btSymbol)
+                if not orders:
+                    continue
+                new_orders = []
+                for order in orders:
+                    if order not in seqs:
+                        seqs[order] = len(seqs)
+                        new_orders.append(order)
+                    elif resume:
+                        new_orders.append(order)
+                if new_orders:
+                    self._push_events(vmatch, new_orders, seqs, start, events)
+            resume = False
+
+            if not events:
+                break
+
+            bar_idx = events[0][0]
+            requeue = self._apply_bar(btSymbol, bar_idx, str(dates[bar_idx]), str(times[bar_idx]), events)
+            # 部分成交后继续挂单的订单通常下一根bar又会撮合
+            dense = dense + 1 if requeue and bar_idx == last_bar + 1 else 0
+            last_bar = bar_idx
+            start = bar_idx + 1
+            if dense >= self.DENSE_BARS and start < n:
+                end = min(start + self.OBJECT_BARS, n)
+                self._replay_bars(btSymbol, dates, times, start, end)
+                del events[:]
+                start = end
+                resume = True
+                dense = 0
+            elif start < n:
+                for vmatch, orders in requeue.items():
+                    self._push_events(vmatch, orders, seqs, start, events)
+
+    def _apply_bar(self, btSymbol, bar_idx, cur_date, cur_time, events):
+        """应用某根bar上的全部撮合结果，返回撮合后仍在挂单队列中的订单 {vmatch: [order]}
+        同 VMatchManager.on_new_bar，每根bar作为一个事件：之前检查快照，之后发出批量回报
+        """
+        vmatchmgr = self.vmatchmgr
+        if vmatchmgr.wal:
+            vmatchmgr._check_snapshot()
+
+        groups = {}
+        while events and events[0][0] == bar_idx:
+            _, _, vmatch, order, trade_price, trade_volume = heapq.heappop(events)
+            try:
+                groups[vmatch].append((order, trade_price, trade_volume))
+            except KeyError:
+                groups[vmatch] = [(order, trade_price, trade_volume)]
+
+        # 按账户在订阅索引中的顺序处理，已不在索引中的排在最后
+        vmatchs = list(groups.keys())
+        if len(vmatchs) > 1:
+            subs = vmatchmgr.symbol_subs.get(btSymbol, {})
+            ordered = [vmatch for vmatch in subs.values() if vmatch in groups]
+            if len(ordered) < len(vmatchs):
+                ordered.extend(vmatch for vmatch in vmatchs if subs.get(vmatch.accountID) is not vmatch)
+            vmatchs = ordered
+
+        requeue = {}
+        for vmatch in vmatchs:
+            engine = vmatch.vmatch_engine
+            trade_infos = []
+            for order, trade_price, trade_volume in groups[vmatch]:
+                # 已在回调中被撤销
+                if order.orderSysID not in vmatch.order_index:
+                    continue
+                if trade_price is None:
+                    engine.cancel_order(order, cur_date, cur_time, trade_infos)
+                else:
+                    engine.fill_order(order, trade_price, trade_volume, cur_date, cur_time, trade_infos)
+            if trade_infos:
+                vmatch._process_trade_infos(vmatch.order_dicts.get(btSymbol), trade_infos)
+
+            remains = [order for order, _, _ in groups[vmatch] if order.orderSysID in vmatch.order_index]
+            if remains:
+                requeue[vmatch] = remains
+        vmatchmgr._end_event()
+        return requeue
+
+    def _replay_bars(self, btSymbol, dates, times, begin, end):
+        """bar [begin, end) 逐根调用 VMatchManager.on_new_bar，复用同一个 BtBarData"""
+        bar = BtBarData()
+        bar.btSymbol = btSymbol
+        on_new_bar = self.vmatchmgr.on_new_bar
+        for cur_date, cur_time, close, volume in zip(dates[begin:end], times[begin:end],
+                                                     self.closes[begin:end].tolist(),
+                                                     self.volumes[begin:end].tolist()):
+            bar.date, bar.time = str(cur_date), str(cur_time)
+            bar.close, bar.volume = close, volume
+            on_new_bar(bar)
+
+    def _push_events(self, vmatch, orders, seqs, start, events):
+        """计算订单自 start 起首次触发撮合的bar及成交价量，放入事件堆"""
+        if len(orders) <= self.SCALAR_ORDERS:
+            return self._push_events_scalar(vmatch, orders, seqs, start, events)
+
+        engine = vmatch.vmatch_engine
+        to_cancel_types = engine.PRICETYPE_TOBE_CANCELED
+        levels, capped = self._bar_arrays(engine)
+
+        n_orders = len(orders)
+        is_long = np.fromiter((o.direction == DIRECTION_LONG for o in orders), dtype=bool, count=n_orders)
+        price = np.fromiter((o.price for o in orders), dtype=np.float64, count=n_orders)
+        total = np.fromiter((o.totalVolume for o in orders), dtype=np.float64, count=n_orders)
+        remaining = total - np.fromiter((o.tradedVolume for o in orders), dtype=np.float64, count=n_orders)
+        is_fok = np.fromiter((o.priceType == PRICETYPE_FOK for o in orders), dtype=bool, count=n_orders)
+        to_cancel = np.fromiter((o.priceType in to_cancel_types for o in orders), dtype=bool, count=n_orders)
+
+        # 限价单：自 start 起首个可成交的bar
+        n = len(self.closes)
+        idx = self._first_cross(levels, start, is_long, price)
+        limit_ok = ~to_cancel & (idx < n) & (self._round_volume(engine, remaining) >= 0.0001)
+        # 市价/FAK/FOK单：第一根bar即触发
+        idx = np.where(to_cancel, start, idx)
+        has_event = to_cancel | limit_ok
+        if not has_event.any():
+            return
+
+        sel = np.nonzero(has_event)[0]
+        bar = idx[sel]
+        close = self.closes[bar]
+        volume = self.volumes[bar]
+        o_long, o_price, o_total, o_remaining = is_long[sel], price[sel], total[sel], remaining[sel]
+
+        crossed = np.where(o_long, o_price >= close, o_price <= close)
+        fok_fail = is_fok[sel] & (o_total > volume)
+        fill = crossed & ~fok_fail
+
+        # 同 VMatchEngine.get_trade_vp_by_bar
+        trade_volume = self._round_volume(engine, np.minimum(o_remaining, capped[bar]))
+        trade_volume = np.where(volume > 0, trade_volume, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volume_share = np.minimum(trade_volume / volume, engine.volume_limit)
+        # math.copysign(price_impact, bool) 恒为正
+        trade_price = o_price + volume_share ** 2 * abs(engine.price_impact) * o_price
+
+        for i, bar_i, fill_i, price_i, volume_i in zip(sel.tolist(), bar.tolist(), fill.tolist(),
+                                                       trade_price.tolist(), trade_volume.tolist()):
+            order = orders[i]
+            if fill_i:
+                heapq.heappush(events, (bar_i, seqs[order], vmatch, order,
+                                        round(price_i, engine.price_round), volume_i))
+            else:
+                heapq.heappush(events, (bar_i, seqs[order], vmatch, order, None, 0))
+
+    def _push_events_scalar(self, vmatch, orders, seqs, start, events):
+        """同 _push_events，逐个订单计算，用于部分成交后重新挂单等少量订单"""
+        engine = vmatch.vmatch_engine
+        to_cancel_types = engine.PRICETYPE_TOBE_CANCELED
+        volume_round = engine.volume_round
+        levels, _ = self._bar_arrays(engine)
+        closes, volumes = self.closes, self.volumes
+        n = len(closes)
+        heappush = heapq.heappush
+        for order in orders:
+            remaining = order.totalVolume - order.tradedVolume
+            is_long = order.direction == DIRECTION_LONG
+            if order.priceType in to_cancel_types:
+                bar = start
+            else:
+                # 同 _round_volume，标量上直接计算
+                if volume_round == 1:
+                    rounded = int(remaining)
+                elif volume_round > 1:
+                    rounded = int(remaining / volume_round * volume_round)
+                else:
+                    rounded = remaining
+                if rounded < 0.0001:
+                    continue
+                bar = self._first_cross_one(levels, start, 0 if is_long else 1,
+                                            order.price if is_long else -order.price)
+                if bar >= n:
+                    continue
+
+            close = float(closes[bar])
+            volume = float(volumes[bar])
+            crossed = order.price >= close if is_long else order.price <= close
+            if crossed and not (order.priceType == PRICETYPE_FOK and order.totalVolume > volume):
+                trade_price, trade_volume = engine.get_trade_vp_by_bar(order.direction, order.price, remaining,
+                                                                       volume, close)
+                heappush(events, (bar, seqs[order], vmatch, order, trade_price, trade_volume))
+            else:
+                heappush(events, (bar, seqs[order], vmatch, order, None, 0))
+
+    def _bar_arrays(self, engine):
+        """区间最值表及各bar的成交量上限，每次回放按撮合参数只计算一次
+        levels[k][0, i]: bar [i, i + 2^k) 中有效成交量bar收盘价的最小值（多头可成交）
+        levels[k][1, i]: 同一区间收盘价最大值取负（空头可成交），无有效bar时为 inf
+        """
+        key = (engine.volume_limit, engine.volume_round)
+        arrays = self._cache.get(key)
+        if arrays is None:
+            closes = self.closes
+            volumes = self.volumes
+            capped = engine.volume_limit * volumes if engine.volume_limit > 0 else volumes
+            eligible = (volumes > 0) & (self._round_volume(engine, capped) >= 0.0001)
+            level = np.stack([np.where(eligible, closes, np.inf), np.where(eligible, -closes, np.inf)])
+            levels = [level]
+            width = 1
+            while 2 * width <= len(closes):
+                level = np.minimum(level[:, :-width], level[:, width:])
+                levels.append(level)
+                width *= 2
+            arrays = (levels, capped)
+            self._cache[key] = arrays
+        return arrays
+
+    def _first_cross(self, levels, start, is_long, price):
+        """各订单自 start 起首个可成交的bar，没有时为bar数
+        先检查之后的 SCAN_BARS 根bar（部分成交的挂单通常很快再次成交），其余在区间最值表上倍增查找
+        """
+        n = len(self.closes)
+        side = np.where(is_long, 0, 1)
+        # 多头：收盘价 <= 委托价；空头：-收盘价 <= -委托价
+        bound = np.where(is_long, price, -price)
+        pos = np.full(len(price), n, dtype=np.int64)
+
+        end = min(start + self.SCAN_BARS, n)
+        if end > start:
+            hits = levels[0][side, start:end] <= bound[:, None]
+            found = hits.any(axis=1)
+            pos[found] = start + hits[found].argmax(axis=1)
+        rest = np.nonzero(pos == n)[0]
+        if not len(rest) or end >= n:
+            return pos
+
+        cur = np.full(len(rest), end, dtype=np.int64)
+        r_side, r_bound = side[rest], bound[rest]
+        for k in range(len(levels) - 1, -1, -1):
+            width = 1 << k
+            level = levels[k]
+            ok = cur + width <= n
+            at = np.minimum(cur, level.shape[1] - 1)
+            # 整个区间都不可成交时跳过
+            skip = ok & (level[r_side, at] > r_bound)
+            cur += np.where(skip, width, 0)
+        pos[rest] = cur
+        return pos
+
+    def _first_cross_one(self, levels, start, side, bound):
+        """同 _first_cross，单个订单"""
+        n = len(self.closes)
+        row = levels[0][side]
+        end = min(start + self.SCAN_BARS, n)
+        for i in range(start, end):
+            if row[i] <= bound:
+                return i
+
+        cur = end
+        for k in range(len(levels) - 1, -1, -1):
+            width = 1 << k
+            if cur + width <= n and levels[k][side, cur] > bound:
+                cur += width
+        return cur
+
+    @staticmethod
+    def _round_volume(engine, volume):
+        """同 VMatchEngine.get_trade_vp_by_bar 的成交量取整"""
+        if engine.volume_round == 1:
+            return np.trunc(volume)
+        elif engine.volume_round > 1:
+            return np.trunc(volume / engine.volume_round * engine.volume_round)
+        return volume
@@ -0,0 +1,173 @@
+# encoding: UTF-8
+#
+# Copyright 2018 BigQuant, Inc.
+#
+# 向量化的组合持仓盯市
+#
+
+import numpy as np
+
+from vposition import VPosition2
+
+
+def _column(name, cast):
+    """VPosition2 的属性映射到组合数组的一列"""
+    def fget(self):
+        return cast(getattr(self._portfolio, name)[self._index])
+
+    def fset(self, value):
+        getattr(self._portfolio, name)[self._index] = value
+    return property(fget, fset)
+
+
+def _multiplier_column():
+    """合约乘数写入组合数组参与计算，读取时返回原值，保持合约中的类型（如 int）"""
+    def fget(self):
+        return self._multiplier
+
+    def fset(self, value):
+        self._multiplier = value
+        self._portfolio.multiplier[self._index] = value
+    return property(fget, fset)
+
+
+class PortfolioPosition(VPosition2):
+    """组合中的一个合约持仓，接口同 VPosition2
+    多/空持仓、均价、盈亏、保证金、乘数、最新价读写组合中的数组，其余字段同 VPosition2
+    """
+    _longPos = _column('long_pos', int)
+    _longPrice = _column('long_price', float)
+    _longPnl = _column('long_pnl', float)
+    _longMargin = _column('long_margin', float)
+    _shortPos = _column('short_pos', int)
+    _shortPrice = _column('short_price', float)
+    _shortPnl = _column('short_pnl', float)
+    _shortMargin = _column('short_margin', float)
+    multiplier = _multiplier_column()
+    lastPrice = _column('last_price', float)
+    tickUpdateN = _column('tick_update_n', int)
+
+    def __init__(self, portfolio, index, accountID, contract):
+        # 先绑定数组，VPosition2 初始化时的赋值写入数组
+        self._portfolio = portfolio
+        self._index = index
+        super(PortfolioPosition, self).__init__(accountID, contract)
+
+    def update_margin_rate(self, marginRate):
+        """更新保证金率，同时更新组合中按最新价计算保证金的比例"""
+        super(PortfolioPosition, self).update_margin_rate(marginRate)
+        if marginRate:
+            self._portfolio.long_margin_ratio[self._index] = marginRate.longMarginRatioByMoney
+            self._portfolio.short_margin_ratio[self._index] = marginRate.shortMarginRatioByMoney
+
+
+class VPortfolio(object):
+    """组合持仓（numpy），各合约的多/空持仓、均价、乘数等按列存储，行号即合约序号
+    1. 持仓仍由 get_position 返回的 PortfolioPosition 按委托、成交维护（与 VPosition2 相同），直接读写数组
+    2. update_prices 一次计算一批合约最新价下的持仓盈亏、按最新价的保证金和净敞口，
+       结果与逐个调用 VPosition2.process_tick_updated 相同
+    3. 汇总（总盈亏、总保证金、净敞口）直接在数组上计算
+    """
+    INT_FIELDS = ('long_pos', 'short_pos', 'tick_update_n')
+    FLOAT_FIELDS = ('long_price', 'long_pnl', 'long_margin', 'short_price', 'short_pnl', 'short_margin',
+                    'multiplier', 'last_price', 'long_margin_ratio', 'short_margin_ratio',
+                    'long_mkt_margin', 'short_mkt_margin', 'exposure')
+
+    def __init__(self, accountID='', capacity=1024):
+        self.accountID = accountID
+        self.size = 0               # 合约数
+        self.btSymbols = []         # 各行的合约
+        self.symbol_index = {}      # {btSymbol: 行号}
+        self.positions = []         # 各行的 PortfolioPosition
+
+        for name in self.INT_FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=np.int64))
+        for name in self.FLOAT_FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=np.float64))
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self):
+        capacity = max(16, 2 * len(self.long_pos))
+        for name in self.INT_FIELDS + self.FLOAT_FIELDS:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add_position(self, contract, marginRate=None):
+        """添加合约持仓，已有时返回原持仓"""
+        index = self.symbol_index.get(contract.btSymbol)
+        if index is not None:
+            return self.positions[index]
+
+        if self.size >= len(self.long_pos):
+            self._grow()
+        index = self.size
+        self.size += 1
+        position = PortfolioPosition(self, index, self.accountID, contract)
+        position.update_margin_rate(marginRate)
+        self.btSymbols.append(contract.btSymbol)
+        self.symbol_index[contract.btSymbol] = index
+        self.positions.append(position)
+        return position
+
+    def get_position(self, btSymbol):
+        """合约持仓 PortfolioPosition，没有时返回 None"""
+        index = self.symbol_index.get(btSymbol)
+        return self.positions[index] if index is not None else None
+
+    def get_indexes(self, btSymbols):
+        """合约对应的行号数组，同一批合约多次更新时可先取得行号"""
+        symbol_index = self.symbol_index
+        return np.fromiter((symbol_index[btSymbol] for btSymbol in btSymbols), dtype=np.int64,
+                           count=len(btSymbols))
+
+    def update_prices(self, lastPrices, btSymbols=None, indexes=None):
+        """按一批最新价盯市
+        lastPrices: 最新价数组
+        btSymbols/indexes: 对应的合约或行号，都为 None 时 lastPrices 对应全部合约
+        """
+        prices = np.asarray(lastPrices, dtype=np.float64)
+        if indexes is None:
+            indexes = slice(0, self.size) if btSymbols is None else self.get_indexes(btSymbols)
+
+        multiplier = self.multiplier[indexes]
+        long_pos = self.long_pos[indexes]
+        short_pos = self.short_pos[indexes]
+        long_value = long_pos * prices * multiplier
+        short_value = short_pos * prices * multiplier
+
+        self.last_price[indexes] = prices
+        # 同 VPosition2.calculate_position_pnl
+        self.long_pnl[indexes] = long_pos * (prices - self.long_price[indexes]) * multiplier
+        self.short_pnl[indexes] = short_pos * (self.short_price[indexes] - prices) * multiplier
+        self.long_mkt_margin[indexes] = long_value * self.long_margin_ratio[indexes]
+        self.short_mkt_margin[indexes] = short_value * self.short_margin_ratio[indexes]
+        self.exposure[indexes] = long_value - short_value
+        self.tick_update_n[indexes] += 1
+
+    def get_position_pnl(self):
+        """总持仓盈亏"""
+        n = self.size
+        return float(self.long_pnl[:n].sum() + self.short_pnl[:n].sum())
+
+    def get_position_margin(self):
+        """总保证金占用（开仓时计算）"""
+        n = self.size
+        return float(self.long_margin[:n].sum() + self.short_margin[:n].sum())
+
+    def get_market_margin(self):
+        """按最新价计算的总保证金"""
+        n = self.size
+        return float(self.long_mkt_margin[:n].sum() + self.short_mkt_margin[:n].sum())
+
+    def get_net_exposure(self):
+        """净敞口（多头市值 - 空头市值）"""
+        return float(self.exposure[:self.size].sum())
+
+    def get_gross_exposure(self):
+        """总敞口（多头市值 + 空头市值）"""
+        n = self.size
+        return float(((self.long_pos[:n] + self.short_pos[:n]) * self.last_price[:n] * self.multiplier[:n]).sum())
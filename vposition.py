@@ -3,6 +3,7 @@
 # Copyright 2018 BigQuant, Inc.
 #
 
+from collections import deque
 from copy import copy
 
 from bigvmatch.vmatch.vtypes import *
@@ -117,8 +118,13 @@ class VPosition2(object):
         # 已完成的订单的号 <btOrderSysID> 
         self.finishedOrderSet = set()
 
-        # 持仓明细
-        self.positionDetails = []
+        # 持仓明细，按方向、今/昨仓分别按开仓顺序排队 {(direction, 是否昨仓): deque(posDetail)}
+        self._detailQueues = {}
+        # 持仓明细按方向的汇总：数量、按持仓价计的成本，持仓均价直接由此计算
+        self._longDetailVolume = 0
+        self._longDetailCost = 0.0
+        self._shortDetailVolume = 0
+        self._shortDetailCost = 0.0
 
         # 多仓
         self._longPos = 0
@@ -150,8 +156,20 @@ class VPosition2(object):
         self.realizedPnl = 0.0
         # tick行情更新次数
         self.tickUpdateN = 0
+        # 持仓盈亏懒计算：行情只记录最新价，读取盈亏时（或持仓变化前）才计算，期间多次行情合并为一次
+        self.lazyPnl = False
+        self._pnlDirty = False
+        self.pnlCalcN = 0       # 实际计算持仓盈亏的次数
+        self.pnlSkipN = 0       # 被合并、省掉的计算次数
+
+        # 日志：低于 logLevel 的不输出，默认全部输出（含 DEBUG），需要时用 set_log_level 调高；
+        # logRing 保存最近的原始日志参数，需要时再格式化
+        self.logPrefix = ''
+        self.logLevel = LEVEL_DEBUG
+        self.logRing = None
 
     def __repr__(self):
+        self._flush_pnl()
         return "Position({},longPos:{},longYdPos:{},longFrozen:{},longPnl:{},longPrice:{},\
     shortPos:{},shortYdPos:{},shortFrozen:{},shortPnl:{},shortPrice:{},lastPrice:{})"\
                .format(self.btSymbol, self._longPos, self._longYdPos, self._longPosFrozen, self._longPnl, self._longPrice,
@@ -167,6 +185,23 @@ class VPosition2(object):
             return
         self.logPrefix = prefix
 
+    def set_log_level(self, level):
+        """设置日志输出级别"""
+        self.logLevel = level
+
+    def enable_log_ring(self, size=4096):
+        """保存最近 size 条日志（不论是否输出，不格式化），size 为 0 时关闭"""
+        self.logRing = deque(maxlen=size) if size else None
+
+    def dump_log_ring(self, clear=True):
+        """格式化环形缓冲中的日志，返回 [(level, content)]"""
+        if not self.logRing:
+            return []
+        lines = [(level, self.logPrefix + fmt.format(*args)) for level, fmt, args in self.logRing]
+        if clear:
+            self.logRing.clear()
+        return lines
+
     def update_margin_rate(self, marginRate):
         """更新保证金率"""
         if not marginRate:
@@ -175,6 +210,12 @@ class VPosition2(object):
         assert self.btSymbol == marginRate.btSymbol, "update_margin_rate btSymbol not equal"
         self.marginRate = marginRate
 
+    def set_lazy_pnl(self, enable=True):
+        """设置持仓盈亏懒计算，关闭时先补算未计算的盈亏"""
+        if not enable:
+            self._flush_pnl()
+        self.lazyPnl = enable
+
     def update_trading_day(self, tradingDay):
         """更新交易日"""
         self.tradingDay = tradingDay
@@ -226,10 +267,12 @@ class VPosition2(object):
 
     @property
     def long_pnl(self):
+        self._flush_pnl()
         return self._longPnl
 
     @property
     def short_pnl(self):
+        self._flush_pnl()
         return self._shortPnl
 
     @property
@@ -240,12 +283,18 @@ class VPosition2(object):
     def is_account_pos(self):
         return self.isAccountPos
 
+    @property
+    def positionDetails(self):
+        """全部持仓明细（只读列表）"""
+        return [posDetail for details in self._detailQueues.values() for posDetail in details]
+
     @property
     def contract(self):
         return self._contract
 
     @contract.setter
     def contract(self, contract):
+        self._flush_pnl()
         self._contract = contract
         self.btSymbol = contract.btSymbol
         self.symbol = contract.symbol
@@ -287,8 +336,8 @@ class VPosition2(object):
                     return False
                 self._shortTdFrozen += volume
             self._shortPosFrozen += volume
-            self.pos_log(LEVEL_INFO, '*position by req close short vol:{} shortPos:{},shortFrozen:{},shortYdFrozen:{},shortTdFrozen:{}'\
-                         .format(volume, self._shortPos, self._shortPosFrozen, self._shortYdFrozen, self._shortTdFrozen))
+            self.pos_log(LEVEL_INFO, '*position by req close short vol:{} shortPos:{},shortFrozen:{},shortYdFrozen:{},shortTdFrozen:{}',
+                         volume, self._shortPos, self._shortPosFrozen, self._shortYdFrozen, self._shortTdFrozen)
         elif direction == Direction.Short:
             # 平多仓
             if volume > (self._longPos - self._longPosFrozen) and self._longPosFrozen > self._longPos:
@@ -305,8 +354,8 @@ class VPosition2(object):
                     return False
                 self._longTdFrozen += volume
             self._longPosFrozen += volume
-            self.pos_log(LEVEL_INFO, '*position by req close long vol:{} longPos:{},longFrozen:{},longYdFrozen:{},longTdFrozen:{}'\
-                         .format(volume, self._longPos, self._longPosFrozen, self._longYdFrozen, self._longTdFrozen))
+            self.pos_log(LEVEL_INFO, '*position by req close long vol:{} longPos:{},longFrozen:{},longYdFrozen:{},longTdFrozen:{}',
+                         volume, self._longPos, self._longPosFrozen, self._longYdFrozen, self._longTdFrozen)
 
         # freeze success
         return True
@@ -338,8 +387,8 @@ class VPosition2(object):
                     self._shortYdFrozen -= volume
             elif order.offset == OFFSET_CLOSETODAY:
                     self._shortTdFrozen -= volume
-            self.pos_log(LEVEL_INFO, '*position by cancel short vol:{} shortPos:{},shortFrozen:{},shortYdFrozen:{},shortTdFrozen:{}'\
-                         .format(volume, self._shortPos, self._shortPosFrozen, self._shortYdFrozen, self._shortTdFrozen))
+            self.pos_log(LEVEL_INFO, '*position by cancel short vol:{} shortPos:{},shortFrozen:{},shortYdFrozen:{},shortTdFrozen:{}',
+                         volume, self._shortPos, self._shortPosFrozen, self._shortYdFrozen, self._shortTdFrozen)
         elif order.direction == Direction.Short:
             # 平多仓
             self._longPosFrozen -= volume
@@ -351,11 +400,13 @@ class VPosition2(object):
                     self._longYdFrozen -= volume
             elif order.offset == OFFSET_CLOSETODAY:
                 self._longTdFrozen -= volume
-            self.pos_log(LEVEL_INFO, '*position by cancel long vol:{} longPos:{},longFrozen:{},longYdFrozen:{},longTdFrozen:{}'\
-                         .format(volume, self._longPos, self._longPosFrozen, self._longYdFrozen, self._longTdFrozen))
+            self.pos_log(LEVEL_INFO, '*position by cancel long vol:{} longPos:{},longFrozen:{},longYdFrozen:{},longTdFrozen:{}',
+                         volume, self._longPos, self._longPosFrozen, self._longYdFrozen, self._longTdFrozen)
 
     def process_order_trade(self, trade):
         """处理成交回报，更新本地持仓详情"""
+        # 盈亏按成交前的持仓计算，与逐笔计算一致
+        self._flush_pnl()
         volume = trade.volume
         price = trade.price
         direction = trade.direction
@@ -367,7 +418,7 @@ class VPosition2(object):
         # 开仓保存一条明细
         if offset == OFFSET_OPEN:
             _posDetail = self._make_position_detail_data(trade, margin)
-            self.positionDetails.append(_posDetail)
+            self._add_position_detail(_posDetail)
 
         # 平仓盈亏
         realizedPnl = 0.0
@@ -383,8 +434,8 @@ class VPosition2(object):
             cost += volume * price
             self._longPrice = cost / self._longPos
             self._longUpdateTime = trade.tradeTime
-            self.pos_log(LEVEL_INFO, '*position by trade open long px:{},vol:{} longPos:{},longMargin:{},longPrice:{},longPnl:{}'\
-                         .format(price, volume, self._longPos, self._longMargin, self._longPrice, self._longPnl))
+            self.pos_log(LEVEL_INFO, '*position by trade open long px:{},vol:{} longPos:{},longMargin:{},longPrice:{},longPnl:{}',
+                         price, volume, self._longPos, self._longMargin, self._longPrice, self._longPnl)
         elif direction == Direction.Short and offset == OFFSET_OPEN:
             # 开空仓
             cost = self._shortPrice * self._shortPos
@@ -396,8 +447,8 @@ class VPosition2(object):
             cost += volume * price
             self._shortPrice = cost / self._shortPos
             self._shortUpdateTime = trade.tradeTime
-            self.pos_log(LEVEL_INFO, '*position by trade open short px:{},vol:{} shortPos:{},shortMargin:{},shortPrice:{},shortPnl:{}'\
-                         .format(price, volume, self._shortPos, self._shortMargin, self._shortPrice, self._shortPnl))
+            self.pos_log(LEVEL_INFO, '*position by trade open short px:{},vol:{} shortPos:{},shortMargin:{},shortPrice:{},shortPnl:{}',
+                         price, volume, self._shortPos, self._shortMargin, self._shortPrice, self._shortPnl)
         elif direction == Direction.Long:
             # 平空仓
             self._shortPos -= volume
@@ -428,8 +479,8 @@ class VPosition2(object):
                 self._shortMargin = 0.0
 
             self._shortUpdateTime = trade.tradeTime
-            self.pos_log(LEVEL_INFO, '*position by trade close short px:{},vol:{} shortPos:{},shortMargin:{},shortPnl:{},rpnl:{}'\
-                         .format(price, volume, self._shortPos, self._shortMargin, self._shortPnl, realizedPnl))
+            self.pos_log(LEVEL_INFO, '*position by trade close short px:{},vol:{} shortPos:{},shortMargin:{},shortPnl:{},rpnl:{}',
+                         price, volume, self._shortPos, self._shortMargin, self._shortPnl, realizedPnl)
         elif direction == Direction.Short:
             # 平多仓
             self._longPos -= volume
@@ -460,8 +511,8 @@ class VPosition2(object):
                 self._longMargin = 0.0
 
             self._longUpdateTime = trade.tradeTime
-            self.pos_log(LEVEL_INFO, '*position by trade close long px:{},vol:{} longPos:{},longMargin:{},longPnl:{},rpnl:{}'\
-                         .format(price, volume, self._longPos, self._longMargin, self._longPnl, realizedPnl))
+            self.pos_log(LEVEL_INFO, '*position by trade close long px:{},vol:{} longPos:{},longMargin:{},longPnl:{},rpnl:{}',
+                         price, volume, self._longPos, self._longMargin, self._longPnl, realizedPnl)
 
         return realizedPnl
 
@@ -471,6 +522,7 @@ class VPosition2(object):
         assert self.btSymbol == pos.btSymbol, \
                'process_position_update self symbol {} != {}'\
                     .format(self.btSymbol, pos.btSymbol)
+        self._flush_pnl()
 
         if pos.direction == Direction.Long:
             self._longPos = pos.position
@@ -489,12 +541,12 @@ class VPosition2(object):
             self._shortMargin = pos.useMargin
             self._shortPosFrozen = pos.frozen
         else:
-            self.pos_log(LEVEL_ERROR, 'process_position_update unknown direction {} for {}'\
-                         .format(pos.direction, pos.btSymbol))
+            self.pos_log(LEVEL_ERROR, 'process_position_update unknown direction {} for {}',
+                         pos.direction, pos.btSymbol)
 
     def process_position_detail_update(self, posDetail):
         """持仓明细查询返回"""
-        self.positionDetails.append(posDetail)
+        self._add_position_detail(posDetail)
         self.latestPosDateTime = max(self.latestPosDateTime, posDetail.openDateTime)
 
     def update_position_by_detail(self, posDetail):
@@ -509,9 +561,10 @@ class VPosition2(object):
         if posDetail.volume <= 0:
             return
 
+        self._flush_pnl()
         # 保存持仓明细
         posDetail = copy(posDetail)
-        self.positionDetails.append(posDetail)
+        self._add_position_detail(posDetail)
 
         # 策略冻结数量需要从挂单中获取
 
@@ -535,21 +588,33 @@ class VPosition2(object):
             self._shortTdPos = self._shortPos - self._shortYdPos
             self._shortMargin = self.calculate_margin(Direction.Short, self._shortPos, self._shortPrice)
         else:
-            self.pos_log(LEVEL_ERROR, 'update_position_by_detail unknown direction {} for {}'\
-                         .format(posDetail.direction, posDetail.btSymbol))
+            self.pos_log(LEVEL_ERROR, 'update_position_by_detail unknown direction {} for {}',
+                         posDetail.direction, posDetail.btSymbol)
 
     #----------------------------------------------------------------------
     def process_tick_updated(self, lastPrice):
-        """行情更新"""
+        """行情更新，懒计算时只记录最新价"""
         self.lastPrice = lastPrice
-        self.calculate_position_pnl()
+        if not self.lazyPnl:
+            self.calculate_position_pnl()
+        elif self._pnlDirty:
+            self.pnlSkipN += 1
+        else:
+            self._pnlDirty = True
 
         # 计数加1
         self.tickUpdateN += 1
 
+    def _flush_pnl(self):
+        """补算懒计算模式下未计算的持仓盈亏"""
+        if self._pnlDirty:
+            self._pnlDirty = False
+            self.calculate_position_pnl()
+
     #----------------------------------------------------------------------
     def get_position_pnl(self, direction=None):
         """获取持仓盈亏"""
+        self._flush_pnl()
         if direction is None:
             return self._longPnl + self._shortPnl
         elif direction == Direction.Long:
@@ -572,6 +637,7 @@ class VPosition2(object):
     #----------------------------------------------------------------------
     def calculate_position_pnl(self):
         """计算持仓盈亏"""
+        self.pnlCalcN += 1
         self._longPnl = self._longPos * (self.lastPrice - self._longPrice) * self.multiplier
         self._shortPnl = self._shortPos * (self._shortPrice - self.lastPrice) * self.multiplier
 
@@ -592,72 +658,101 @@ class VPosition2(object):
 
     #----------------------------------------------------------------------
     def calculate_position_price(self, direction):
-        """重新计算持仓均价"""
-        positionPrice = 0.0
-        totalVolume = 0
-        for posDetail in self.positionDetails:
-            if direction != posDetail.direction:
-                continue
-            totalVolume += posDetail.volume
-            positionPrice += posDetail.positionPrice * posDetail.volume
+        """重新计算持仓均价，由持仓明细的汇总得到，不再遍历明细"""
+        if direction == Direction.Long:
+            totalVolume, positionCost = self._longDetailVolume, self._longDetailCost
+        elif direction == Direction.Short:
+            totalVolume, positionCost = self._shortDetailVolume, self._shortDetailCost
+        else:
+            return 0.0
 
         if totalVolume > 0:
-            positionPrice = positionPrice / totalVolume
-
-        #print("calc_price>> {}.{} volume:{},price:{}".format(self.symbol, direction, totalVolume, positionPrice))
+            return positionCost / totalVolume
+        return 0.0
 
-        return positionPrice
+    def _update_detail_sum(self, direction, volume, price):
+        """持仓明细增减 volume（负数为减少）时更新汇总，数量归零时成本也归零，避免累计误差"""
+        if direction == Direction.Long:
+            self._longDetailVolume += volume
+            if self._longDetailVolume > 0:
+                self._longDetailCost += volume * price
+            else:
+                self._longDetailCost = 0.0
+        elif direction == Direction.Short:
+            self._shortDetailVolume += volume
+            if self._shortDetailVolume > 0:
+                self._shortDetailCost += volume * price
+            else:
+                self._shortDetailCost = 0.0
+
+    def _get_detail_queue(self, direction, isYdPosition):
+        key = (direction, isYdPosition)
+        details = self._detailQueues.get(key)
+        if details is None:
+            details = deque()
+            self._detailQueues[key] = details
+        return details
+
+    def _add_position_detail(self, posDetail):
+        """保存一条持仓明细"""
+        isYdPosition = posDetail.positionDate == POSITION_DATE_YESTERDAY
+        self._get_detail_queue(posDetail.direction, isYdPosition).append(posDetail)
+        self._update_detail_sum(posDetail.direction, posDetail.volume, posDetail.positionPrice)
 
     def close_position_detail_data(self, trade):
-        """平仓时处理明细数据，返回平仓盈亏和原始占用的保证金"""
+        """平仓时处理明细数据，返回平仓盈亏和原始占用的保证金
+        按开仓顺序从队首平仓，平仓先平昨仓再平今仓，平今只平今仓
+        """
         if trade.offset == OFFSET_OPEN:
             return
 
         margin = 0.0
         realizedPnl = 0.0
         volume = trade.volume
-        removes = []
-        for posDetail in self.positionDetails:
-            if trade.direction == posDetail.direction:
-                continue
-
-            # 平今、平昨
-            if trade.offset == OFFSET_CLOSETODAY and posDetail.positionDate == POSITION_DATE_YESTERDAY:
-                continue
-
-            if volume < posDetail.volume:
-                closedVolume = volume
-                posDetail.volume -= volume
-                volume = 0
-            else:
-                closedVolume = posDetail.volume
-                volume -= posDetail.volume
-                removes.append(posDetail)
 
-            # 保证金
-            margin += posDetail.margin
-
-            # 计算平仓盈亏
-            if posDetail.direction == Direction.Long:
-                realizedPnl += (trade.price - posDetail.positionPrice) *\
-                    closedVolume * self.multiplier
-            else:
-                realizedPnl += (posDetail.positionPrice - trade.price) * closedVolume * self.multiplier
+        # 被平的是反方向的持仓
+        direction = Direction.Short if trade.direction == Direction.Long else Direction.Long
+        if trade.offset == OFFSET_CLOSETODAY:
+            queues = (self._get_detail_queue(direction, False),)
+        else:
+            queues = (self._get_detail_queue(direction, True), self._get_detail_queue(direction, False))
+
+        for details in queues:
+            while details:
+                posDetail = details[0]
+                if volume < posDetail.volume:
+                    closedVolume = volume
+                    posDetail.volume -= volume
+                    volume = 0
+                else:
+                    closedVolume = posDetail.volume
+                    volume -= posDetail.volume
+                    # 从明细队列中删除
+                    details.popleft()
+                    self.pos_log(LEVEL_DEBUG, "remove_pos_detail: {}", posDetail)
+
+                # 保证金
+                margin += posDetail.margin
+                self._update_detail_sum(direction, -closedVolume, posDetail.positionPrice)
+
+                # 计算平仓盈亏
+                if direction == Direction.Long:
+                    realizedPnl += (trade.price - posDetail.positionPrice) * closedVolume * self.multiplier
+                else:
+                    realizedPnl += (posDetail.positionPrice - trade.price) * closedVolume * self.multiplier
 
+                if volume <= 0:
+                    break
             if volume <= 0:
                 break
 
         #print("close_detail: volume:{}, rpnl:{}".format(trade.volume, realizedPnl))
 
-        # 从明细队列中删除
-        for _removePos in removes:
-            self.pos_log(LEVEL_DEBUG, "remove_pos_detail: {}".format(_removePos))
-            self.positionDetails.remove(_removePos)
-
         return realizedPnl, margin
 
     #----------------------------------------------------------------------
     def to_dict(self):
+        self._flush_pnl()
         d = {
             'symbol' : self.symbol,
             'btSymbol' : self.btSymbol,
@@ -683,10 +778,12 @@ class VPosition2(object):
         return d
 
     #----------------------------------------------------------------------
-    def pos_log(self, level, content):
-        """position异步日志"""
-        if log:
-            log.async_log(level, self.logPrefix + content)
+    def pos_log(self, level, fmt, *args):
+        """position异步日志，fmt 为 str.format 格式串，只在输出时才格式化"""
+        if self.logRing is not None:
+            self.logRing.append((level, fmt, args))
+        if log and level >= self.logLevel:
+            log.async_log(level, self.logPrefix + fmt.format(*args))
 
     def pos_str(self):
         """返回简单持仓字符串"""
@@ -741,6 +838,7 @@ class VPosition2(object):
         #if self.longPos == 0:
         #    return None
 
+        self._flush_pnl()
         posData = BtPositionData()
         self._conv_position_common_field(posData)
 
@@ -762,6 +860,7 @@ class VPosition2(object):
         #if self.shortPos == 0:
         #    return None
 
+        self._flush_pnl()
         posData = BtPositionData()
         self._conv_position_common_field(posData)
 